@@ -12,12 +12,13 @@ setup(name='xirvik-tools',
       long_description=open('README.md').read(),
       install_requires=[
           'Unidecode>=0.4.19',
+          'aiohttp>=3.6.0',
           'argcomplete>=1.10.3',
           'benc>=2019.8.1',
           'cached-property>=1.0.0',
           'humanize>=0.5.1',
           'lockfile>=0.10.2',
-          'paramiko>=1.17.0',
+          'paramiko>=3.3.0',
           'requests-futures>=1.0.0',
           'requests>=2.6.0',
           'six>=1.10.0',
@@ -34,6 +35,7 @@ setup(name='xirvik-tools',
               'xirvik-move-by-label = xirvik.commands.move_by_label:main',
               'xirvik-move-erroneous = xirvik.commands.move_erroneous:main',
               'xirvik-start-torrents = xirvik.commands:start_torrents',
+              'xirvik-verify = xirvik.commands.verify:main',
           ]
       },
       test_suite='xirvik.test',
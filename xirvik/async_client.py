@@ -0,0 +1,317 @@
+"""asyncio client for ruTorrent."""
+from base64 import b64encode
+from cgi import parse_header
+from typing import (Any, Callable, Dict, List, Mapping, Optional, Sequence,
+                    Tuple, Union, cast)
+import asyncio
+import json
+import xmlrpc.client as xmlrpc
+
+import aiohttp
+
+from .client import (TORRENT_LABEL_INDEX, _delete_calls, _fix_file_row,
+                     _list_files_data, _move_torrent_data, _raise_faults,
+                     _raise_for_errors, _ruTorrentClientBase, _set_label_data,
+                     _TORRENT_DECODER)
+from .typing import TorrentDict
+
+__all__ = ('AsyncRuTorrentClient', )
+
+#: Longest time to wait between retries in seconds.
+BACKOFF_MAX = 120
+
+
+class AsyncRuTorrentClient(_ruTorrentClientBase):
+    """
+    asyncio ruTorrent client class.
+
+    All requests go through one aiohttp session, so connections are pooled
+    and kept alive. At most max_in_flight requests are sent at once; callers
+    can start as many coroutines as they like.
+
+    Use as an async context manager or call close() when done.
+    """
+    def __init__(self,
+                 host: str,
+                 name: Optional[str] = None,
+                 password: Optional[str] = None,
+                 max_retries: int = 10,
+                 netrc_path: Optional[str] = None,
+                 max_in_flight: int = 16,
+                 timeout: Optional[float] = None):
+        """
+        Construct an asyncio ruTorrent client.
+
+        host, name, password and netrc_path are the same as for
+        ruTorrentClient.
+
+        max_retries is the number of times a request is retried after a
+        connection error or a timeout. max_in_flight is the number of requests
+        sent at once and the size of the connection pool. timeout is the total
+        time in seconds for a single request, not counting time spent waiting
+        for other requests to finish.
+        """
+        super().__init__(host, name, password, netrc_path)
+        self.max_retries = max_retries
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self._client_session: Optional[aiohttp.ClientSession] = None
+        self._in_flight: Optional[asyncio.Semaphore] = None
+
+    async def __aenter__(self) -> 'AsyncRuTorrentClient':
+        """For use with an async with statement."""
+        return self
+
+    async def __aexit__(self, exc_type: Any, exc_val: Any,
+                        exc_tb: Any) -> None:
+        """For use with an async with statement."""
+        await self.close()
+
+    @property
+    def _session(self) -> aiohttp.ClientSession:
+        # Created on first use so that it belongs to the running event loop
+        if self._client_session is None or self._client_session.closed:
+            credentials = '{}:{}'.format(self.name, self.password)
+            self._client_session = aiohttp.ClientSession(
+                headers={
+                    'Authorization':
+                    'Basic ' + b64encode(credentials.encode()).decode()
+                },
+                connector=aiohttp.TCPConnector(limit=self.max_in_flight),
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+            # Requests wait here rather than for a pool slot, where the wait
+            # would count towards the timeout
+            self._in_flight = asyncio.Semaphore(self.max_in_flight)
+        return self._client_session
+
+    async def close(self) -> None:
+        """Close the session and its connections."""
+        if self._client_session is not None:
+            await self._client_session.close()
+            self._client_session = None
+
+    async def _request(self,
+                       method: str,
+                       url: str,
+                       data: Any = None,
+                       headers: Optional[Mapping[str, str]] = None
+                       ) -> Tuple[bytes, Mapping[str, str]]:
+        # data may be a callable for bodies that can only be sent once (forms)
+        attempt = 0
+        while True:
+            session = self._session
+            assert self._in_flight is not None
+            try:
+                async with self._in_flight, session.request(
+                        method,
+                        url,
+                        data=data() if callable(data) else data,
+                        headers=headers) as r:
+                    r.raise_for_status()
+                    return await r.read(), r.headers
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise e
+                delay = min(2**(attempt - 1), BACKOFF_MAX)
+                self._log.debug('Retrying %s %s in %d seconds (%s)', method,
+                                url, delay, e)
+                await asyncio.sleep(delay)
+
+    async def _post_json(self, url: str, data: Any) -> Any:
+        headers = None
+        if isinstance(data, bytes):
+            # Pre-encoded form data with repeated keys
+            headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        body, _ = await self._request('POST', url, data=data, headers=headers)
+        return json.loads(body)
+
+    async def add_torrent(self, filepath: str, start_now: bool = True) -> None:
+        """Add a torrent. Use start_now=False to start paused."""
+        with open(filepath, 'rb') as f:
+            content = f.read()
+
+        def make_form() -> aiohttp.FormData:
+            form = aiohttp.FormData()
+            if not start_now:
+                form.add_field('torrents_start_stopped', 'on')
+            form.add_field('torrent_file', content, filename=filepath)
+            return form
+
+        await self._request('POST', self._add_torrent_uri, data=make_form)
+
+    async def add_torrent_url(self, url: str) -> None:
+        """Add a torrent via a publicly accessible URI."""
+        await self._request('POST', self._add_torrent_uri, data=dict(url=url))
+
+    async def list_torrents(self) -> Mapping[str, Sequence[Any]]:
+        """
+        List torrents as they come from ruTorrent.
+
+        See ruTorrentClient.list_torrents().
+        """
+        ret = (await self._list(None))['t']
+        if isinstance(ret, list):
+            raise ValueError('Unexpected type from API')
+        return cast(Mapping[str, Sequence[Any]], ret)
+
+    async def list_torrents_since(
+        self,
+        cid: Optional[int] = None
+    ) -> Tuple[Mapping[str, Union[Sequence[Any], bool]], int]:
+        """
+        List torrents that changed since a previous change ID (cid).
+
+        See ruTorrentClient.list_torrents_since().
+        """
+        json_ = await self._list(cid)
+        ret = json_['t']
+        if isinstance(ret, list):
+            if ret:
+                raise ValueError('Unexpected type from API')
+            ret = {}
+        return cast(Mapping[str, Union[Sequence[Any], bool]],
+                    ret), int(json_['cid'])
+
+    async def _list(self, cid: Optional[int]) -> Dict[str, Any]:
+        data: Dict[str, Any] = {
+            'mode': 'list',
+            'cmd': 'd.custom=addtime',
+        }
+        if cid is not None:
+            data['cid'] = str(cid)
+        return cast(Dict[str, Any], await
+                    self._post_json(self.multirpc_action_uri, data))
+
+    async def list_torrents_dict(self) -> Mapping[str, TorrentDict]:
+        """
+        Get all torrent information.
+
+        See ruTorrentClient.list_torrents_dict() for the fields.
+        """
+        return cast(Mapping[str, TorrentDict],
+                    _TORRENT_DECODER.decode(await self.list_torrents()))
+
+    async def get_torrent(self, hash_: str) -> Tuple[bytes, str]:
+        """
+        Get a torrent file given a hash.
+
+        Return tuple of the torrent file contents and the file name string.
+        """
+        body, headers = await self._request('GET', self._source_uri(hash_))
+        fn = parse_header(headers['content-disposition'])[1]['filename']
+        return body, fn
+
+    async def move_torrent(self,
+                           hash_: str,
+                           target_dir: str,
+                           fast_resume: bool = True) -> None:
+        """
+        Move a torrent's files to somewhere else on the server.
+
+        target_dir must be a valid and usable directory.
+        """
+        _raise_for_errors(await self._post_json(
+            self.datadir_action_uri,
+            _move_torrent_data(hash_, target_dir, fast_resume)))
+
+    async def set_label_to_hashes(self,
+                                  *,
+                                  hashes: Sequence[str],
+                                  label: str,
+                                  allow_recursive_fix: bool = True,
+                                  recursion_limit: int = 5) -> None:
+        """
+        Set a label to a list of info hashes. The label can be a new label.
+
+        See ruTorrentClient.set_label_to_hashes(). Torrents that did not get
+        the label are retried up to recursion_limit times.
+        """
+        if not hashes or not label:
+            raise TypeError('"hashes" (list) and "label" (str) keyword '
+                            'arguments are required')
+        attempt = 0
+        while True:
+            json_ = await self._post_json(self.multirpc_action_uri,
+                                          _set_label_data(hashes, label))
+            if len(json_) == len(hashes):
+                return
+            self._log.warning(
+                'JSON returned should have been an array with '
+                'same length as hashes list passed in: %s', json_)
+            if not allow_recursive_fix or attempt >= recursion_limit:
+                self._log.warning('Passed recursion limit for label fix')
+                return
+            attempt += 1
+            self._log.info('Attempting label again (%d out of %d)', attempt,
+                           recursion_limit)
+            hashes = [
+                hash_ for hash_, v in (await self.list_torrents()).items()
+                if hash_ in hashes and not v[TORRENT_LABEL_INDEX].strip()
+            ]
+            if not hashes:
+                self._log.debug('Found no torrents to correct')
+                return
+
+    async def set_label(self, label: str, hash_: str) -> None:
+        """Set a label to a torrent hash."""
+        await self.set_label_to_hashes(hashes=[hash_], label=label)
+
+    async def list_files(self,
+                         hash_: str) -> List[Sequence[Union[int, str]]]:
+        """
+        List files for a given torrent hash.
+
+        See ruTorrentClient.list_files() for the fields.
+        """
+        return [
+            _fix_file_row(x) for x in await self._post_json(
+                self.multirpc_action_uri, _list_files_data(hash_))
+        ]
+
+    async def delete(self, hash_: str) -> None:
+        """
+        Delete a torrent and its files by hash. Use the remove() method to
+        remove the torrent but keep the data.
+
+        Returns if successful. Faults are converted to xmlrpc.Fault exceptions.
+        """
+        calls = [
+            dict(methodName=method, params=list(params))
+            for method, params in _delete_calls(hash_)
+        ]
+        body, _ = await self._request(
+            'POST',
+            self.multirpc_action_uri,
+            data=xmlrpc.dumps((calls, ), 'system.multicall'),
+            headers={'Content-Type': 'text/xml'})
+        _raise_faults(xmlrpc.loads(body)[0][0])
+
+    async def remove(self, hash_: str) -> None:
+        """
+        Remove a torrent from the client but keep the data. Use the delete()
+        method to remove and delete the torrent data.
+        """
+        await self._request('POST',
+                            self.multirpc_action_uri,
+                            data=dict(mode='remove', hash=hash_))
+
+    async def stop(self, hash_: str) -> None:
+        """Stop a torrent by hash."""
+        await self._request('POST',
+                            self.multirpc_action_uri,
+                            data=dict(mode='stop', hash=hash_))
+
+    async def gather(self, func: Callable[[str], Any],
+                     hashes: Sequence[str]) -> List[Any]:
+        """
+        Call a coroutine method for many hashes concurrently.
+
+        Example use:
+            await client.gather(client.stop, hashes)
+
+        Returns the results in the same order as hashes. Exceptions are
+        returned instead of raised.
+        """
+        return list(await asyncio.gather(*(func(x) for x in hashes),
+                                         return_exceptions=True))
@@ -0,0 +1,432 @@
+"""On-disk caches."""
+from os import makedirs, remove as rm, replace, scandir, stat, utime
+from os.path import dirname, expanduser, isfile, join as path_join, sep
+from tempfile import mkstemp
+from threading import Lock
+from typing import (Any, Dict, Iterable, List, Mapping, NamedTuple, Optional,
+                    Sequence, Tuple)
+import json
+import logging
+import sqlite3
+import time
+
+__all__ = (
+    'DEFAULT_TORRENT_CACHE_DIR',
+    'DEFAULT_TORRENT_CACHE_SIZE',
+    'DEFAULT_VERIFIED_STATE_PATH',
+    'DEFAULT_TRANSFER_SETTINGS_PATH',
+    'DEFAULT_REMOTE_MANIFEST_MAX_AGE',
+    'DEFAULT_REMOTE_MANIFEST_PATH',
+    'FileState',
+    'ManifestFile',
+    'RemoteManifest',
+    'TorrentFileCache',
+    'TransferSettingsCache',
+    'VerifiedStateStore',
+    'write_atomic',
+)
+
+#: Default directory for TorrentFileCache.
+DEFAULT_TORRENT_CACHE_DIR = '~/.cache/xirvik/torrents'
+#: Default maximum size of a TorrentFileCache in bytes.
+DEFAULT_TORRENT_CACHE_SIZE = 256 * 1024 * 1024
+#: Default database path for VerifiedStateStore.
+DEFAULT_VERIFIED_STATE_PATH = '~/.cache/xirvik/verified.sqlite3'
+#: Default path for TransferSettingsCache.
+DEFAULT_TRANSFER_SETTINGS_PATH = '~/.cache/xirvik/sftp-transfer.json'
+#: Default database path for RemoteManifest.
+DEFAULT_REMOTE_MANIFEST_PATH = '~/.cache/xirvik/remote-manifest.sqlite3'
+#: Default age in seconds after which RemoteManifest listings are ignored.
+DEFAULT_REMOTE_MANIFEST_MAX_AGE = 24 * 3600
+LOG_NAME = 'xirvik.cache'
+
+_TORRENT_SUFFIX = '.torrent'
+_NAME_SUFFIX = '.name'
+
+
+def write_atomic(path: str, content: bytes) -> None:
+    """
+    Write content to a temporary file in the same directory as path, then
+    rename it over path so readers never see a partial file.
+    """
+    fd, tmp = mkstemp(dir=dirname(path), prefix='.tmp-')
+    try:
+        with open(fd, 'wb') as f:
+            f.write(content)
+        replace(tmp, path)
+    except BaseException:
+        try:
+            rm(tmp)
+        except OSError:
+            pass
+        raise
+
+
+class TorrentFileCache:
+    """
+    Size-bounded cache of .torrent files keyed by info hash.
+
+    Torrent metainfo never changes for an info hash, so entries never need to
+    be refreshed. When the cache grows past max_size bytes, the least recently
+    used entries are removed. Reads update the modification time of an entry
+    to mark it as used.
+    """
+    def __init__(self,
+                 path: str = DEFAULT_TORRENT_CACHE_DIR,
+                 max_size: int = DEFAULT_TORRENT_CACHE_SIZE):
+        """Construct a cache in directory path (created if necessary)."""
+        self.path = expanduser(path)
+        self.max_size = max_size
+        self._log = logging.getLogger(LOG_NAME)
+        makedirs(self.path, exist_ok=True)
+
+    def _entry_path(self, hash_: str) -> str:
+        if not hash_.isalnum():
+            raise ValueError(f'Invalid hash: {hash_}')
+        return path_join(self.path, hash_.upper())
+
+    def get(self, hash_: str) -> Optional[Tuple[bytes, str]]:
+        """
+        Get a cached torrent file.
+
+        Return a tuple of the file contents and the file name, or None if the
+        hash is not in the cache.
+        """
+        entry = self._entry_path(hash_)
+        try:
+            with open(entry + _TORRENT_SUFFIX, 'rb') as f:
+                content = f.read()
+            with open(entry + _NAME_SUFFIX, 'r', encoding='utf-8') as f:
+                name = f.read()
+        except OSError:
+            return None
+        try:
+            utime(entry + _TORRENT_SUFFIX)
+        except OSError:
+            pass
+        self._log.debug('Cache hit for %s', hash_)
+        return content, name
+
+    def put(self, hash_: str, content: bytes, name: str) -> None:
+        """Store a torrent file and its file name, then evict if needed."""
+        entry = self._entry_path(hash_)
+        # The name goes first: an entry only counts once its .torrent exists
+        write_atomic(entry + _NAME_SUFFIX, name.encode('utf-8'))
+        write_atomic(entry + _TORRENT_SUFFIX, content)
+        self.evict()
+
+    def __contains__(self, hash_: object) -> bool:
+        """Check if a hash is in the cache."""
+        return isinstance(hash_, str) and isfile(
+            self._entry_path(hash_) + _TORRENT_SUFFIX)
+
+    def evict(self) -> None:
+        """Remove least recently used entries until within max_size."""
+        entries: List[Tuple[float, int, str]] = []
+        total = 0
+        with scandir(self.path) as it:
+            for x in it:
+                if not x.name.endswith(_TORRENT_SUFFIX):
+                    continue
+                try:
+                    st = x.stat()
+                except OSError:
+                    # Removed by another process since it was listed
+                    continue
+                entries.append((st.st_mtime, st.st_size, x.path))
+                total += st.st_size
+        if total <= self.max_size:
+            return
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            self._log.debug('Evicting %s', path)
+            for p in (path, path[:-len(_TORRENT_SUFFIX)] + _NAME_SUFFIX):
+                try:
+                    rm(p)
+                except OSError:
+                    pass
+            total -= size
+
+
+#: State of a file: size, modification time in nanoseconds and inode.
+FileState = Tuple[int, int, int]
+
+
+class VerifiedStateStore:
+    """
+    SQLite database of torrents whose data passed verification, keyed by
+    info hash.
+
+    The size, modification time and inode of each file are saved with the
+    time of verification. If none of them have changed, the data does not
+    need to be hashed again. Safe to use from several threads.
+    """
+    def __init__(self, path: str = DEFAULT_VERIFIED_STATE_PATH):
+        """Open or create the database at path."""
+        self.path = expanduser(path)
+        self._log = logging.getLogger(LOG_NAME)
+        self._lock = Lock()
+        if dirname(self.path):
+            makedirs(dirname(self.path), exist_ok=True)
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS verified ('
+                             'info_hash TEXT PRIMARY KEY, '
+                             'files TEXT NOT NULL, '
+                             'verified_at REAL NOT NULL)')
+
+    @staticmethod
+    def file_states(paths: Iterable[str]) -> Optional[List[FileState]]:
+        """
+        Get the state of each file, or None if any cannot be read.
+
+        Get the states before hashing and pass them to mark_verified(), so
+        changes made while hashing are noticed the next time.
+        """
+        ret = []
+        for path in paths:
+            try:
+                st = stat(path)
+            except OSError:
+                return None
+            ret.append((st.st_size, st.st_mtime_ns, st.st_ino))
+        return ret
+
+    def _get(self, info_hash: str) -> Optional[Tuple[str, float]]:
+        with self._lock:
+            return self._db.execute(
+                'SELECT files, verified_at FROM verified WHERE info_hash = ?',
+                (info_hash.upper(), )).fetchone()
+
+    def is_verified(self, info_hash: str,
+                    states: Optional[Sequence[FileState]]) -> bool:
+        """Check if a torrent was verified with files in the same states."""
+        if states is None:
+            return False
+        row = self._get(info_hash)
+        if row is None:
+            return False
+        if [tuple(x) for x in json.loads(row[0])] != list(states):
+            self._log.debug('Files of %s changed since verification',
+                            info_hash)
+            return False
+        return True
+
+    def verified_at(self, info_hash: str) -> Optional[float]:
+        """Time of the last successful verification, or None."""
+        row = self._get(info_hash)
+        return row[1] if row else None
+
+    def mark_verified(self, info_hash: str,
+                      states: Sequence[FileState]) -> None:
+        """Record that a torrent passed with files in the given states."""
+        with self._lock, self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO verified VALUES (?, ?, ?)',
+                (info_hash.upper(), json.dumps(list(states)), time.time()))
+
+    def forget(self, info_hash: str) -> None:
+        """Remove a torrent."""
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM verified WHERE info_hash = ?',
+                             (info_hash.upper(), ))
+
+    def close(self) -> None:
+        """Close the database."""
+        with self._lock:
+            self._db.close()
+
+
+class TransferSettingsCache:
+    """
+    JSON file of SFTP transfer settings keyed by host.
+
+    Settings are saved with the time they were found, so they can be probed
+    again when they get old.
+    """
+    def __init__(self, path: str = DEFAULT_TRANSFER_SETTINGS_PATH):
+        """Use the file at path. It is created by the first set()."""
+        self.path = expanduser(path)
+        self._lock = Lock()
+
+    def _load(self) -> Dict[str, Any]:
+        try:
+            with open(self.path, 'rb') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    def get(self,
+            host: str,
+            max_age: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        """
+        Settings saved for host.
+
+        Returns None if there are none or they are older than max_age seconds.
+        """
+        with self._lock:
+            entry = self._load().get(host)
+        if not isinstance(entry, dict):
+            return None
+        saved_at = entry.get('saved_at', 0)
+        if max_age is not None and time.time() - saved_at > max_age:
+            return None
+        settings = entry.get('settings')
+        return settings if isinstance(settings, dict) else None
+
+    def set(self, host: str, settings: Mapping[str, Any]) -> None:
+        """Save settings for host."""
+        with self._lock:
+            data = self._load()
+            data[host] = dict(settings=dict(settings), saved_at=time.time())
+            if dirname(self.path):
+                makedirs(dirname(self.path), exist_ok=True)
+            write_atomic(self.path, json.dumps(data).encode())
+
+
+class ManifestFile(NamedTuple):
+    """File in a RemoteManifest."""
+    path: str
+    size: Optional[int]
+    mtime: Optional[int]
+    atime: Optional[int]
+    mode: Optional[int]
+
+
+def _subtree_range(path: str) -> Tuple[str, str]:
+    # Bounds of the paths under path, for use with > and <
+    prefix = path if path.endswith(sep) else path + sep
+    return prefix, prefix[:-1] + chr(ord(sep) + 1)
+
+
+class RemoteManifest:
+    """
+    SQLite database of remote directory listings.
+
+    A tree is identified by a root string, such as the host and directory it
+    was listed from. For each directory that was listed, its modification
+    time and its entries are saved, so a directory whose modification time
+    has not changed does not need to be listed again. Listings older than
+    max_age seconds are ignored so files changed in place are eventually
+    noticed. Safe to use from several threads.
+    """
+    def __init__(self,
+                 path: str = DEFAULT_REMOTE_MANIFEST_PATH,
+                 max_age: Optional[float] = DEFAULT_REMOTE_MANIFEST_MAX_AGE):
+        """Open or create the database at path."""
+        self.path = expanduser(path)
+        self.max_age = max_age
+        self._lock = Lock()
+        if dirname(self.path):
+            makedirs(dirname(self.path), exist_ok=True)
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS dirs ('
+                             'root TEXT NOT NULL, '
+                             'path TEXT NOT NULL, '
+                             'mtime INTEGER, '
+                             'listed_at REAL NOT NULL, '
+                             'PRIMARY KEY (root, path))')
+            self._db.execute('CREATE TABLE IF NOT EXISTS entries ('
+                             'root TEXT NOT NULL, '
+                             'path TEXT NOT NULL, '
+                             'parent TEXT NOT NULL, '
+                             'is_dir INTEGER NOT NULL, '
+                             'size INTEGER, '
+                             'mtime INTEGER, '
+                             'atime INTEGER, '
+                             'mode INTEGER, '
+                             'PRIMARY KEY (root, path))')
+            self._db.execute('CREATE INDEX IF NOT EXISTS entries_parent '
+                             'ON entries (root, parent)')
+
+    def dir_mtime(self, root: str, path: str) -> Optional[int]:
+        """
+        Modification time of a directory when it was listed.
+
+        Returns None if the directory was not listed, its modification time
+        was unknown or the listing is older than max_age.
+        """
+        with self._lock:
+            row = self._db.execute(
+                'SELECT mtime, listed_at FROM dirs WHERE root = ? AND '
+                'path = ?', (root, path)).fetchone()
+        if row is None:
+            return None
+        mtime, listed_at = row
+        if self.max_age is not None and time.time() - listed_at > self.max_age:
+            return None
+        return mtime
+
+    def listing(self, root: str,
+                path: str) -> Tuple[List[ManifestFile], List[str]]:
+        """Files and subdirectory paths saved for a directory."""
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT path, is_dir, size, mtime, atime, mode FROM entries '
+                'WHERE root = ? AND parent = ? ORDER BY path',
+                (root, path)).fetchall()
+        return ([ManifestFile(x[0], *x[2:]) for x in rows if not x[1]],
+                [x[0] for x in rows if x[1]])
+
+    def update(self,
+               root: str,
+               listings: Iterable[Tuple[str, Optional[int],
+                                        Sequence[ManifestFile],
+                                        Sequence[str]]],
+               listed_at: Optional[float] = None) -> None:
+        """
+        Save directory listings in one transaction.
+
+        Each listing is the path of a directory, its modification time (None
+        if it must be listed again next time), the files in it and the paths
+        of its subdirectories. Subdirectories that are no longer there are
+        removed with everything under them.
+
+        listed_at is when the listings started (default: now).
+        """
+        if listed_at is None:
+            listed_at = time.time()
+        with self._lock, self._db:
+            for path, mtime, files, subdirs in listings:
+                keep = set(subdirs)
+                gone = [
+                    x for (x, ) in self._db.execute(
+                        'SELECT path FROM entries WHERE root = ? AND '
+                        'parent = ? AND is_dir', (root, path)) if x not in keep
+                ]
+                for subdir in gone:
+                    for table in ('dirs', 'entries'):
+                        self._db.execute(
+                            f'DELETE FROM {table} WHERE root = ? AND '
+                            '(path = ? OR (path > ? AND path < ?))',
+                            (root, subdir) + _subtree_range(subdir))
+                self._db.execute(
+                    'DELETE FROM entries WHERE root = ? AND parent = ?',
+                    (root, path))
+                self._db.executemany(
+                    'INSERT INTO entries VALUES (?, ?, ?, 0, ?, ?, ?, ?)',
+                    ((root, x.path, path, x.size, x.mtime, x.atime, x.mode)
+                     for x in files))
+                self._db.executemany(
+                    'INSERT INTO entries VALUES '
+                    '(?, ?, ?, 1, NULL, NULL, NULL, NULL)',
+                    ((root, x, path) for x in subdirs))
+                self._db.execute(
+                    'INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?)',
+                    (root, path, mtime, listed_at))
+
+    def forget(self, root: str) -> None:
+        """Remove a tree."""
+        with self._lock, self._db:
+            for table in ('dirs', 'entries'):
+                self._db.execute(f'DELETE FROM {table} WHERE root = ?',
+                                 (root, ))
+
+    def close(self) -> None:
+        """Close the database."""
+        with self._lock:
+            self._db.close()
@@ -1,31 +1,49 @@
 """Client for ruTorrent."""
 from cgi import parse_header
+from concurrent.futures import (FIRST_COMPLETED, Future, ThreadPoolExecutor,
+                                wait)
 from datetime import datetime
+from functools import partial
+from itertools import chain, islice, repeat
 from netrc import netrc
 from os.path import expanduser
-from typing import (Any, Callable, Dict, Iterable, Iterator, Mapping, Optional,
-                    Sequence, Tuple, Union, cast)
+from types import MappingProxyType
+from typing import (Any, Callable, Dict, Iterable, Iterator, List, Mapping,
+                    Optional, Sequence, Set, Tuple, TypeVar, Union, cast)
 from urllib.parse import quote
 import logging
-import re
-import ssl
+import time
 import xmlrpc.client as xmlrpc
 
 from cached_property import cached_property
-from requests.adapters import HTTPAdapter
+from requests.adapters import BaseAdapter, HTTPAdapter
 from requests_futures.sessions import FuturesSession
 from urllib3.util import Retry
 import requests
 
+from .cache import TorrentFileCache
+from .metainfo import parse_metainfo
+from .metrics import InstrumentedHTTPAdapter, MetricsHook
+from .ratelimit import RateLimitedHTTPAdapter, RateLimiter
 from .typing import TorrentDict
+from .util import info_hash_hex
 
 __all__ = (
+    'BULK_BATCH_SIZE',
+    'BulkResults',
     'LOG_NAME',
+    'RETRY_STATUS_CODES',
+    'TORRENT_FIELDS',
     'TORRENT_PATH_INDEX',
+    'TorrentListCache',
     'UnexpectedruTorrentError',
     'ruTorrentClient',
 )
 
+T = TypeVar('T')
+#: Hash to exception mapping returned by bulk methods. None means success.
+BulkResults = Dict[str, Optional[Exception]]
+
 #: Name used in logger.
 LOG_NAME = 'xirvik.rutorrent'
 TORRENT_FILE_DOWNLOAD_STRATEGY_LEADING_CHUNK_FIRST = 1
@@ -38,35 +56,411 @@ TORRENT_LABEL_INDEX = 14
 #: Index of the torrent information list that has the path
 TORRENT_PATH_INDEX = 25
 TORRENT_PIECE_SIZE_INDEX = 13
+#: Names of the columns returned by ruTorrent's list mode, in order.
+TORRENT_FIELDS = (
+    'is_open',
+    'is_hash_checking',
+    'is_hash_checked',
+    'state',
+    'name',
+    'size_bytes',
+    'completed_chunks',
+    'size_chunks',
+    'bytes_done',
+    'up_total',
+    'ratio',
+    'up_rate',
+    'down_rate',
+    'chunk_size',
+    'custom1',
+    'peers_accounted',
+    'peers_not_connected',
+    'peers_connected',
+    'peers_complete',
+    'left_bytes',
+    'priority',
+    'state_changed',
+    'skip_total',
+    'hashing',
+    'chunks_hashed',
+    'base_path',
+    'creation_date',
+    'tracker_focus',
+    'is_active',
+    'message',
+    'custom2',
+    'free_diskspace',
+    'is_private',
+    'is_multi_file',
+)
+#: Default number of hashes sent in one request by the bulk methods.
+BULK_BATCH_SIZE = 100
+#: HTTP status codes fetch_torrents() retries on.
+RETRY_STATUS_CODES = frozenset((429, 500, 502, 503, 504))
+
+_DIGITS = frozenset('0123456789')
+# rTorrent commands for each of TORRENT_FIELDS, used by query()
+_FIELD_COMMANDS: Mapping[str, str] = {
+    'is_open': 'd.is_open',
+    'is_hash_checking': 'd.is_hash_checking',
+    'is_hash_checked': 'd.is_hash_checked',
+    'state': 'd.state',
+    'name': 'd.name',
+    'size_bytes': 'd.size_bytes',
+    'completed_chunks': 'd.completed_chunks',
+    'size_chunks': 'd.size_chunks',
+    'bytes_done': 'd.bytes_done',
+    'up_total': 'd.up.total',
+    'ratio': 'd.ratio',
+    'up_rate': 'd.up.rate',
+    'down_rate': 'd.down.rate',
+    'chunk_size': 'd.chunk_size',
+    'custom1': 'd.custom1',
+    'peers_accounted': 'd.peers_accounted',
+    'peers_not_connected': 'd.peers_not_connected',
+    'peers_connected': 'd.peers_connected',
+    'peers_complete': 'd.peers_complete',
+    'left_bytes': 'd.left_bytes',
+    'priority': 'd.priority',
+    'state_changed': 'd.state_changed',
+    'skip_total': 'd.skip.total',
+    'hashing': 'd.hashing',
+    'chunks_hashed': 'd.chunks_hashed',
+    'base_path': 'd.base_path',
+    'creation_date': 'd.creation_date',
+    'tracker_focus': 'd.tracker_focus',
+    'is_active': 'd.is_active',
+    'message': 'd.message',
+    'custom2': 'd.custom2',
+    'free_diskspace': 'd.free_diskspace',
+    'is_private': 'd.is_private',
+    'is_multi_file': 'd.is_multi_file',
+}
 
 
 class UnexpectedruTorrentError(Exception):
     """Raised when an unexpected error occurs."""
 
 
-class ruTorrentClient:
+def _decode_bool(value: str) -> bool:
+    return value == '1'
+
+
+def _decode_timestamp(value: str) -> datetime:
+    return datetime.fromtimestamp(float(value))
+
+
+def _decode_optional_timestamp(value: str) -> Optional[datetime]:
+    try:
+        fvalue = float(value)
+    except ValueError:
+        return None
+    return datetime.fromtimestamp(fvalue) if fvalue else None
+
+
+def _decode_ratio(value: str) -> float:
+    return int(value) / 1000.0
+
+
+def _decode_number(value: str) -> Any:
+    if value.isdigit() and value.isascii():
+        return int(value)
+    # Values starting with a digit or with a dot followed by a digit are
+    # numeric candidates; anything that fails to convert is kept as-is
+    first = value[:1]
+    if first not in _DIGITS and (first != '.' or value[1:2] not in _DIGITS):
+        return value
+    try:
+        return float(value) if '.' in value else int(value)
+    except ValueError:
+        return value
+
+
+_SPECIAL_DECODERS: Mapping[str, Callable[[str], Any]] = {
+    'creation_date': _decode_optional_timestamp,
+    'hashing': _decode_bool,
+    'ratio': _decode_ratio,
+    'state_changed': _decode_timestamp,
+}
+
+
+def _decode_xmlrpc_ratio(value: int) -> float:
+    return value / 1000.0
+
+
+def _decode_xmlrpc_optional_timestamp(value: int) -> Optional[datetime]:
+    return datetime.fromtimestamp(value) if value else None
+
+
+def _decode_xmlrpc_bool(value: int) -> bool:
+    # Same rule as _decode_bool(), d.hashing is 0 to 3
+    return value == 1
+
+
+def _identity(value: Any) -> Any:
+    return value
+
+
+# XML-RPC values are already typed so only a few fields need converting
+_XMLRPC_DECODERS: Mapping[str, Callable[[Any], Any]] = {
+    'creation_date': _decode_xmlrpc_optional_timestamp,
+    'hashing': _decode_xmlrpc_bool,
+    'ratio': _decode_xmlrpc_ratio,
+    'state_changed': datetime.fromtimestamp,
+}
+
+
+def _get_xmlrpc_decoder(field: str) -> Callable[[Any], Any]:
+    if field.startswith('is_'):
+        return bool
+    return _XMLRPC_DECODERS.get(field, _identity)
+
+
+def _get_decoder(field: str) -> Callable[[str], Any]:
+    if field.startswith('is_'):
+        return _decode_bool
+    return _SPECIAL_DECODERS.get(field, _decode_number)
+
+
+class _MemoizedDecoder(Dict[str, Any]):
+    # Maps a raw cell to its decoded value, running the decoder once per
+    # distinct value. Most columns only have a handful of distinct values
+    # (flags, states, chunk sizes) so lookups hit far more than they miss.
+    def __init__(self, decode: Callable[[str], Any]):
+        super().__init__()
+        self._decode = decode
+
+    def __missing__(self, value: str) -> Any:
+        ret = self[value] = self._decode(value)
+        return ret
+
+
+def _column_lookup(decode: Callable[[str], Any],
+                   column: Sequence[str]) -> Callable[[str], Any]:
+    # Memoising only pays off when values repeat. Names, paths and sizes are
+    # mostly unique so they are decoded directly.
+    if len(set(column)) * 2 > len(column):
+        return decode
+    return _MemoizedDecoder(decode).__getitem__
+
+
+class _TorrentListDecoder:
     """
-    ruTorrent client class.
+    Decodes torrent rows as returned by ruTorrent's list mode.
 
-    Reference on RPC returned fields: https://goo.gl/DvmW4c
+    The per-column decoders are resolved once in the constructor. Rows are
+    decoded column by column so that repeated values are only converted once
+    per call.
     """
-    def __init__(self,
-                 host: str,
-                 name: Optional[str] = None,
-                 password: Optional[str] = None,
-                 max_retries: int = 10,
-                 netrc_path: Optional[str] = None):
+    def __init__(self, fields: Sequence[str]):
+        self.fields = tuple(fields)
+        self._decoders = tuple(_get_decoder(x) for x in self.fields)
+
+    def _decode_layout(
+        self, hashes: Sequence[str], rows: Iterable[Sequence[Any]], width: int
+    ) -> Iterable[Tuple[str, Dict[str, Any]]]:
+        names = self.fields[:width]
+        if not names:
+            return ((hash_, {}) for hash_ in hashes)
+        columns = (map(_column_lookup(decode, column), column)
+                   for decode, column in zip(self._decoders, zip(*rows)))
+        return zip(hashes, map(dict, map(zip, repeat(names), zip(*columns))))
+
+    def decode(
+            self, torrents: Mapping[str, Sequence[Any]]
+    ) -> Dict[str, Dict[str, Any]]:
         """
-        Construct a ruTorrent client.
+        Decode a mapping of hashes to rows into a mapping of dictionaries.
 
-        Host should be the hostname with no protocol.
+        Columns past the known fields are ignored. Rows with fewer columns
+        only get the fields they have.
+        """
+        widths = set(map(len, torrents.values()))
+        if len(widths) <= 1:
+            return dict(
+                self._decode_layout(list(torrents), torrents.values(),
+                                    widths.pop() if widths else 0))
+        layouts: Dict[int, List[str]] = {}
+        for hash_, row in torrents.items():
+            layouts.setdefault(len(row), []).append(hash_)
+        ret: Dict[str, Dict[str, Any]] = {}
+        for width, hashes in layouts.items():
+            ret.update(
+                self._decode_layout(hashes, (torrents[x] for x in hashes),
+                                    width))
+        # Keep the order ruTorrent returned
+        return {hash_: ret[hash_] for hash_ in torrents}
 
-        If no name and no password are passed, ~/.netrc will be searched with
-        the host provided. The path can be overridden with the netrc_path
-        argument.
 
-        max_retries is used as an argument for urllib3's Retry() class.
+_TORRENT_DECODER = _TorrentListDecoder(TORRENT_FIELDS)
+
+
+class TorrentListCache:
+    """
+    Merged view of the torrent list kept up to date with change IDs.
+
+    The first call to update() downloads the full list. Later calls only
+    transfer the torrents that were added, changed or deleted since the
+    previous call.
+    """
+    def __init__(self, client: 'ruTorrentClient'):
+        """Construct a cache for a ruTorrentClient instance."""
+        self.client = client
+        self.cid: Optional[int] = None
+        self._torrents: Dict[str, Sequence[Any]] = {}
+        self._decoded: Dict[str, Dict[str, Any]] = {}
+        self._stale: Set[str] = set()
+
+    @property
+    def torrents(self) -> Mapping[str, Sequence[Any]]:
+        """Return the merged view in the same format as list_torrents()."""
+        return MappingProxyType(self._torrents)
+
+    @property
+    def torrents_dict(self) -> Mapping[str, TorrentDict]:
+        """
+        Return the merged view in the same format as list_torrents_dict().
+
+        Only rows that changed since the last access are decoded.
+        """
+        if self._stale:
+            self._decoded.update(
+                _TORRENT_DECODER.decode(
+                    {x: self._torrents[x]
+                     for x in self._stale}))
+            self._stale.clear()
+        return cast(Mapping[str, TorrentDict], MappingProxyType(self._decoded))
+
+    def reset(self) -> None:
+        """Forget the snapshot so the next update() fetches everything."""
+        self.cid = None
+        self._torrents.clear()
+        self._decoded.clear()
+        self._stale.clear()
+
+    def update(self) -> Mapping[str, Sequence[Any]]:
+        """
+        Apply changes since the last update.
+
+        Return the merged view (see the torrents property).
         """
+        changes, cid = self.client.list_torrents_since(self.cid)
+        if self.cid is None:
+            self.reset()
+        for hash_, row in changes.items():
+            if row is False:
+                self._torrents.pop(hash_, None)
+                self._decoded.pop(hash_, None)
+                self._stale.discard(hash_)
+                continue
+            self._torrents[hash_] = cast(Sequence[Any], row)
+            self._stale.add(hash_)
+        self.client._log.debug('Torrent list cache: %d changes (cid %d -> %d)',
+                               len(changes), self.cid or 0, cid)
+        self.cid = cid
+        return self.torrents
+
+
+def _move_torrent_data(hash_: str, target_dir: str,
+                       fast_resume: bool) -> Dict[str, str]:
+    return {
+        'hash': hash_,
+        'datadir': target_dir,
+        'move_addpath': '1',
+        'move_datafiles': '1',
+        'move_fastresume': '1' if fast_resume else '0',
+    }
+
+
+def _raise_for_errors(json: Any) -> None:
+    if 'errors' in json and json['errors']:
+        raise UnexpectedruTorrentError(str(json['errors']))
+
+
+def _set_label_data(hashes: Sequence[str], label: str) -> bytes:
+    # The way to set a label to multiple torrents is to specify the hashes
+    # using hash=, then the v parameter as many times as there are hashes,
+    # and then the s=label for as many times as there are hashes.
+    #
+    # Example:
+    #    mode=setlabel&hash=...&hash=...&v=label&v=label&s=label&s=label
+    #
+    # This builds this string out since Requests can take in a byte string as
+    # POST data (and you cannot set a key twice in a dictionary).
+    data = b'mode=setlabel'
+    for hash_ in hashes:
+        data += '&hash={}'.format(hash_).encode()
+    data += '&v={}'.format(label).encode() * len(hashes)
+    data += b'&s=label' * len(hashes)
+    return data
+
+
+def _list_files_data(hash_: str) -> bytes:
+    cmds = (
+        quote('f.prioritize_first='),
+        quote('f.prioritize_last='),
+    )
+    query = 'mode=fls&hash={}'.format(hash_).encode()
+    query += b'&'
+    query += '&'.join(['cmd={}'.format(x) for x in cmds]).encode()
+    return query
+
+
+def _fix_file_row(x: List[Any]) -> List[Any]:
+    # Fix the numeric values which come as strings
+    x[1] = int(x[1])  # total number of pieces
+    x[2] = int(x[2])  # downloaded pieces
+    x[3] = int(x[3])  # size in bytes
+    x[4] = int(x[4])  # priority ID
+    x[5] = int(x[5])  # download strategy ID
+    x[6] = int(x[6])  # ??
+    return x
+
+
+def _delete_calls(hash_: str) -> Sequence[Tuple[str, Tuple[str, ...]]]:
+    return (
+        ('d.custom5.set', (hash_, '1')),
+        ('d.delete_tied', (hash_, )),
+        ('d.erase', (hash_, )),
+    )
+
+
+def _batches(items: Sequence[T], size: int) -> Iterator[Sequence[T]]:
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _first_fault(results: Iterable[Any]) -> Optional[xmlrpc.Fault]:
+    for x in results:
+        if isinstance(x, dict) and 'faultCode' in x:
+            return xmlrpc.Fault(x['faultCode'], x['faultString'])
+    return None
+
+
+def _raise_faults(results: Iterable[Any]) -> None:
+    for x in results:
+        try:
+            raise xmlrpc.Fault(
+                cast(Dict[str, Any], x)['faultCode'],
+                cast(Dict[str, Any], x)['faultString'])
+        except (TypeError, KeyError):
+            pass
+
+
+def _make_response(url: str, content: bytes, fn: str) -> requests.Response:
+    # Response for a cached torrent file, as if it was just downloaded
+    r = requests.Response()
+    r.status_code = 200
+    r.url = url
+    r.headers['content-disposition'] = f'attachment; filename="{fn}"'
+    r._content = content  # pylint: disable=protected-access
+    return r
+
+
+class _ruTorrentClientBase:
+    # Credentials and URIs shared by the blocking and asyncio clients
+    def __init__(self, host: str, name: Optional[str],
+                 password: Optional[str], netrc_path: Optional[str]):
         if not name and not password:
             if not netrc_path:
                 netrc_path = expanduser('~/.netrc')
@@ -75,20 +469,7 @@ class ruTorrentClient:
         self.name = name
         self.password = password
         self.host = host
-        retry = Retry(connect=max_retries,
-                      read=max_retries,
-                      redirect=False,
-                      backoff_factor=1)
         self._log = logging.getLogger(LOG_NAME)
-        self._http_adapter = HTTPAdapter(max_retries=retry)
-        self._session = requests.Session()
-        self._session.mount('http://', self._http_adapter)
-        self._session.mount('https://', self._http_adapter)
-
-        uri = 'https://{}:{}@{}/rtorrent/plugins/multirpc/action.php'.format(
-            self.name, self.password, self.host)
-        self._xmlrpc_proxy = xmlrpc.ServerProxy(
-            uri, context=ssl._create_unverified_context())
 
     @cached_property
     def http_prefix(self) -> str:
@@ -117,6 +498,126 @@ class ruTorrentClient:
             self.password,
         )
 
+    def _source_uri(self, hash_: str) -> str:
+        return (f'{self.http_prefix}/rtorrent/plugins/source/'
+                f'action.php?hash={hash_}')
+
+
+class _RequestsTransport(xmlrpc.Transport):
+    """
+    XML-RPC transport that posts with a client's requests session.
+
+    Calls share the session's keep-alive connection pool (and TLS sessions)
+    and its retry policy. Responses are fed to the expat parser as they
+    arrive instead of being read into memory first.
+    """
+    #: Size of the chunks fed to the parser.
+    chunk_size = 65536
+
+    def __init__(self, client: 'ruTorrentClient'):
+        """Construct a transport for a ruTorrentClient instance."""
+        super().__init__()
+        self.client = client
+
+    def request(self,
+                host: Any,
+                handler: str,
+                request_body: bytes,
+                verbose: bool = False) -> Tuple[Any, ...]:
+        """Send an XML-RPC request and return the unmarshalled response."""
+        r = self.client._session.post(
+            self.client.multirpc_action_uri,
+            data=request_body,
+            headers={'Content-Type': 'text/xml'},
+            auth=self.client.auth,
+            stream=True)
+        with r:
+            if r.status_code != 200:
+                raise xmlrpc.ProtocolError(self.client.multirpc_action_uri,
+                                           r.status_code, r.reason,
+                                           cast(Any, r.headers))
+            parser, unmarshaller = self.getparser()
+            for chunk in r.iter_content(chunk_size=self.chunk_size):
+                parser.feed(chunk)
+            parser.close()
+        return cast(Tuple[Any, ...], unmarshaller.close())
+
+
+class ruTorrentClient(_ruTorrentClientBase):
+    """
+    ruTorrent client class.
+
+    Reference on RPC returned fields: https://goo.gl/DvmW4c
+    """
+    def __init__(self,
+                 host: str,
+                 name: Optional[str] = None,
+                 password: Optional[str] = None,
+                 max_retries: int = 10,
+                 netrc_path: Optional[str] = None,
+                 torrent_cache: Optional[TorrentFileCache] = None,
+                 pool_size: int = 10,
+                 rate_limiter: Optional[RateLimiter] = None,
+                 metrics_hook: Optional[MetricsHook] = None):
+        """
+        Construct a ruTorrent client.
+
+        Host should be the hostname with no protocol.
+
+        If no name and no password are passed, ~/.netrc will be searched with
+        the host provided. The path can be overridden with the netrc_path
+        argument.
+
+        max_retries is used as an argument for urllib3's Retry() class.
+
+        If torrent_cache is passed, get_torrent() and get_torrents_futures()
+        read .torrent files from it and store what they download in it.
+
+        pool_size is the number of keep-alive connections kept per host. It
+        should be at least the concurrency passed to fetch_torrents().
+
+        If rate_limiter is passed, every HTTP request (including XML-RPC
+        calls) waits for it and reports its outcome to it.
+
+        If metrics_hook is passed, it is called with a RequestRecord after
+        every HTTP request. See xirvik.metrics.MetricsRegistry.
+        """
+        super().__init__(host, name, password, netrc_path)
+        self.torrent_cache = torrent_cache
+        retry = Retry(connect=max_retries,
+                      read=max_retries,
+                      redirect=False,
+                      backoff_factor=1)
+        self.rate_limiter = rate_limiter
+        self.metrics_hook = metrics_hook
+        self._http_adapter = HTTPAdapter(max_retries=retry,
+                                         pool_maxsize=pool_size)
+        adapter: BaseAdapter = self._http_adapter
+        if metrics_hook:
+            adapter = InstrumentedHTTPAdapter(adapter, metrics_hook)
+        if rate_limiter:
+            # Outside the metrics so waiting for the limiter is not counted as
+            # request latency
+            adapter = RateLimitedHTTPAdapter(adapter, rate_limiter)
+        self._session = requests.Session()
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+    @cached_property
+    def _xmlrpc_proxy(self) -> xmlrpc.ServerProxy:
+        return xmlrpc.ServerProxy(self.multirpc_action_uri,
+                                  transport=_RequestsTransport(self))
+
+    @cached_property
+    def torrent_list_cache(self) -> TorrentListCache:
+        """
+        Return a torrent list cache that belongs to this client.
+
+        set_label_to_hashes() polls it when retrying. Other methods, such as
+        list_torrents(), do not use it.
+        """
+        return TorrentListCache(self)
+
     def add_torrent(self, filepath: str, start_now: bool = True) -> None:
         """Add a torrent. Use start_now=False to start paused."""
         with open(filepath, 'rb') as f:
@@ -135,19 +636,52 @@ class ruTorrentClient:
         are lists similar to the columns in ruTorrent's main view.
 
         For a more detailed dictionary, use list_torrents_dict().
+
+        Every call downloads the whole list. To poll for changes, use the
+        torrent_list_cache property.
         """
-        r = self._session.post(self.multirpc_action_uri,
-                               data={
-                                   'mode': 'list',
-                                   'cmd': 'd.custom=addtime',
-                               },
-                               auth=self.auth)
-        r.raise_for_status()
-        ret = r.json()['t']
+        ret = self._list(None)['t']
         if isinstance(ret, list):
             raise ValueError('Unexpected type from API')
         return cast(Mapping[str, Sequence[Any]], ret)
 
+    def list_torrents_since(
+        self,
+        cid: Optional[int] = None
+    ) -> Tuple[Mapping[str, Union[Sequence[Any], bool]], int]:
+        """
+        List torrents that changed since a previous change ID (cid).
+
+        Return a tuple of the torrents and the new change ID. Without a cid,
+        all torrents are returned. With a cid, only added and changed torrents
+        are returned as rows and deleted torrents have the value False.
+
+        Use TorrentListCache (or the torrent_list_cache property) to keep a
+        merged view.
+        """
+        json = self._list(cid)
+        ret = json['t']
+        if isinstance(ret, list):
+            # PHP encodes an empty array (nothing changed) as a list
+            if ret:
+                raise ValueError('Unexpected type from API')
+            ret = {}
+        return cast(Mapping[str, Union[Sequence[Any], bool]],
+                    ret), int(json['cid'])
+
+    def _list(self, cid: Optional[int]) -> Dict[str, Any]:
+        data: Dict[str, Any] = {
+            'mode': 'list',
+            'cmd': 'd.custom=addtime',
+        }
+        if cid is not None:
+            data['cid'] = cid
+        r = self._session.post(self.multirpc_action_uri,
+                               data=data,
+                               auth=self.auth)
+        r.raise_for_status()
+        return cast(Dict[str, Any], r.json())
+
     def list_torrents_dict(self) -> Mapping[str, TorrentDict]:
         """
         Get all torrent information.
@@ -191,90 +725,92 @@ class ruTorrentClient:
         - is_private - boolean, if the torrent is private
         - is_multi_file - boolean, if the torrent contains multiple files
         """
-        fields = (
-            'is_open',
-            'is_hash_checking',
-            'is_hash_checked',
-            'state',
-            'name',
-            'size_bytes',
-            'completed_chunks',
-            'size_chunks',
-            'bytes_done',
-            'up_total',
-            'ratio',
-            'up_rate',
-            'down_rate',
-            'chunk_size',
-            'custom1',
-            'peers_accounted',
-            'peers_not_connected',
-            'peers_connected',
-            'peers_complete',
-            'left_bytes',
-            'priority',
-            'state_changed',
-            'skip_total',
-            'hashing',
-            'chunks_hashed',
-            'base_path',
-            'creation_date',
-            'tracker_focus',
-            'is_active',
-            'message',
-            'custom2',
-            'free_diskspace',
-            'is_private',
-            'is_multi_file',
-        )
-        ret: Dict[str, Dict[str, Any]] = {}
-        for hash_, torrent in self.list_torrents().items():
-            ret[hash_] = {}
-            value: Any
-            for i, value in enumerate(torrent):
-                try:
-                    if fields[i].startswith('is_') or fields[i] == 'hashing':
-                        value = True if value == '1' else False
-                    elif fields[i] == 'state_changed':
-                        value = datetime.fromtimestamp(float(value))
-                    elif fields[i] == 'creation_date':
-                        try:
-                            fvalue: Optional[float] = float(value)
-                        except ValueError:
-                            fvalue = None
-                        if fvalue:
-                            value = datetime.fromtimestamp(float(fvalue))
-                        else:
-                            value = None
-                    elif fields[i] == 'ratio':
-                        value = int(value) / 1000.0
-                    else:
-                        re1 = r'^[0-9]+(\.[0-9]+)?'
-                        re2 = r'^\.[0-9]+'
-                        if re.match(re1, value) or re.match(re2, value):
-                            cons = int if "." not in value else float
-                            try:
-                                value = cons(value)
-                            except ValueError:
-                                pass
-                    ret[hash_][fields[i]] = value
-                except IndexError:
-                    continue
-        return cast(Mapping[str, TorrentDict], ret)
+        return cast(Mapping[str, TorrentDict],
+                    _TORRENT_DECODER.decode(self.list_torrents()))
+
+    def query(self,
+              fields: Sequence[str],
+              view: str = 'main') -> Mapping[str, Dict[str, Any]]:
+        """
+        Get only some fields of every torrent in a view.
+
+        fields are names from TORRENT_FIELDS. This uses rTorrent's
+        d.multicall2 so only the requested columns are transferred.
+
+        Return a dictionary with the hash of the torrent as the key. The values
+        are dictionaries with the requested fields, typed as in
+        list_torrents_dict(). Faults are raised as xmlrpc.Fault exceptions.
+
+        Example use:
+            client.query(('name', 'base_path'), view='complete')
+        """
+        try:
+            commands = [_FIELD_COMMANDS[x] + '=' for x in fields]
+        except KeyError as e:
+            raise ValueError(f'Unknown field: {e.args[0]}') from e
+        decoders = tuple(_get_xmlrpc_decoder(x) for x in fields)
+        rows = self._xmlrpc_proxy.d.multicall2('', view, 'd.hash=', *commands)
+        return {
+            row[0]: {
+                name: decode(value)
+                for name, decode, value in zip(fields, decoders, row[1:])
+            }
+            for row in cast(Iterable[Sequence[Any]], rows)
+        }
 
     def get_torrent(self, hash_: str) -> Tuple[requests.Response, str]:
         """
         Prepare to get a torrent file given a hash.
 
         Return tuple Request object and the file name string.
+
+        With a torrent cache, cached files are returned without a request and
+        downloaded files are added to the cache.
         """
-        source_torrent_uri = (f'{self.http_prefix}/rtorrent/plugins/source/'
-                              f'action.php?hash={hash_}')
-        r = self._session.get(source_torrent_uri, auth=self.auth, stream=True)
+        cached = self._get_cached_torrent(hash_)
+        if cached:
+            return cached
+        r = self._session.get(self._source_uri(hash_),
+                              auth=self.auth,
+                              stream=True)
         r.raise_for_status()
         fn = parse_header(r.headers['content-disposition'])[1]['filename']
+        if self.torrent_cache is not None:
+            self._cache_torrent(hash_, r.content, fn)
         return r, fn
 
+    def _cache_torrent(self, hash_: str, content: bytes, fn: str) -> None:
+        # Entries are kept forever, so only cache the torrent asked for
+        assert self.torrent_cache is not None
+        try:
+            valid = info_hash_hex(parse_metainfo(content)) == hash_.upper()
+        except (KeyError, ValueError):
+            valid = False
+        if not valid:
+            self._log.warning('Not caching %s: not the torrent for this hash',
+                              hash_)
+            return
+        self.torrent_cache.put(hash_, content, fn)
+
+    def _get_cached_torrent(
+            self, hash_: str) -> Optional[Tuple[requests.Response, str]]:
+        if self.torrent_cache is None:
+            return None
+        cached = self.torrent_cache.get(hash_)
+        if not cached:
+            return None
+        content, fn = cached
+        return _make_response(self._source_uri(hash_), content, fn), fn
+
+    def _cache_torrent_future(self, hash_: str, future: 'Future[Any]') -> None:
+        if future.cancelled() or future.exception() or not self.torrent_cache:
+            return
+        r = future.result()
+        if r.status_code != 200 or 'content-disposition' not in r.headers:
+            return
+        fn = parse_header(r.headers['content-disposition'])[1]['filename']
+        self._cache_torrent(hash_, r.content, fn)
+
     def get_torrents_futures(
         self,
         hashes: Iterable[str],
@@ -286,14 +822,93 @@ class ruTorrentClient:
 
         Pass a list of hashes, optionally a session and a callback.
 
-        Yields the GET future request for each hash.
+        Yields the GET future request for each hash. With a torrent cache,
+        cached files are yielded as futures that are already done.
         """
         if not session:
             session = FuturesSession(max_workers=4)
         for hash_ in hashes:
-            yield session.get((f'{self.http_prefix}/rtorrent/plugins/source/'
-                               f'action.php?hash={hash_}'),
-                              background_callback=background_callback)
+            cached = self._get_cached_torrent(hash_)
+            if cached:
+                future: 'Future[Any]' = Future()
+                if background_callback:
+                    background_callback(session, cached[0])
+                future.set_result(cached[0])
+                yield cast(FuturesSession, future)
+                continue
+            future = session.get(self._source_uri(hash_),
+                                 auth=self.auth,
+                                 background_callback=background_callback)
+            if self.torrent_cache is not None:
+                future.add_done_callback(
+                    partial(self._cache_torrent_future, hash_))
+            yield cast(FuturesSession, future)
+
+    def _fetch_torrent(self, hash_: str, max_attempts: int,
+                       backoff_factor: float) -> Any:
+        for attempt in range(1, max_attempts + 1):
+            try:
+                r, _ = self.get_torrent(hash_)
+                return parse_metainfo(r.content)
+            except requests.HTTPError as e:
+                if (attempt == max_attempts or e.response is None
+                        or e.response.status_code not in RETRY_STATUS_CODES):
+                    raise
+                self._log.debug('Retrying %s after HTTP %d', hash_,
+                                e.response.status_code)
+            time.sleep(backoff_factor * 2**(attempt - 1))
+        raise ValueError('max_attempts must be at least 1')
+
+    def fetch_torrents(
+            self,
+            hashes: Iterable[str],
+            concurrency: int = 8,
+            max_attempts: int = 3,
+            backoff_factor: float = 1.0) -> Iterator[Tuple[str, Any]]:
+        """
+        Download and parse many torrent files.
+
+        Yields tuples of hash and parsed metainfo (a Metainfo) in the order
+        downloads finish. If a torrent cannot be fetched or parsed, the
+        exception is yielded in place of the metainfo.
+
+        At most concurrency requests are in flight at once, sharing the
+        client's authenticated session. Requests failing with a status in
+        RETRY_STATUS_CODES are attempted up to max_attempts times, sleeping
+        backoff_factor * 2 ** (attempt - 1) seconds between attempts.
+        Connection and read errors are retried by the session itself.
+
+        Hashes are consumed lazily, so only a few more than concurrency
+        results are held in memory at any time.
+        """
+        it = iter(hashes)
+        pending: Dict['Future[Any]', str] = {}
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+
+            def submit(n: int) -> None:
+                for hash_ in islice(it, n):
+                    pending[executor.submit(self._fetch_torrent, hash_,
+                                            max_attempts,
+                                            backoff_factor)] = hash_
+
+            submit(concurrency * 2)
+            try:
+                while pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        hash_ = pending.pop(future)
+                        try:
+                            result = future.result()
+                        except Exception as e:
+                            self._log.error('Fetching %s failed: %s', hash_,
+                                            e)
+                            result = e
+                        yield hash_, result
+                    submit(len(done))
+            finally:
+                # Do not wait for downloads nobody will read
+                for future in pending:
+                    future.cancel()
 
     def move_torrent(self,
                      hash_: str,
@@ -305,19 +920,11 @@ class ruTorrentClient:
         target_dir must be a valid and usable directory.
         """
         r = self._session.post(self.datadir_action_uri,
-                               data={
-                                   'hash': hash_,
-                                   'datadir': target_dir,
-                                   'move_addpath': '1',
-                                   'move_datafiles': '1',
-                                   'move_fastresume':
-                                   '1' if fast_resume else '0',
-                               },
+                               data=_move_torrent_data(
+                                   hash_, target_dir, fast_resume),
                                auth=self.auth)
         r.raise_for_status()
-        json = r.json()
-        if 'errors' in json and json['errors']:
-            raise UnexpectedruTorrentError(str(json['errors']))
+        _raise_for_errors(r.json())
 
     def set_label_to_hashes(self, **kwargs: Any) -> None:
         """
@@ -329,15 +936,6 @@ class ruTorrentClient:
         Example use:
             client.set_labels(hashes=[hash_1, hash_2], label='my new label')
         """
-        # The way to set a label to multiple torrents is to specify the hashes
-        # using hash=, then the v parameter as many times as there are hashes,
-        # and then the s=label for as many times as there are hashes.
-        #
-        # Example:
-        #    mode=setlabel&hash=...&hash=...&v=label&v=label&s=label&s=label
-        #
-        # This method builds this string out since Requests can take in a byte
-        # string as POST data (and you cannot set a key twice in a dictionary).
         hashes = kwargs.pop('hashes', [])
         label = kwargs.pop('label', None)
         allow_recursive_fix = kwargs.pop('allow_recursive_fix', True)
@@ -346,11 +944,7 @@ class ruTorrentClient:
         if not hashes or not label:
             raise TypeError('"hashes" (list) and "label" (str) keyword '
                             'arguments are required')
-        data = b'mode=setlabel'
-        for hash_ in hashes:
-            data += '&hash={}'.format(hash_).encode()
-        data += '&v={}'.format(label).encode() * len(hashes)
-        data += b'&s=label' * len(hashes)
+        data = _set_label_data(hashes, label)
         self._log.debug('set_labels() with data: %s', data.decode('utf-8'))
         r = self._session.post(self.multirpc_action_uri,
                                data=data,
@@ -369,12 +963,10 @@ class ruTorrentClient:
                                '(%d out of %d)', recursion_attempt,
                                recursion_limit)
 
-                data = b'mode=setlabel'
                 new_hashes = []
-                for hash_, v in self.list_torrents().items():
+                for hash_, v in self.torrent_list_cache.update().items():
                     if hash_ not in hashes or v[TORRENT_LABEL_INDEX].strip():
                         continue
-                    data += '&hash={}'.format(hash_).encode()
                     new_hashes.append(hash_)
                 if not new_hashes:
                     self._log.debug('Found no torrents to correct')
@@ -406,27 +998,12 @@ class ruTorrentClient:
         for info in list_files():
             for name, pieces, pieces_dl, size, dlstrat, _ in info:
         """
-        cmds: Union[str, Tuple[str, ...]] = (
-            quote('f.prioritize_first='),
-            quote('f.prioritize_last='),
-        )
-        query = 'mode=fls&hash={}'.format(hash_).encode()
-        cmds = '&'.join(['cmd={}'.format(x) for x in cmds])
-        query += b'&'
-        query += cmds.encode()
         r = self._session.post(self.multirpc_action_uri,
-                               data=query,
+                               data=_list_files_data(hash_),
                                auth=self.auth)
         r.raise_for_status()
         for x in r.json():
-            # Fix the numeric values which come as strings
-            x[1] = int(x[1])  # total number of pieces
-            x[2] = int(x[2])  # downloaded pieces
-            x[3] = int(x[3])  # size in bytes
-            x[4] = int(x[4])  # priority ID
-            x[5] = int(x[5])  # download strategy ID
-            x[6] = int(x[6])  # ??
-            yield x
+            yield _fix_file_row(x)
 
     def delete(self, hash_: str) -> None:
         """
@@ -436,16 +1013,9 @@ class ruTorrentClient:
         Returns if successful. Faults are converted to xmlrpc.Fault exceptions.
         """
         mc = xmlrpc.MultiCall(self._xmlrpc_proxy)
-        getattr(mc, 'd.custom5.set')(hash_, '1')
-        getattr(mc, 'd.delete_tied')(hash_)
-        getattr(mc, 'd.erase')(hash_)
-        for x in mc().results:
-            try:
-                raise xmlrpc.Fault(
-                    cast(Dict[str, Any], x)['faultCode'],
-                    cast(Dict[str, Any], x)['faultString'])
-            except (TypeError, KeyError):
-                pass
+        for method, params in _delete_calls(hash_):
+            getattr(mc, method)(*params)
+        _raise_faults(mc().results)
 
     def remove(self, hash_: str) -> None:
         """
@@ -468,6 +1038,94 @@ class ruTorrentClient:
                            data=dict(mode='stop', hash=hash_),
                            auth=self.auth).raise_for_status()
 
+    def _post_many(self, mode: str, hashes: Sequence[str],
+                   batch_size: int) -> BulkResults:
+        ret: BulkResults = {}
+        for batch in _batches(hashes, batch_size):
+            error: Optional[Exception] = None
+            try:
+                self._session.post(self.multirpc_action_uri,
+                                   data=[('mode', mode)] +
+                                   [('hash', x) for x in batch],
+                                   auth=self.auth).raise_for_status()
+            except requests.RequestException as e:
+                self._log.error('%s failed for %d torrents: %s', mode,
+                                len(batch), e)
+                error = e
+            ret.update(dict.fromkeys(batch, error))
+        return ret
+
+    def stop_many(self,
+                  hashes: Sequence[str],
+                  batch_size: int = BULK_BATCH_SIZE) -> BulkResults:
+        """
+        Stop many torrents with one request per batch_size hashes.
+
+        Return a dictionary of hash to None on success or the exception raised
+        for the request containing that hash.
+        """
+        return self._post_many('stop', hashes, batch_size)
+
+    def remove_many(self,
+                    hashes: Sequence[str],
+                    batch_size: int = BULK_BATCH_SIZE) -> BulkResults:
+        """
+        Remove many torrents but keep their data. See stop_many() for the
+        return value.
+        """
+        return self._post_many('remove', hashes, batch_size)
+
+    def move_many(self,
+                  hashes: Sequence[str],
+                  target_dir: str,
+                  fast_resume: bool = True) -> BulkResults:
+        """
+        Move many torrents' files to target_dir. See stop_many() for the return
+        value.
+
+        The datadir plugin only accepts one hash per request, so this makes one
+        request per torrent over the client's keep-alive session.
+        """
+        ret: BulkResults = {}
+        for hash_ in hashes:
+            try:
+                self.move_torrent(hash_, target_dir, fast_resume)
+            except (requests.RequestException,
+                    UnexpectedruTorrentError) as e:
+                self._log.error('Moving %s failed: %s', hash_, e)
+                ret[hash_] = e
+            else:
+                ret[hash_] = None
+        return ret
+
+    def delete_many(self,
+                    hashes: Sequence[str],
+                    batch_size: int = BULK_BATCH_SIZE) -> BulkResults:
+        """
+        Delete many torrents and their files with one XML-RPC
+        system.multicall per batch_size hashes.
+
+        See stop_many() for the return value. Faults are returned as
+        xmlrpc.Fault instances.
+        """
+        ret: BulkResults = {}
+        for batch in _batches(hashes, batch_size):
+            mc = xmlrpc.MultiCall(self._xmlrpc_proxy)
+            calls = [_delete_calls(hash_) for hash_ in batch]
+            for method, params in chain.from_iterable(calls):
+                getattr(mc, method)(*params)
+            try:
+                results = iter(mc().results)
+            except (xmlrpc.Error, OSError) as e:
+                self._log.error('delete failed for %d torrents: %s',
+                                len(batch), e)
+                ret.update(dict.fromkeys(batch, e))
+                continue
+            for hash_, hash_calls in zip(batch, calls):
+                ret[hash_] = _first_fault(
+                    list(islice(results, len(hash_calls))))
+        return ret
+
     def add_torrent_url(self, url: str) -> None:
         """Add a torrent via a publicly accessible URI."""
         self._session.post(self._add_torrent_uri,
@@ -5,18 +5,19 @@ Deletes old torrents based on specified criteria.
 """
 from datetime import datetime, timedelta
 from time import sleep
-from typing import Callable, Dict, Optional, Tuple
+from typing import Callable, Dict, List, Optional, Tuple
 import logging
 import sys
-import xmlrpc.client as xmlrpc
 
 from requests.exceptions import HTTPError
 import argcomplete
 
 from xirvik.typing import TorrentDict
 
-from ..client import ruTorrentClient
-from .util import common_parser, setup_logging_stdout
+from ..client import BULK_BATCH_SIZE, ruTorrentClient
+from .util import (add_sleep_time_argument, common_parser, metrics_from_args,
+                   rate_limiter_from_args, setup_logging_stdout,
+                   warn_sleep_time)
 
 TestCallable = Callable[[TorrentDict, logging.Logger], Tuple[str, bool]]
 TestsDict = Dict[str, Tuple[bool, TestCallable]]
@@ -57,16 +58,20 @@ def main() -> int:
     parser.add_argument('-y', '--dry-run', action='store_true')
     parser.add_argument('--max-attempts', type=int, default=3)
     parser.add_argument('--label')
-    parser.add_argument('--sleep-time', type=int, default=10)
+    add_sleep_time_argument(parser)
+    parser.add_argument('--batch-size', type=int, default=BULK_BATCH_SIZE)
     parser.add_argument('--days', type=int, default=14)
     argcomplete.autocomplete(parser)
     args = parser.parse_args()
     log = setup_logging_stdout(verbose=args.verbose)
+    warn_sleep_time(args, log)
     client = ruTorrentClient(args.host[0],
                              name=args.username,
                              password=args.password,
                              max_retries=args.max_retries,
-                             netrc_path=args.netrc)
+                             netrc_path=args.netrc,
+                             rate_limiter=rate_limiter_from_args(args),
+                             metrics_hook=metrics_from_args(args, log))
     try:
         torrents = client.list_torrents_dict().items()
     except HTTPError:
@@ -77,6 +82,7 @@ def main() -> int:
         date=(args.ignore_date, _test_date_cb(args.days)),
     )
     info: TorrentDict
+    to_delete: List[str] = []
     for hash_, info in torrents:
         if info['left_bytes'] != 0 or info['custom1'] != args.label:
             continue
@@ -98,18 +104,19 @@ def main() -> int:
             continue
         else:
             log.info('Deleting %s, reason: %s', info['name'], reason)
+        to_delete.append(hash_)
+    for i in range(0, len(to_delete), args.batch_size):
+        pending = to_delete[i:i + args.batch_size]
         attempts = 0
-        while attempts < args.max_attempts:
+        while pending and attempts < args.max_attempts:
             attempts += 1
-            try:
-                client.delete(hash_)
-            except xmlrpc.Fault as e:
-                log.exception(e)
+            results = client.delete_many(pending, batch_size=args.batch_size)
+            pending = [x for x, e in results.items() if e is not None]
+            for hash_ in pending:
+                log.error('Failed to delete %s: %s', hash_, results[hash_])
+            if pending:
                 sleep_time = args.backoff_factor * (2**(attempts - 1))
                 sleep(sleep_time)
-            else:
-                sleep(args.sleep_time)
-                break
     return 0
 
 
@@ -1,19 +1,21 @@
 #!/usr/bin/env python
 # PYTHON_ARGCOMPLETE_OK
 """Organise torrents based on labels assigned in ruTorrent."""
-from time import sleep
-from typing import Any, Callable, Tuple
+from typing import Any, Callable, Tuple, cast
 import sys
+import xmlrpc.client as xmlrpc
 
-from requests.exceptions import HTTPError
 import argcomplete
 
 from xirvik.typing import TorrentDict
 
 from ..client import ruTorrentClient
-from .util import common_parser, setup_logging_stdout
+from .util import (add_sleep_time_argument, common_parser, metrics_from_args,
+                   rate_limiter_from_args, setup_logging_stdout,
+                   warn_sleep_time)
 
 PREFIX = '/torrents/{}/_completed'
+FIELDS = ('name', 'custom1', 'base_path', 'left_bytes', 'is_hash_checking')
 
 
 def _base_path_check(
@@ -40,13 +42,7 @@ def main() -> int:
         '--completed-dir',
         default='_completed',
         help='Top directory where moved torrent data will be placed')
-    parser.add_argument(
-        '-t',
-        '--sleep-time',
-        default=10,
-        type=int,
-        help=('Time to sleep in seconds at certain times during this batch '
-              'of requests'))
+    add_sleep_time_argument(parser, '-t', '--sleep-time')
     parser.add_argument(
         '-l',
         '--lower-label',
@@ -60,18 +56,21 @@ def main() -> int:
     args = parser.parse_args()
     log = setup_logging_stdout(verbose=args.verbose)
     assert log is not None
+    warn_sleep_time(args, log)
     client = ruTorrentClient(args.host[0],
                              name=args.username,
                              password=args.password,
                              max_retries=args.max_retries,
-                             netrc_path=args.netrc)
+                             netrc_path=args.netrc,
+                             rate_limiter=rate_limiter_from_args(args),
+                             metrics_hook=metrics_from_args(args, log))
     username = client.name
     try:
-        torrents = list(client.list_torrents_dict().items())
-    except (ValueError, HTTPError):
-        log.error('Connection failed on list_torrents() call')
+        torrents = [(hash_, cast(TorrentDict, info))
+                    for hash_, info in client.query(FIELDS).items()]
+    except (OSError, xmlrpc.Error):
+        log.error('Connection failed on query() call')
         return 1
-    count = 0
     assert username is not None
     hash_: str
     info: TorrentDict
@@ -85,9 +84,6 @@ def main() -> int:
         move_to = '{}/{}'.format(PREFIX.format(username), label)
         log.info('Moving %s to %s/', info['name'], move_to)
         client.move_torrent(hash_, move_to)
-        count += 1
-        if count > 0 and (count % 10) == 0:
-            sleep(args.sleep_time)
     return 0
 
 
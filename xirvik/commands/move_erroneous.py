@@ -1,14 +1,16 @@
 """Move torrents in error state to another location."""
-from time import sleep
-from typing import Iterable, List, Tuple, TypeVar
+from typing import Dict, Iterable, List, Set, TypeVar
+import logging
 import sys
 
 from typing_extensions import Final
 import argcomplete
 
-from ..client import ruTorrentClient
+from ..client import BulkResults, ruTorrentClient
 from ..typing import TorrentDict
-from .util import common_parser, setup_logging_stdout
+from .util import (add_sleep_time_argument, common_parser, metrics_from_args,
+                   rate_limiter_from_args, setup_logging_stdout,
+                   warn_sleep_time)
 
 __all__ = ("main", )
 
@@ -37,49 +39,61 @@ def _make_move_to(prefix: str, label: str) -> str:
     return '{}/{}'.format(prefix, label)
 
 
+def _log_failures(log: logging.Logger, action: str,
+                  results: BulkResults) -> Set[str]:
+    failed: Set[str] = set()
+    for hash_, error in results.items():
+        if error is not None:
+            log.error('Failed to %s %s: %s', action, hash_, error)
+            failed.add(hash_)
+    return failed
+
+
 def main() -> int:
     """Move torrents in error state to another location."""
     parser: Final = common_parser()
     parser.add_argument('-a', '--ignore-ratio', action='store_true')
-    parser.add_argument('-t', '--sleep-time', default=10, type=int)
+    add_sleep_time_argument(parser, '-t', '--sleep-time')
     argcomplete.autocomplete(parser)
     args: Final = parser.parse_args()
     log: Final = setup_logging_stdout(verbose=args.verbose)
+    warn_sleep_time(args, log)
     client: Final = ruTorrentClient(args.host[0],
                                     name=args.username,
                                     password=args.password,
                                     max_retries=args.max_retries,
-                                    netrc_path=args.netrc)
+                                    netrc_path=args.netrc,
+                                    rate_limiter=rate_limiter_from_args(args),
+                                    metrics_hook=metrics_from_args(args, log))
     prefix: Final = PREFIX.format(client.name)
-    to_delete: List[Tuple[str, str]] = []
     items: Final = [(hash_, info)
                     for hash_, info in client.list_torrents_dict().items()
                     if _should_process(info)]
-    count = 0
-    for hash_, info in items:
+    if not items:
+        return 0
+    hashes: Final = [hash_ for hash_, _ in items]
+    for _, info in items:
         log.info('Stopping %s', info['name'])
-        client.stop(hash_)
-        count += 1
-        if count > 0 and (count % 10) == 0:
-            sleep(args.sleep_time)
-    count = 0
+    _log_failures(log, 'stop', client.stop_many(hashes))
+    by_target: Dict[str, List[str]] = {}
     for hash_, info in items:
         move_to = _make_move_to(prefix, info['custom1'].lower())
-        to_delete.append((hash_, info['name']))
         log.info('Moving %s to %s/', info['name'], move_to)
-        client.move_torrent(hash_, move_to)
-        client.stop(hash_)
-        count += 1
-        if count > 0 and (count % 10) == 0:
-            sleep(args.sleep_time)
-    count = 0
-    for hash_, name in to_delete:
-        log.info('Removing torrent "%s" (without deleting data)', name)
-        client.remove(hash_)
-        count += 1
-        if count > 0 and (count % 10) == 0:
-            sleep(args.sleep_time)
-    return 0
+        by_target.setdefault(move_to, []).append(hash_)
+    not_moved: Set[str] = set()
+    for move_to, target_hashes in by_target.items():
+        not_moved |= _log_failures(log, 'move',
+                                   client.move_many(target_hashes, move_to))
+    # Torrents that failed to move are left in place
+    moved: Final = [(hash_, info) for hash_, info in items
+                    if hash_ not in not_moved]
+    moved_hashes: Final = [hash_ for hash_, _ in moved]
+    _log_failures(log, 'stop', client.stop_many(moved_hashes))
+    for _, info in moved:
+        log.info('Removing torrent "%s" (without deleting data)',
+                 info['name'])
+    _log_failures(log, 'remove', client.remove_many(moved_hashes))
+    return 1 if not_moved else 0
 
 
 if __name__ == '__main__':
@@ -4,9 +4,10 @@ from logging.handlers import SysLogHandler
 from netrc import netrc
 from os import chmod, close as close_fd, listdir, makedirs, remove as rm, utime
 from os.path import (basename, dirname, expanduser, isdir, join as path_join,
-                     realpath, splitext)
+                     normpath, realpath, relpath, splitext)
+from stat import S_ISREG
 from tempfile import gettempdir, mkstemp
-from typing import Optional, cast
+from typing import Any, Callable, Dict, Optional, Tuple, cast
 import argparse
 import hashlib
 import json
@@ -16,6 +17,7 @@ import signal
 import socket
 import subprocess as sp
 import sys
+import xmlrpc.client as xmlrpc
 
 from lockfile import LockFile, NotLocked
 from paramiko import SFTPClient as OriginalSFTPClient
@@ -24,22 +26,64 @@ from unidecode import unidecode
 import argcomplete
 import requests
 
-from xirvik.client import (TORRENT_PATH_INDEX, UnexpectedruTorrentError,
-                           ruTorrentClient)
+from xirvik.cache import (DEFAULT_REMOTE_MANIFEST_PATH,
+                          DEFAULT_TORRENT_CACHE_DIR,
+                          DEFAULT_VERIFIED_STATE_PATH, RemoteManifest,
+                          TorrentFileCache, VerifiedStateStore)
+from xirvik.client import UnexpectedruTorrentError, ruTorrentClient
+from xirvik.commands.util import add_metrics_arguments, metrics_from_args
 from xirvik.log import get_logger
 from xirvik.sftp import SFTPClient
-from xirvik.util import (ReadableDirectoryListAction, VerificationError,
-                         cleanup_and_exit, ctrl_c_handler,
-                         verify_torrent_contents)
+from xirvik.typing import WriteHook
+from xirvik.util import (ReadableDirectoryListAction, StreamingVerifier,
+                         TorrentIndex, VerificationError, cleanup_and_exit,
+                         ctrl_c_handler, verify_torrent_contents)
 
 
 # pylint: disable=protected-access
+def _download(rclient: ruTorrentClient,
+              uri: str,
+              dest: str,
+              on_write: Optional[WriteHook] = None) -> None:
+    log = logging.getLogger('xirvik')
+    session = rclient._session
+    uri = uri.replace('#', '%23')
+    log.info('Downloading %s -> %s', uri, dest)
+    r = session.get(uri, stream=True)
+    r.raise_for_status()
+    try:
+        total: Optional[int] = int(
+            cast(str, r.headers.get('content-length')))
+        log.info('Content-Length: %d', total)
+    except (KeyError, ValueError):
+        total = None
+    with open(dest, 'wb+') as f:
+        downloaded = 0
+        for chunk in r.iter_content(chunk_size=4096):
+            f.write(chunk)
+            if on_write:
+                on_write(dest, downloaded, chunk)
+            downloaded += len(chunk)
+            done = int(50 * downloaded / cast(int, total))
+            percent = (float(downloaded) / float(cast(int, total))) * 100
+            args = (
+                '=' * done,
+                ' ' * (50 - done),
+                percent,
+            )
+            sys.stdout.write('\r[{}{}] {:.2f}%'.format(*args))
+            sys.stdout.flush()
+    sys.stdout.write('\n')
+
+
 def mirror(sftp_client: SFTPClient,
            rclient: ruTorrentClient,
            path: str = '.',
            destroot: str = '.',
            keep_modes: bool = True,
-           keep_times: bool = True) -> None:
+           keep_times: bool = True,
+           on_write: Optional[WriteHook] = None,
+           manifest: Optional[RemoteManifest] = None) -> None:
     """
     Mirror a remote directory to local.
 
@@ -52,11 +96,16 @@ def mirror(sftp_client: SFTPClient,
 
     `keep_modes` and `keep_times` are boolean to ensure permissions and time
     are retained respectively.
+
+    `on_write` is called with every block written.
+
+    `manifest` is used to list only the remote directories that changed.
     """
     cwd = cast(OriginalSFTPClient, sftp_client).getcwd()
     log = logging.getLogger('xirvik')
-    for _path, info in sftp_client.listdir_attr_recurse(path=path):
-        if info.st_mode & 0o700 == 0o700:
+    for _path, info in sftp_client.listdir_attr_recurse(path=path,
+                                                        manifest=manifest):
+        if info.st_mode is not None and not S_ISREG(info.st_mode):
             continue
         dest_path = path_join(destroot, dirname(_path))
         dest = path_join(dest_path, basename(_path))
@@ -65,7 +114,7 @@ def mirror(sftp_client: SFTPClient,
                 makedirs(dest_path)
             except OSError:
                 pass
-            sftp_client._dircache.append(dest_path)
+            sftp_client._dircache.add(dest_path)
         if isdir(dest):
             continue
         try:
@@ -73,35 +122,11 @@ def mirror(sftp_client: SFTPClient,
         except OSError:
             current_size = None
         if current_size is None or current_size != info.st_size:
-            session = rclient._session
-            uri = '{}/downloads{}{}'.format(rclient.http_prefix, cwd,
-                                            _path[1:])
-            uri = uri.replace('#', '%23')
-            log.info('Downloading %s -> %s', uri, dest)
-            r = session.get(uri, stream=True)
-            r.raise_for_status()
-            try:
-                total: Optional[int] = int(
-                    cast(str, r.headers.get('content-length')))
-                log.info('Content-Length: %d', total)
-            except (KeyError, ValueError):
-                total = None
-            with open(dest, 'wb+') as f:
-                downloaded = 0
-                for chunk in r.iter_content(chunk_size=4096):
-                    f.write(chunk)
-                    downloaded += len(chunk)
-                    done = int(50 * downloaded / cast(int, total))
-                    percent = (float(downloaded) /
-                               float(cast(int, total))) * 100
-                    args = (
-                        '=' * done,
-                        ' ' * (50 - done),
-                        percent,
-                    )
-                    sys.stdout.write('\r[{}{}] {:.2f}%'.format(*args))
-                    sys.stdout.flush()
-            sys.stdout.write('\n')
+            _download(rclient,
+                      '{}/downloads{}{}'.format(rclient.http_prefix, cwd,
+                                                _path[1:]),
+                      dest,
+                      on_write=on_write)
         else:
             log.info('Skipping already downloaded file %s', dest)
 
@@ -118,6 +143,16 @@ def mirror(sftp_client: SFTPClient,
             pass
 
 
+def _piece_logger(log: logging.Logger,
+                  name: str) -> Callable[[int, bool], Any]:
+    def on_piece(index: int, ok: bool) -> None:
+        if not ok:
+            log.warning('Piece %d of "%s" does not match its hash', index,
+                        name)
+
+    return on_piece
+
+
 def mirror_main() -> None:
     """Entry point."""
     signal.signal(signal.SIGINT, ctrl_c_handler)
@@ -137,6 +172,39 @@ def mirror_main() -> None:
     parser.add_argument('--no-preserve-permissions', action='store_false')
     parser.add_argument('--no-preserve-times', action='store_false')
     parser.add_argument('--max-retries', type=int, default=10)
+    parser.add_argument('--torrent-cache-dir',
+                        default=DEFAULT_TORRENT_CACHE_DIR,
+                        help='Directory to cache .torrent files in')
+    parser.add_argument('--no-torrent-cache',
+                        action='store_true',
+                        help='Always download .torrent files')
+    parser.add_argument('--fetch-concurrency',
+                        type=int,
+                        default=8,
+                        help='Number of .torrent files to download at once')
+    parser.add_argument('--verify-workers',
+                        type=int,
+                        default=os.cpu_count() or 1,
+                        help='Number of threads used to hash pieces')
+    parser.add_argument(
+        '--verified-state',
+        default=DEFAULT_VERIFIED_STATE_PATH,
+        help=('Database of verified torrents. Torrents whose files have not '
+              'changed since they were verified are not hashed again'))
+    parser.add_argument('--no-verified-state',
+                        action='store_true',
+                        help='Always hash every torrent')
+    parser.add_argument(
+        '--manifest',
+        metavar='PATH',
+        help=('Database of the remote tree (for example '
+              f'{DEFAULT_REMOTE_MANIFEST_PATH}). Remote directories whose '
+              'modification time has not changed are not listed again'))
+    parser.add_argument(
+        '--verify-checkpoint-dir',
+        help=('Directory to save verification progress in, so later runs '
+              'only hash pieces of changed files'))
+    add_metrics_arguments(parser)
     parser.add_argument('remote_dir', metavar='REMOTEDIR', nargs=1)
     parser.add_argument('local_dir', metavar='LOCALDIR', nargs=1)
     argcomplete.autocomplete(parser)
@@ -156,6 +224,11 @@ def mirror_main() -> None:
             channel.setFormatter(formatter)
             _log.addHandler(channel)
     local_dir: str = realpath(args.local_dir[0])
+    if args.verify_checkpoint_dir:
+        makedirs(args.verify_checkpoint_dir, exist_ok=True)
+    state_store = (None if args.no_verified_state else VerifiedStateStore(
+        args.verified_state))
+    manifest = RemoteManifest(args.manifest) if args.manifest else None
     user_pass = netrc(args.netrc_path).authenticators(args.host)
     assert user_pass is not None
     user, _, password = user_pass
@@ -182,10 +255,15 @@ def mirror_main() -> None:
     log.debug('Local directory to sync to: %s', local_dir)
     log.debug('Read user and password from netrc file')
     log.debug('SFTP URI: %s', sftp_host)
-    client = ruTorrentClient(args.host,
-                             user,
-                             password,
-                             max_retries=args.max_retries)
+    client = ruTorrentClient(
+        args.host,
+        user,
+        password,
+        max_retries=args.max_retries,
+        pool_size=max(10, args.fetch_concurrency),
+        metrics_hook=metrics_from_args(args, log),
+        torrent_cache=(None if args.no_torrent_cache else TorrentFileCache(
+            args.torrent_cache_dir)))
     assumed_path_prefix = '/torrents/{}'.format(user)
     look_for = '{}/{}/'.format(assumed_path_prefix, args.remote_dir[0])
     move_to = '{}/{}'.format(assumed_path_prefix, args.move_to)
@@ -194,8 +272,8 @@ def mirror_main() -> None:
     log.debug('Moving finished torrents to: %s', move_to)
     log.info('Getting current torrent information (ruTorrent)')
     try:
-        torrents = client.list_torrents()
-    except requests.exceptions.ConnectionError as e:
+        torrents = client.query(('base_path', ))
+    except (OSError, xmlrpc.Error) as e:
         # Assume no Internet connection at this point
         log.error('Failed to connect: %s', e)
         try:
@@ -205,18 +283,46 @@ def mirror_main() -> None:
         cleanup_and_exit(1)
     hash_ = None
     for hash_, v in torrents.items():
-        if not v[TORRENT_PATH_INDEX].startswith(look_for):
+        if not v['base_path'].startswith(look_for):
             continue
-        bn = basename(v[TORRENT_PATH_INDEX])
+        bn = basename(v['base_path'])
         names[bn] = (
             hash_,
-            v[TORRENT_PATH_INDEX],
+            v['base_path'],
         )
         log.info(
             'Completed torrent "%s" found with hash %s',
             bn,
             hash_,
         )
+    bn_by_hash = {hash_: bn for bn, (hash_, unused_) in names.items()}
+    # There is a warning that can get raised here by urllib3 if
+    # Content-Disposition header's filename field has any non-ASCII
+    # characters. It is ignorable as the content still gets downloaded
+    # correctly
+    metainfos = dict(
+        client.fetch_torrents(bn_by_hash,
+                              concurrency=args.fetch_concurrency))
+    # Pieces are hashed as they are downloaded, so only files that were
+    # already there have to be read again
+    verifiers: Dict[str, StreamingVerifier] = {}
+    files_by_path: Dict[str, Tuple[StreamingVerifier, int]] = {}
+    for hash_, metainfo in metainfos.items():
+        if isinstance(metainfo, Exception):
+            continue
+        verifier = verifiers[hash_] = StreamingVerifier(
+            TorrentIndex(metainfo[b'info'], local_dir),
+            on_piece=_piece_logger(log, bn_by_hash[hash_]))
+        for i, (path, unused_) in enumerate(verifier.index.files):
+            files_by_path[normpath(path)] = (verifier, i)
+
+    def on_write(path: str, offset: int, data: bytes) -> None:
+        try:
+            verifier, i = files_by_path[normpath(path)]
+        except KeyError:
+            return
+        verifier.feed(i, offset, data)
+
     sftp_client_args = dict(
         hostname=args.host,
         username=user,
@@ -228,6 +334,7 @@ def mirror_main() -> None:
             log.info('Verifying contents of %s with previous '
                      'response', look_for)
             assert sftp_client.chdir(args.remote_dir[0]) is not None
+            remote_cwd = cast(OriginalSFTPClient, sftp_client).getcwd()
             for item in sftp_client.listdir_iter(read_aheads=10):
                 if item.filename not in names:
                     log.error(
@@ -244,7 +351,9 @@ def mirror_main() -> None:
                    client,
                    destroot=local_dir,
                    keep_modes=not args.no_preserve_permissions,
-                   keep_times=not args.no_preserve_times)
+                   keep_times=not args.no_preserve_times,
+                   on_write=on_write,
+                   manifest=manifest)
     except (AssertionError, IndexError) as e:
         if args.debug:
             _lock.release()
@@ -256,16 +365,53 @@ def mirror_main() -> None:
     _all = names.items()
     exit_status = 0
     bad = []
-    for bn, (hash_, unused_) in _all:
-        # There is a warning that can get raised here by urllib3 if
-        # Content-Disposition header's filename field has any
-        # non-ASCII characters. It is ignorable as the content still gets
-        # downloaded correctly
+    for hash_, metainfo in metainfos.items():
+        bn = bn_by_hash[hash_]
         log.info('Verifying "%s"', bn)
-        r, _ = client.get_torrent(hash_)
+        checkpoint = (path_join(args.verify_checkpoint_dir, f'{hash_}.json')
+                      if args.verify_checkpoint_dir else None)
         try:
-            verify_torrent_contents(r.content, local_dir)
-        except VerificationError:
+            if isinstance(metainfo, Exception):
+                raise VerificationError(
+                    'Could not get torrent file') from metainfo
+            verifier = verifiers[hash_]
+            paths = [x[0] for x in verifier.index.files]
+            states = VerifiedStateStore.file_states(paths)
+            if state_store and state_store.is_verified(hash_, states):
+                log.info('"%s" has not changed since it was verified', bn)
+                continue
+            report = verifier.finish(workers=args.verify_workers,
+                                     checkpoint=checkpoint)
+            if not report.ok:
+                # Download only the damaged files again and retry once
+                for piece in report.bad_pieces:
+                    log.debug('Bad piece %d: %s', piece.index, ', '.join(
+                        f'{x.path} [{x.start}, {x.end})'
+                        for x in piece.files))
+                for path in report.damaged_files:
+                    log.info('Downloading damaged file %s again', path)
+                    rel = relpath(path, local_dir).replace(os.sep, '/')
+                    makedirs(dirname(path), exist_ok=True)
+                    _download(
+                        client, f'{client.http_prefix}/downloads'
+                        f'{remote_cwd}/{rel}', path)
+                # Everything else passed, so only the damaged files need to
+                # be hashed
+                states = VerifiedStateStore.file_states(paths)
+                index = verifier.index
+                damaged = set(report.damaged_files)
+                verify_torrent_contents(
+                    metainfo,
+                    local_dir,
+                    workers=args.verify_workers,
+                    files=[
+                        name
+                        for name, (path, _) in zip(index.names, index.files)
+                        if path in damaged
+                    ])
+            if state_store and states is not None:
+                state_store.mark_verified(hash_, states)
+        except (IOError, HTTPError, VerificationError):
             log.error(
                 'Could not verify "%s" contents against piece hashes '
                 'in torrent file', bn)
@@ -3,9 +3,13 @@ from functools import lru_cache
 from os.path import basename
 from typing import Optional
 import argparse
+import atexit
 import logging
 import sys
 
+from ..metrics import MetricsRegistry
+from ..ratelimit import RateLimiter
+
 
 @lru_cache()
 def setup_logging_stdout(name: Optional[str] = None,
@@ -54,5 +58,85 @@ def common_parser() -> argparse.ArgumentParser:
         help=('Back-off factor used when calculating time to wait to retry '
               'a failed request'))
     parser.add_argument('--netrc', required=False, help='netrc file path')
+    parser.add_argument(
+        '--rate',
+        type=float,
+        default=5.0,
+        help=('Initial number of requests per second. The rate adapts to '
+              'server errors and latency. Use 0 to disable rate limiting'))
+    parser.add_argument('--max-rate',
+                        type=float,
+                        default=50.0,
+                        help='Maximum number of requests per second')
+    add_metrics_arguments(parser)
     parser.add_argument('host', nargs=1, help='Host name')
     return parser
+
+
+def add_metrics_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add arguments used by metrics_from_args()."""
+    parser.add_argument('--metrics-summary',
+                        action='store_true',
+                        help='Log a summary of requests made at exit')
+    parser.add_argument('--metrics-file',
+                        help='Write request metrics to this file at exit')
+    parser.add_argument(
+        '--metrics-format',
+        choices=('jsonl', 'prometheus'),
+        default='jsonl',
+        help=('Format of --metrics-file: JSON lines (appended) or Prometheus '
+              'text (replaced, for node_exporter\'s textfile collector)'))
+
+
+def metrics_from_args(args: argparse.Namespace,
+                      log: logging.Logger) -> Optional[MetricsRegistry]:
+    """
+    Create a metrics registry from arguments added by add_metrics_arguments().
+
+    The summary and metrics file are written at exit.
+    """
+    if not args.metrics_summary and not args.metrics_file:
+        return None
+    registry = MetricsRegistry()
+
+    def dump() -> None:
+        if args.metrics_summary:
+            for line in registry.format_summary():
+                log.info('%s', line)
+        if args.metrics_file:
+            if args.metrics_format == 'prometheus':
+                registry.write_prometheus(args.metrics_file)
+            else:
+                registry.write_json_lines(args.metrics_file)
+
+    atexit.register(dump)
+    return registry
+
+
+def rate_limiter_from_args(args: argparse.Namespace) -> Optional[RateLimiter]:
+    """Create a rate limiter from arguments added by common_parser()."""
+    if args.rate <= 0:
+        return None
+    return RateLimiter(rate=args.rate,
+                       burst=max(1, int(args.rate)),
+                       min_rate=min(0.5, args.rate),
+                       max_rate=max(args.rate, args.max_rate))
+
+
+def add_sleep_time_argument(parser: argparse.ArgumentParser,
+                            *flags: str) -> None:
+    """
+    Accept the removed --sleep-time option so existing invocations keep
+    working. The option is hidden and ignored; see warn_sleep_time().
+    """
+    parser.add_argument(*(flags or ('--sleep-time', )),
+                        type=int,
+                        dest='sleep_time',
+                        help=argparse.SUPPRESS)
+
+
+def warn_sleep_time(args: argparse.Namespace, log: logging.Logger) -> None:
+    """Log a warning if --sleep-time was passed."""
+    if args.sleep_time is not None:
+        log.warning('--sleep-time is deprecated and ignored. Use --rate and '
+                    '--max-rate instead')
@@ -0,0 +1,89 @@
+"""Verify downloaded torrent data against .torrent files."""
+from os import listdir
+from os.path import basename, isdir, join as path_join
+from typing import Dict, Iterable, Iterator, Tuple
+import argparse
+import os
+import sys
+
+from typing_extensions import Final
+import argcomplete
+
+from ..util import TorrentFile, VerificationReport, verify_torrents
+from .util import setup_logging_stdout
+
+__all__ = ('main', )
+
+
+def _torrent_files(paths: Iterable[str]) -> Iterator[str]:
+    for path in paths:
+        if isdir(path):
+            yield from (path_join(path, x) for x in sorted(listdir(path))
+                        if x.endswith('.torrent'))
+        else:
+            yield path
+
+
+def main() -> int:
+    """Verify torrent data against .torrent files."""
+    parser: Final = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-d',
+                        '--data-dir',
+                        default='.',
+                        help='Directory the torrents are saved in')
+    parser.add_argument('-w',
+                        '--workers',
+                        type=int,
+                        default=os.cpu_count() or 1,
+                        help='Number of threads used to read and hash pieces')
+    parser.add_argument(
+        '--max-active',
+        type=int,
+        help='Number of torrents verified at once (default: --workers)')
+    parser.add_argument('-v',
+                        '--verbose',
+                        action='store_true',
+                        help='Log bad pieces')
+    parser.add_argument(
+        'torrents',
+        nargs='+',
+        metavar='TORRENT',
+        help='.torrent files, or directories containing .torrent files')
+    argcomplete.autocomplete(parser)
+    args: Final = parser.parse_args()
+    log: Final = setup_logging_stdout(verbose=args.verbose)
+    jobs: Dict[str, Tuple[TorrentFile, str]] = {
+        x: (x, args.data_dir)
+        for x in _torrent_files(args.torrents)
+    }
+    failed = 0
+    for torrent_file, report in verify_torrents(jobs,
+                                                workers=args.workers,
+                                                max_active=args.max_active):
+        name = basename(torrent_file)
+        if isinstance(report, Exception):
+            log.error('%s: could not load torrent file: %s', name, report)
+            failed += 1
+            continue
+        assert isinstance(report, VerificationReport)
+        if report.ok:
+            log.info('%s: OK', name)
+            continue
+        failed += 1
+        log.error(
+            '%s: FAILED (%d of %d pieces bad, %d missing files, %d files of '
+            'the wrong size)', name, len(report.bad_pieces),
+            report.piece_count, len(report.missing_files),
+            len(report.wrong_size_files))
+        for piece in report.bad_pieces:
+            log.debug('  piece %d: %s', piece.index,
+                      ', '.join(f'{x.path} [{x.start}, {x.end})'
+                                for x in piece.files))
+        for path in report.damaged_files:
+            log.info('  damaged: %s', path)
+    log.info('%d of %d torrents failed', failed, len(jobs))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,136 @@
+"""Lazy parser for bencoded torrent metainfo."""
+from hashlib import sha1
+from typing import Any, Dict, Iterator, List, Mapping, Tuple, Union
+
+__all__ = (
+    'LazyDict',
+    'Metainfo',
+    'parse_metainfo',
+)
+
+_DICT = ord('d')
+_END = ord('e')
+_INT = ord('i')
+_LIST = ord('l')
+
+#: Keys whose string values are returned as memoryviews of the data instead
+#: of being copied.
+VIEW_KEYS = frozenset((b'pieces', ))
+
+
+def _string_span(data: bytes, i: int) -> Tuple[int, int]:
+    # Start and end of the string at i
+    colon = data.find(b':', i)
+    if colon < 0 or not data[i:colon].isdigit():
+        raise ValueError(f'Invalid string at offset {i}')
+    start = colon + 1
+    end = start + int(data[i:colon])
+    if end > len(data):
+        raise ValueError(f'Truncated string at offset {i}')
+    return start, end
+
+
+def _skip(data: bytes, i: int) -> int:
+    # Offset after the value at i, without decoding it
+    c = data[i]
+    if c == _INT:
+        return data.index(b'e', i) + 1
+    if c in (_LIST, _DICT):
+        i += 1
+        while data[i] != _END:
+            i = _skip(data, i)
+        return i + 1
+    return _string_span(data, i)[1]
+
+
+def _decode(data: bytes, i: int, view: bool = False) -> Tuple[Any, int]:
+    # Value at i and the offset after it
+    c = data[i]
+    if c == _INT:
+        end = data.index(b'e', i)
+        return int(data[i + 1:end]), end + 1
+    if c == _LIST:
+        ret: List[Any] = []
+        i += 1
+        while data[i] != _END:
+            value, i = _decode(data, i)
+            ret.append(value)
+        return ret, i + 1
+    if c == _DICT:
+        d = LazyDict(data, i)
+        return d, d.end
+    start, end = _string_span(data, i)
+    return (memoryview(data)[start:end] if view else data[start:end]), end
+
+
+class LazyDict(Mapping[bytes, Any]):
+    """
+    Bencoded dictionary. Values are decoded when first accessed.
+
+    Dictionaries are LazyDict instances, lists are lists, integers are
+    integers and strings are bytes except for keys in VIEW_KEYS, which are
+    memoryviews of the data.
+    """
+    def __init__(self, data: bytes, start: int = 0):
+        """Parse the keys of the dictionary at offset start in data."""
+        self._data = data
+        self._spans: Dict[bytes, Tuple[int, int]] = {}
+        self._values: Dict[bytes, Any] = {}
+        i = start + 1
+        try:
+            if data[start] != _DICT:
+                raise ValueError(f'Expected a dictionary at offset {start}')
+            while data[i] != _END:
+                key_start, key_end = _string_span(data, i)
+                value_end = _skip(data, key_end)
+                self._spans[data[key_start:key_end]] = (key_end, value_end)
+                i = value_end
+        except IndexError as e:
+            raise ValueError('Truncated data') from e
+        #: Offset after the dictionary.
+        self.end = i + 1
+
+    def raw(self, key: bytes) -> memoryview:
+        """Bencoded value of key, as a view of the data."""
+        start, end = self._spans[key]
+        return memoryview(self._data)[start:end]
+
+    def __getitem__(self, key: bytes) -> Any:
+        """Decode a value."""
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+        start, unused_end = self._spans[key]
+        value = self._values[key] = _decode(self._data, start,
+                                            key in VIEW_KEYS)[0]
+        return value
+
+    def __iter__(self) -> Iterator[bytes]:
+        """Iterate keys in order."""
+        return iter(self._spans)
+
+    def __len__(self) -> int:
+        """Number of keys."""
+        return len(self._spans)
+
+
+class Metainfo(LazyDict):
+    """Torrent metainfo."""
+    def __init__(self, data: bytes):
+        """Parse data, which must be a complete bencoded dictionary."""
+        super().__init__(data)
+        if self.end != len(data):
+            raise ValueError('Trailing data after metainfo')
+        #: SHA1 digest of the bencoded info dictionary (None if missing).
+        self.info_hash = (sha1(self.raw(b'info')).digest()
+                          if b'info' in self._spans else None)
+
+
+def parse_metainfo(data: Union[bytes, bytearray, memoryview]) -> Metainfo:
+    """
+    Parse a .torrent file's contents without decoding the values.
+
+    Raises ValueError if data is not a bencoded dictionary.
+    """
+    return Metainfo(data if isinstance(data, bytes) else bytes(data))
@@ -0,0 +1,307 @@
+"""Request metrics for ruTorrentClient."""
+from bisect import bisect_left
+from threading import Lock
+from typing import (Any, Callable, Dict, Iterator, List, Mapping, NamedTuple,
+                    Optional, Sequence, Tuple, Union)
+from urllib.parse import parse_qs, urlsplit
+import json
+import re
+import time
+
+from requests.adapters import BaseAdapter
+import requests
+
+from .cache import write_atomic
+
+__all__ = (
+    'Histogram',
+    'InstrumentedHTTPAdapter',
+    'LATENCY_BUCKETS',
+    'MetricsHook',
+    'MetricsRegistry',
+    'RequestRecord',
+)
+
+#: Upper bounds in seconds of the latency histogram buckets.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0, float('inf'))
+
+_METHOD_NAME_RE = re.compile(rb'<methodName>\s*([^<\s]+)\s*</methodName>')
+_MODE_RE = re.compile(rb'(?:^|&)mode=([^&]*)')
+
+
+class RequestRecord(NamedTuple):
+    """One HTTP request made by a client."""
+    #: URI path of the request.
+    endpoint: str
+    #: ruTorrent mode (form or query mode= value) or XML-RPC method name.
+    mode: str
+    #: HTTP status code, or None if no response was received.
+    status: Optional[int]
+    #: Size of the request body.
+    bytes_sent: int
+    #: Bytes of the response body read from the connection. For streamed
+    #: responses this is Content-Length (0 if unknown).
+    bytes_received: int
+    #: Number of retries made by urllib3.
+    retries: int
+    #: Seconds until the response body was read, or until the headers were
+    #: received for streamed responses.
+    latency: float
+
+
+#: Callable that receives a RequestRecord for every request.
+MetricsHook = Callable[[RequestRecord], Any]
+
+
+class Histogram:
+    """Fixed-bucket histogram. Not thread-safe by itself."""
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS):
+        """Buckets are upper bounds in ascending order ending with inf."""
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        """Add a value."""
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimate a quantile (0 to 1) as the upper bound of the bucket it falls
+        in. The last bucket reports the maximum value seen.
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class _Series:
+    def __init__(self) -> None:
+        self.latency = Histogram()
+        self.statuses: Dict[Optional[int], int] = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.retries = 0
+
+
+class MetricsRegistry:
+    """
+    Thread-safe in-process metrics, grouped by endpoint and mode.
+
+    Instances are MetricsHook callables: pass one as the metrics_hook argument
+    to ruTorrentClient.
+    """
+    def __init__(self) -> None:
+        """Construct an empty registry."""
+        self._lock = Lock()
+        self._series: Dict[Tuple[str, str], _Series] = {}
+        self.started = time.time()
+
+    def __call__(self, record: RequestRecord) -> None:
+        """Record a request."""
+        key = (record.endpoint, record.mode)
+        with self._lock:
+            try:
+                series = self._series[key]
+            except KeyError:
+                series = self._series[key] = _Series()
+            series.latency.observe(record.latency)
+            series.statuses[record.status] = series.statuses.get(
+                record.status, 0) + 1
+            series.bytes_sent += record.bytes_sent
+            series.bytes_received += record.bytes_received
+            series.retries += record.retries
+
+    def summary(self) -> List[Dict[str, Any]]:
+        """
+        Return one dictionary per endpoint and mode, sorted by total time
+        spent (highest first).
+        """
+        with self._lock:
+            ret = [
+                dict(endpoint=endpoint,
+                     mode=mode,
+                     count=s.latency.count,
+                     errors=sum(n for status, n in s.statuses.items()
+                                if status is None or status >= 400),
+                     statuses={
+                         str(status or 'error'): n
+                         for status, n in s.statuses.items()
+                     },
+                     bytes_sent=s.bytes_sent,
+                     bytes_received=s.bytes_received,
+                     retries=s.retries,
+                     latency_total=s.latency.sum,
+                     latency_p50=s.latency.quantile(0.5),
+                     latency_p95=s.latency.quantile(0.95),
+                     latency_max=s.latency.max)
+                for (endpoint, mode), s in self._series.items()
+            ]
+        return sorted(ret, key=lambda x: -x['latency_total'])
+
+    def format_summary(self) -> Iterator[str]:
+        """Yield human-readable summary lines."""
+        for x in self.summary():
+            x['mode'] = x['mode'] or '-'
+            yield ('{endpoint} {mode}: {count} requests, {errors} errors, '
+                   '{retries} retries, {bytes_received} bytes in, '
+                   '{latency_total:.2f}s total, p50 {latency_p50:.3f}s, '
+                   'p95 {latency_p95:.3f}s, max {latency_max:.3f}s'.format(
+                       **x))
+
+    def write_json_lines(self, path: str) -> None:
+        """Append the summary to path, one JSON object per line."""
+        now = time.time()
+        with open(path, 'a', encoding='utf-8') as f:
+            for x in self.summary():
+                f.write(json.dumps(dict(time=now, started=self.started, **x)))
+                f.write('\n')
+
+    def write_prometheus(self, path: str, prefix: str = 'xirvik') -> None:
+        """
+        Write the metrics in Prometheus text format, for example for
+        node_exporter's textfile collector. The file is replaced atomically.
+        """
+        duration = f'{prefix}_request_duration_seconds'
+        families: Dict[str, List[str]] = {
+            f'{duration} histogram': [],
+            f'{prefix}_requests_total counter': [],
+            f'{prefix}_request_retries_total counter': [],
+            f'{prefix}_response_bytes_total counter': [],
+        }
+        hist, requests_, retries, bytes_ = families.values()
+        with self._lock:
+            for (endpoint, mode), s in sorted(self._series.items()):
+                labels = (f'endpoint="{_escape(endpoint)}",'
+                          f'mode="{_escape(mode)}"')
+                cumulative = 0
+                for bound, count in zip(s.latency.buckets, s.latency.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    hist.append(f'{duration}_bucket{{{labels},le="{le}"}} '
+                                f'{cumulative}')
+                hist.append(f'{duration}_sum{{{labels}}} {s.latency.sum}')
+                hist.append(f'{duration}_count{{{labels}}} {s.latency.count}')
+                for status, n in sorted(s.statuses.items(),
+                                        key=lambda x: x[0] or 0):
+                    requests_.append(f'{prefix}_requests_total{{{labels},'
+                                     f'status="{status or "error"}"}} {n}')
+                retries.append(f'{prefix}_request_retries_total{{{labels}}} '
+                               f'{s.retries}')
+                bytes_.append(f'{prefix}_response_bytes_total{{{labels}}} '
+                              f'{s.bytes_received}')
+        lines: List[str] = []
+        for type_line, samples in families.items():
+            lines.append(f'# TYPE {type_line}')
+            lines.extend(samples)
+        write_atomic(path, ('\n'.join(lines) + '\n').encode('utf-8'))
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _get_mode(request: requests.PreparedRequest) -> str:
+    body = request.body
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    content_type = request.headers.get('Content-Type', '')
+    m = None
+    if isinstance(body, bytes):
+        if content_type.startswith('text/xml'):
+            m = _METHOD_NAME_RE.search(body, 0, 1024)
+        elif content_type.startswith('application/x-www-form-urlencoded'):
+            m = _MODE_RE.search(body)
+    if m:
+        return m.group(1).decode('utf-8', 'replace')
+    query = parse_qs(urlsplit(request.url or '').query)
+    return query.get('mode', [''])[0]
+
+
+def _body_size(request: requests.PreparedRequest) -> int:
+    try:
+        return int(request.headers.get('Content-Length', 0))
+    except ValueError:
+        return 0
+
+
+def _response_size(r: requests.Response, stream: bool) -> int:
+    if stream:
+        try:
+            return int(r.headers.get('Content-Length', 0))
+        except ValueError:
+            return 0
+    # Bytes read from the connection, before any content decoding
+    try:
+        return int(r.raw.tell()) or len(r.content)
+    except (AttributeError, TypeError, ValueError, OSError):
+        return len(r.content)
+
+
+class InstrumentedHTTPAdapter(BaseAdapter):
+    """
+    Adapter that wraps another adapter and passes a RequestRecord for every
+    request to a MetricsHook.
+    """
+    def __init__(self, adapter: BaseAdapter, hook: MetricsHook):
+        """Wrap adapter."""
+        super().__init__()
+        self.adapter = adapter
+        self.hook = hook
+
+    def send(self,
+             request: requests.PreparedRequest,
+             stream: bool = False,
+             timeout: Union[None, float, Tuple[float, float]] = None,
+             verify: Union[bool, str] = True,
+             cert: Any = None,
+             proxies: Optional[Mapping[str, str]] = None
+             ) -> requests.Response:
+        """Send with the wrapped adapter and record the request."""
+        start = time.monotonic()
+        r: Optional[requests.Response] = None
+        try:
+            r = self.adapter.send(request,
+                                  stream=stream,
+                                  timeout=timeout,
+                                  verify=verify,
+                                  cert=cert,
+                                  proxies=proxies)
+            if not stream:
+                # Read the body now so its size can be counted
+                r.content  # pylint: disable=pointless-statement
+            return r
+        finally:
+            latency = time.monotonic() - start
+            retries = 0
+            bytes_received = 0
+            if r is not None:
+                history = getattr(getattr(r.raw, 'retries', None), 'history',
+                                  None)
+                retries = len(history or ())
+                bytes_received = _response_size(r, stream)
+            self.hook(
+                RequestRecord(endpoint=urlsplit(request.url or '').path,
+                              mode=_get_mode(request),
+                              status=r.status_code if r is not None else None,
+                              bytes_sent=_body_size(request),
+                              bytes_received=bytes_received,
+                              retries=retries,
+                              latency=latency))
+
+    def close(self) -> None:
+        """Close the wrapped adapter."""
+        self.adapter.close()
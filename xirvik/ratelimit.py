@@ -0,0 +1,135 @@
+"""Client-side request rate limiting."""
+from threading import Lock
+from typing import Any, Callable, Mapping, Optional, Union
+import logging
+import time
+
+from requests.adapters import BaseAdapter
+import requests
+
+__all__ = (
+    'LOG_NAME',
+    'RateLimitedHTTPAdapter',
+    'RateLimiter',
+)
+
+#: Name used in logger.
+LOG_NAME = 'xirvik.ratelimit'
+
+
+class RateLimiter:
+    """
+    Thread-safe token bucket with an adaptive (AIMD) rate.
+
+    acquire() blocks until a request may be sent. Up to burst requests can be
+    sent at once after a period of inactivity; after that, requests are spaced
+    out to rate per second.
+
+    Call record() with the outcome of every request. Failures (5xx and 429
+    responses, timeouts) multiply the rate by decrease_factor, at most once
+    per target_latency seconds so a burst of failures from requests that were
+    already in flight only counts once. Successes faster than target_latency
+    add increase to the rate. The rate stays between min_rate and max_rate.
+    """
+    def __init__(self,
+                 rate: float = 5.0,
+                 burst: int = 5,
+                 min_rate: float = 0.5,
+                 max_rate: float = 50.0,
+                 increase: float = 0.5,
+                 decrease_factor: float = 0.5,
+                 target_latency: float = 2.0,
+                 clock: Callable[[], float] = time.monotonic,
+                 sleep: Callable[[float], Any] = time.sleep):
+        """Rates are in requests per second and latencies in seconds."""
+        if not 0 < min_rate <= rate <= max_rate:
+            raise ValueError('Rates must satisfy 0 < min_rate <= rate <= '
+                             'max_rate')
+        if burst < 1:
+            raise ValueError('burst must be at least 1')
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.target_latency = target_latency
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = Lock()
+        self._tokens = float(burst)
+        self._last = clock()
+        self._last_decrease: Optional[float] = None
+        self._log = logging.getLogger(LOG_NAME)
+
+    def acquire(self) -> float:
+        """Wait until a request may be sent. Return the time waited."""
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(float(self.burst),
+                               self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            # Taking a token into debt reserves a slot for this caller, so
+            # waiting happens outside the lock
+            self._tokens -= 1
+            delay = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if delay > 0:
+            self._sleep(delay)
+        return delay
+
+    def record(self, latency: float, ok: bool) -> None:
+        """Adjust the rate given a request's latency and outcome."""
+        with self._lock:
+            if not ok:
+                now = self._clock()
+                if (self._last_decrease is not None
+                        and now - self._last_decrease < self.target_latency):
+                    return
+                self._last_decrease = now
+                self.rate = max(self.min_rate,
+                                self.rate * self.decrease_factor)
+                self._log.debug('Backing off to %.2f requests/s', self.rate)
+            elif latency <= self.target_latency:
+                self.rate = min(self.max_rate, self.rate + self.increase)
+
+
+class RateLimitedHTTPAdapter(BaseAdapter):
+    """
+    Adapter that wraps another adapter and sends every request through a
+    RateLimiter.
+    """
+    def __init__(self, adapter: BaseAdapter, rate_limiter: RateLimiter):
+        """Wrap adapter."""
+        super().__init__()
+        self.adapter = adapter
+        self.rate_limiter = rate_limiter
+
+    def send(self,
+             request: requests.PreparedRequest,
+             stream: bool = False,
+             timeout: Union[None, float, tuple] = None,
+             verify: Union[bool, str] = True,
+             cert: Any = None,
+             proxies: Optional[Mapping[str, str]] = None
+             ) -> requests.Response:
+        """Wait for the rate limiter, send, then record the outcome."""
+        self.rate_limiter.acquire()
+        start = time.monotonic()
+        try:
+            r = self.adapter.send(request,
+                                  stream=stream,
+                                  timeout=timeout,
+                                  verify=verify,
+                                  cert=cert,
+                                  proxies=proxies)
+        except (requests.Timeout, requests.ConnectionError):
+            self.rate_limiter.record(time.monotonic() - start, False)
+            raise
+        self.rate_limiter.record(time.monotonic() - start,
+                                 r.status_code < 500
+                                 and r.status_code != 429)
+        return r
+
+    def close(self) -> None:
+        """Close the wrapped adapter."""
+        self.adapter.close()
@@ -1,28 +1,331 @@
 """SFTP client like paramiko's with extra features."""
+from collections import deque
+from concurrent.futures import (FIRST_COMPLETED, Future, ThreadPoolExecutor,
+                                wait)
 from datetime import datetime
 from math import ceil, floor
 from os import chmod, makedirs, utime
 from os.path import basename, dirname, isdir, join as path_join, realpath
-from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, cast
+from queue import Empty, Queue
+from stat import S_IFDIR, S_ISDIR, S_ISREG
+from threading import Lock, local
+from typing import (Any, Callable, Deque, Dict, Iterable, Iterator, List,
+                    NamedTuple, Optional, Sequence, Set, Tuple, cast)
 import inspect
+import json
 import logging
 import os
 import socket
+import time
 
 from humanize import naturaldelta, naturalsize
 from paramiko import SFTPAttributes, SFTPClient as OriginalSFTPClient, SFTPFile
 from paramiko.client import SSHClient
 from paramiko.sftp import SFTPError
+from paramiko.ssh_exception import SSHException
 
-from .typing import Method0, Method1
+from .cache import ManifestFile, RemoteManifest, TransferSettingsCache
+from .typing import Method0, Method1, WriteHook
 
 __all__ = (
     'SFTPClient',
     'LOG_NAME',
+    'TransferSettings',
 )
 
 LOG_NAME = 'xirvik.sftp'
 LOG_INTERVAL = 60
+#: Attempts made at downloading a file by a parallel mirror() worker.
+MAX_ATTEMPTS = 10
+#: readdir requests kept in flight per directory by a concurrent
+#: listdir_attr_recurse().
+READ_AHEADS = 50
+#: Default size of the byte ranges of a segmented download.
+SEGMENT_SIZE = 64 * 1024**2
+#: Suffix of the file a segmented download writes to until it is complete.
+PART_SUFFIX = '.part'
+#: Suffix of the file recording the completed segments of a download.
+SEGMENTS_SUFFIX = '.segments'
+#: Channels opened on one SSH connection at most. OpenSSH servers refuse
+#: more than MaxSessions (10 by default).
+MAX_CHANNELS = 10
+#: Default number of channels listing directories in a parallel mirror().
+WALK_CONCURRENCY = 4
+
+
+class TransferSettings(NamedTuple):
+    """
+    Tuning of SFTP transfers.
+
+    On a link with high latency, throughput is limited by the number of
+    bytes in flight: max_requests * request_size, capped by window_size.
+    """
+    #: Read requests kept outstanding per file. None lets paramiko send them
+    #: all at once.
+    max_requests: Optional[int] = None
+    #: Bytes asked for by each read request.
+    request_size: int = SFTPFile.MAX_REQUEST_SIZE
+    #: SSH channel window size in bytes. None for paramiko's default.
+    window_size: Optional[int] = None
+    #: Maximum SSH packet size in bytes. None for paramiko's default.
+    max_packet_size: Optional[int] = None
+
+
+#: Settings tried by SFTPClient.probe_transfer_settings().
+PROBE_CANDIDATES: Sequence[TransferSettings] = (
+    TransferSettings(),
+    TransferSettings(max_requests=64),
+    TransferSettings(max_requests=128, window_size=8 * 1024**2),
+    TransferSettings(max_requests=256,
+                     window_size=16 * 1024**2,
+                     max_packet_size=64 * 1024),
+    TransferSettings(max_requests=128,
+                     request_size=64 * 1024,
+                     window_size=16 * 1024**2,
+                     max_packet_size=64 * 1024),
+    TransferSettings(max_requests=1024, window_size=64 * 1024**2),
+)
+#: Bytes read with each candidate by SFTPClient.probe_transfer_settings().
+PROBE_SAMPLE_SIZE = 16 * 1024**2
+#: Seconds before settings cached by SFTPClient.tune() are probed again.
+TUNING_MAX_AGE = 7 * 24 * 3600
+
+
+def _read_from(remote: SFTPFile, settings: TransferSettings, offset: int,
+               size: int) -> Iterator[bytes]:
+    # Pipelined read from offset to the end of a file of size bytes
+    remote.MAX_REQUEST_SIZE = settings.request_size
+    remote.seek(offset)
+    remote.prefetch(size, settings.max_requests)
+    while True:
+        data = remote.read(settings.request_size)
+        if not data:
+            return
+        yield data
+
+
+def _read_range(remote: SFTPFile, settings: TransferSettings, start: int,
+                end: int) -> Iterator[Tuple[int, bytes]]:
+    # Pipelined read of bytes [start, end), yielding blocks and their offsets
+    remote.MAX_REQUEST_SIZE = settings.request_size
+    chunks = [(x, min(settings.request_size, end - x))
+              for x in range(start, end, settings.request_size)]
+    for (offset, size), data in zip(
+            chunks, remote.readv(chunks, settings.max_requests)):
+        if len(data) != size:
+            raise IOError('Unexpected end of file')
+        yield offset, data
+
+
+def _preallocate(fd: int, size: int) -> None:
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        # Not supported by the platform or the file system
+        os.ftruncate(fd, size)
+
+
+def _file_size(path: str) -> Optional[int]:
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return None
+
+
+def _spread_channels(channels: int, connections: int,
+                     reserved: int) -> List[int]:
+    # Index of the connection for each new channel, round robin over
+    # connections with at most MAX_CHANNELS on each. reserved channels are
+    # already open on the first connection. Connections are added if needed.
+    used = [reserved] + [0] * (connections - 1)
+    ret = []
+    index = 0
+    for _ in range(channels):
+        for _ in range(len(used)):
+            if used[index] < MAX_CHANNELS:
+                break
+            index = (index + 1) % len(used)
+        else:
+            used.append(0)
+            index = len(used) - 1
+        used[index] += 1
+        ret.append(index)
+        index = (index + 1) % len(used)
+    return ret
+
+
+def _is_file(info: SFTPAttributes) -> bool:
+    # Regular file, or unknown type
+    return info.st_mode is None or S_ISREG(info.st_mode)
+
+
+def _set_attributes(dest: str, info: SFTPAttributes, keep_modes: bool,
+                    keep_times: bool) -> None:
+    try:
+        if keep_modes:
+            chmod(dest, info.st_mode)
+        if keep_times:
+            utime(dest, (
+                info.st_atime,
+                info.st_mtime,
+            ))
+    except IOError:
+        pass
+
+
+class _ChannelDownloader:
+    # Downloads files over its own SFTP channel for SFTPClient.mirror(). After
+    # a connection error it reconnects with a new SSH connection and resumes
+    # from the size of the local file
+    def __init__(self,
+                 parent: 'SFTPClient',
+                 ssh_client: SSHClient,
+                 cwd: Optional[str],
+                 resume: bool,
+                 on_write: Optional[WriteHook],
+                 max_attempts: int = MAX_ATTEMPTS):
+        self.parent = parent
+        self.cwd = cwd
+        self.resume = resume
+        self.on_write = on_write
+        self.max_attempts = max_attempts
+        self.ssh_client: Optional[SSHClient] = None
+        self.sftp = parent._open_sftp(ssh_client)
+        if cwd:
+            self.sftp.chdir(cwd)
+
+    def _reconnect(self) -> None:
+        self.close()
+        self.ssh_client = self.parent._new_ssh_client()
+        self.sftp = self.parent._open_sftp(self.ssh_client)
+        if self.cwd:
+            self.sftp.chdir(self.cwd)
+
+    def close(self) -> None:
+        try:
+            self.sftp.close()
+        finally:
+            # Only connections made by this downloader
+            if self.ssh_client:
+                self.ssh_client.close()
+
+    def _retry(self, remote_path: str, func: Callable[[], None]) -> None:
+        log = self.parent._log
+        attempt = 1
+        while True:
+            try:
+                func()
+                return
+            except (socket.timeout, ConnectionError, EOFError, SFTPError,
+                    SSHException) as e:
+                if not self.resume or attempt >= self.max_attempts:
+                    raise
+                log.error('%s: %s', remote_path, e or type(e).__name__)
+                attempt += 1
+                log.debug('Re-establishing connection')
+                self._reconnect()
+
+    def download(self, remote_path: str, size: int, dest: str) -> None:
+        self._retry(remote_path, lambda: self._get(remote_path, size, dest))
+
+    def download_range(self, remote_path: str, fd: int, dest: str, start: int,
+                       end: int) -> None:
+        # Write bytes [start, end) of the remote file at the same offsets in
+        # fd. A retry starts after the last block written
+        position = start
+
+        def get() -> None:
+            nonlocal position
+            with self.sftp.open(remote_path, 'rb') as remote:
+                for offset, data in _read_range(remote,
+                                                self.parent.transfer_settings,
+                                                position, end):
+                    os.pwrite(fd, data, offset)
+                    if self.on_write:
+                        self.on_write(dest, offset, data)
+                    position = offset + len(data)
+
+        self._retry(remote_path, get)
+
+    def _get(self, remote_path: str, size: int, dest: str) -> None:
+        offset = 0
+        if self.resume:
+            try:
+                offset = os.stat(dest).st_size
+            except OSError:
+                pass
+            if offset > size:
+                offset = 0
+        log = self.parent._log
+        if offset:
+            log.info('Resuming %s at %s bytes', remote_path, offset)
+        else:
+            log.info('Downloading %s -> %s', remote_path, dest)
+        with self.sftp.open(remote_path, 'rb') as remote, open(
+                dest, 'r+b' if offset else 'wb') as f:
+            f.seek(offset)
+            for data in _read_from(remote, self.parent.transfer_settings,
+                                   offset, size):
+                if self.on_write:
+                    self.on_write(dest, offset, data)
+                f.write(data)
+                offset += len(data)
+
+
+class _ManifestWalk:
+    # Skips listing directories of a listdir_attr_recurse() walk that have not
+    # changed according to a RemoteManifest. Listings are only saved once the
+    # walk is complete
+    def __init__(self, manifest: RemoteManifest, root: str):
+        self.manifest = manifest
+        self.root = root
+        self.started = time.time()
+        self.listings: List[Tuple[str, Optional[int], List[ManifestFile],
+                                  List[str]]] = []
+
+    def entries(self, path: str,
+                mtime: Optional[int]) -> Optional[List[SFTPAttributes]]:
+        # Saved entries of a directory, or None if it has to be listed.
+        # Subdirectories have no modification time, so they are checked too
+        if mtime is None or self.manifest.dir_mtime(self.root, path) != mtime:
+            return None
+        files, subdirs = self.manifest.listing(self.root, path)
+        ret = []
+        for x in files:
+            info = SFTPAttributes()
+            info.filename = basename(x.path)
+            info.st_size = x.size
+            info.st_mtime = x.mtime
+            info.st_atime = x.atime
+            info.st_mode = x.mode
+            ret.append(info)
+        for subdir in subdirs:
+            info = SFTPAttributes()
+            info.filename = basename(subdir)
+            info.st_mode = S_IFDIR
+            ret.append(info)
+        return ret
+
+    def record(self, path: str, mtime: Optional[int],
+               entries: Iterable[SFTPAttributes]) -> None:
+        files = []
+        subdirs = []
+        for info in entries:
+            entry_path = path_join(path, info.filename)
+            if S_ISDIR(info.st_mode or 0):
+                subdirs.append(entry_path)
+            else:
+                files.append(
+                    ManifestFile(entry_path, info.st_size, info.st_mtime,
+                                 info.st_atime, info.st_mode))
+        # Modification times have a resolution of a second, so a change made
+        # in the same second as the listing would not change it
+        if mtime is not None and mtime >= floor(self.started):
+            mtime = None
+        self.listings.append((path, mtime, files, subdirs))
+
+    def save(self) -> None:
+        self.manifest.update(self.root, self.listings, self.started)
 
 
 class SFTPClient:
@@ -35,13 +338,22 @@ class SFTPClient:
 
     original_arguments: Dict[str, Any] = {}
     debug: bool = False
+    transfer_settings: TransferSettings = TransferSettings()
 
     _log = logging.getLogger(LOG_NAME)
-    _dircache: List[str] = []
+    _dircache: Set[str] = set()
 
     def __init__(self, **kwargs: Any):
-        """Constructor."""
+        """
+        Constructor.
+
+        Pass transfer_settings (a TransferSettings) to tune transfers. They
+        can also be found with tune().
+        """
         self.original_arguments = kwargs.copy()
+        self._dircache = set()
+        self.transfer_settings = (kwargs.get('transfer_settings')
+                                  or TransferSettings())
         self._connect(**kwargs)
 
     def __enter__(self) -> 'SFTPClient':
@@ -52,27 +364,55 @@ class SFTPClient:
         """For use with a with statement."""
         self.close_all()
 
-    def _connect(self, **kwargs: Any) -> None:
+    def _new_ssh_client(self) -> SSHClient:
+        # New connection made with the arguments passed to the constructor
+        kwargs = self.original_arguments
         kwargs_to_paramiko = dict(
-            look_for_keys=kwargs.pop('look_for_keys', True),
-            username=kwargs.pop('username'),
-            port=kwargs.pop('port', 22),
+            look_for_keys=kwargs.get('look_for_keys', True),
+            username=kwargs['username'],
+            port=kwargs.get('port', 22),
             allow_agent=False,
-            timeout=kwargs.pop('timeout', None),
+            timeout=kwargs.get('timeout', None),
         )
-        host = kwargs.pop('hostname', 'localhost')
-        password = kwargs.pop('password')
-        keepalive = kwargs.pop('keepalive', 5)
-        if password:
-            kwargs_to_paramiko['password'] = password
+        if kwargs['password']:
+            kwargs_to_paramiko['password'] = kwargs['password']
+        ssh_client = SSHClient()
+        ssh_client.load_system_host_keys()
+        ssh_client.connect(kwargs.get('hostname', 'localhost'),
+                           **kwargs_to_paramiko)
+        return ssh_client
+
+    def _host_key(self) -> str:
+        # user@host:port
+        kwargs = self.original_arguments
+        return (f'{kwargs["username"]}@{kwargs.get("hostname", "localhost")}'
+                f':{kwargs.get("port", 22)}')
+
+    def _open_sftp(
+            self,
+            ssh_client: SSHClient,
+            settings: Optional[TransferSettings] = None
+    ) -> OriginalSFTPClient:
+        # New SFTP channel with the timeout and keepalive from the
+        # constructor's arguments, and the window and packet sizes from
+        # settings (default: transfer_settings)
+        settings = settings or self.transfer_settings
+        client = cast(
+            OriginalSFTPClient,
+            OriginalSFTPClient.from_transport(
+                ssh_client.get_transport(),
+                window_size=settings.window_size,
+                max_packet_size=settings.max_packet_size))
+        channel = client.get_channel()
+        channel.settimeout(self.original_arguments.get('timeout', None))
+        channel.get_transport().set_keepalive(
+            self.original_arguments.get('keepalive', 5))
+        return client
+
+    def _connect(self, **kwargs: Any) -> None:
         self.raise_exceptions: bool = kwargs.pop('raise_exceptions', False)
-        self.ssh_client = SSHClient()
-        self.ssh_client.load_system_host_keys()
-        self.ssh_client.connect(host, **kwargs_to_paramiko)
-        self.client: OriginalSFTPClient = self.ssh_client.open_sftp()
-        channel = self.client.get_channel()
-        channel.settimeout(kwargs_to_paramiko['timeout'])
-        channel.get_transport().set_keepalive(keepalive)
+        self.ssh_client = self._new_ssh_client()
+        self.client: OriginalSFTPClient = self._open_sftp(self.ssh_client)
         # 'Extend' the SFTPClient class
         is_reconnect: bool = kwargs.pop('is_reconnect', False)
         members = inspect.getmembers(self.client, predicate=inspect.ismethod)
@@ -95,27 +435,144 @@ class SFTPClient:
 
     def clear_directory_cache(self) -> None:
         """Reset directory cache."""
-        self._dircache = []
-
-    def listdir_attr_recurse(self,
-                             path: str = '.'
-                             ) -> Iterator[Tuple[str, SFTPAttributes]]:
-        """List directory attributes recursively."""
-        for dir_attr in self.client.listdir_attr(path=path):
-            is_dir = dir_attr.st_mode & 0o700 == 0o700
-            if is_dir:
+        self._dircache = set()
+
+    def listdir_attr_recurse(
+        self,
+        path: str = '.',
+        concurrency: int = 1,
+        manifest: Optional[RemoteManifest] = None
+    ) -> Iterator[Tuple[str, SFTPAttributes]]:
+        """
+        List directory attributes recursively.
+
+        Yields the path and attributes of everything that is not a directory,
+        breadth-first, as soon as each directory is listed. Subdirectories
+        that cannot be listed are skipped unless raise_exceptions was passed
+        to the constructor.
+
+        With concurrency greater than 1, that many directories are listed at
+        a time, each over its own SFTP channel, so entries come in no
+        particular order.
+
+        With a manifest, a directory whose modification time has not changed
+        since it was listed is not listed again and its entries come from the
+        manifest. Its subdirectories are still checked with stat(). Listings
+        older than the manifest's max_age are not used, so files changed in
+        place are noticed within that time. The manifest is updated once the
+        walk is complete.
+        """
+        walk = None
+        if manifest:
+            path = path.rstrip('/') or '/'
+            walk = _ManifestWalk(manifest,
+                                 self._host_key() + (self.getcwd() or ''))
+        if concurrency > 1:
+            yield from self._listdir_attr_recurse_concurrent(
+                path, concurrency, walk)
+        else:
+            pending: Deque[Tuple[str, Optional[int]]] = deque([(path, None)])
+            while pending:
+                dir_path, mtime = pending.popleft()
                 try:
-                    for x in self.listdir_attr_recurse(
-                            path_join(path, dir_attr.filename)):
-                        yield x
-                except IOError as e:
-                    if self.raise_exceptions:
-                        raise e
+                    mtime, entries, listed = self._read_dir(
+                        self.client, dir_path, mtime, walk)
+                except IOError:
+                    if dir_path == path or self.raise_exceptions:
+                        raise
+                    continue
+                if walk and listed:
+                    walk.record(dir_path, mtime, entries)
+                yield from self._split_entries(dir_path, entries, pending)
+        if walk:
+            walk.save()
+
+    @staticmethod
+    def _read_dir(
+            sftp: OriginalSFTPClient,
+            dir_path: str,
+            mtime: Optional[int],
+            walk: Optional[_ManifestWalk],
+            read_aheads: Optional[int] = None
+    ) -> Tuple[Optional[int], List[SFTPAttributes], bool]:
+        # Modification time and entries of a directory, and whether it was
+        # listed (instead of taken from the manifest)
+        if walk:
+            if mtime is None:
+                mtime = sftp.stat(dir_path).st_mtime
+            entries = walk.entries(dir_path, mtime)
+            if entries is not None:
+                return mtime, entries, False
+        if read_aheads:
+            return mtime, list(
+                sftp.listdir_iter(dir_path, read_aheads=read_aheads)), True
+        return mtime, sftp.listdir_attr(path=dir_path), True
+
+    @staticmethod
+    def _split_entries(
+        dir_path: str, entries: Iterable[SFTPAttributes],
+        pending: Deque[Tuple[str, Optional[int]]]
+    ) -> Iterator[Tuple[str, SFTPAttributes]]:
+        # Queue the subdirectories and yield the rest
+        for info in entries:
+            entry_path = path_join(dir_path, info.filename)
+            if S_ISDIR(info.st_mode or 0):
+                pending.append((entry_path, info.st_mtime))
             else:
-                yield (
-                    path_join(path, dir_attr.filename),
-                    dir_attr,
-                )
+                yield entry_path, info
+
+    def _listdir_attr_recurse_concurrent(
+            self, path: str, concurrency: int,
+            walk: Optional[_ManifestWalk]
+    ) -> Iterator[Tuple[str, SFTPAttributes]]:
+        # See listdir_attr_recurse()
+        cwd = self.getcwd()
+        channels: List[OriginalSFTPClient] = []
+        lock = Lock()
+        thread_data = local()
+
+        def read_dir(
+            dir_path: str, mtime: Optional[int]
+        ) -> Tuple[Optional[int], List[SFTPAttributes], bool]:
+            sftp = getattr(thread_data, 'sftp', None)
+            if sftp is None:
+                sftp = thread_data.sftp = self._open_sftp(self.ssh_client)
+                with lock:
+                    channels.append(sftp)
+                if cwd:
+                    sftp.chdir(cwd)
+            return self._read_dir(sftp, dir_path, mtime, walk, READ_AHEADS)
+
+        pending: Deque[Tuple[str, Optional[int]]] = deque([(path, None)])
+        running: Dict['Future[Tuple[Optional[int], List[SFTPAttributes], '
+                      'bool]]', str] = {}
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        try:
+            while pending or running:
+                while pending and len(running) < concurrency:
+                    dir_path, mtime = pending.popleft()
+                    running[executor.submit(read_dir, dir_path,
+                                            mtime)] = dir_path
+                done, unused_not_done = wait(running,
+                                             return_when=FIRST_COMPLETED)
+                for future in done:
+                    dir_path = running.pop(future)
+                    try:
+                        mtime, entries, listed = future.result()
+                    except IOError:
+                        if dir_path == path or self.raise_exceptions:
+                            raise
+                        continue
+                    if walk and listed:
+                        walk.record(dir_path, mtime, entries)
+                    yield from self._split_entries(dir_path, entries,
+                                                   pending)
+        finally:
+            for future in running:
+                future.cancel()
+            executor.shutdown()
+            for sftp in channels:
+                sftp.close()
 
     def _get_callback(self, start_time: datetime,
                       _log: logging.Logger) -> Callable[[int, int], None]:
@@ -143,7 +600,13 @@ class SFTPClient:
                dest_root: str = '.',
                keep_modes: bool = True,
                keep_times: bool = True,
-               resume: bool = True) -> int:
+               resume: bool = True,
+               on_write: Optional[WriteHook] = None,
+               workers: int = 1,
+               connections: int = 1,
+               segment_threshold: Optional[int] = None,
+               manifest: Optional[RemoteManifest] = None,
+               walk_concurrency: int = WALK_CONCURRENCY) -> int:
         """
         Mirror a remote directory to a local location.
 
@@ -154,12 +617,37 @@ class SFTPClient:
         are retained respectively.
 
         Pass resume=False to disable file resumption.
+
+        on_write is called with every block written.
+
+        With workers greater than 1, files are downloaded by that many
+        threads, each with its own SFTP channel, spread over connections SSH
+        connections (this client's connection is the first). A worker that
+        loses its connection reconnects and resumes the file it was
+        downloading. Meanwhile, up to walk_concurrency channels on this
+        client's connection list directories. Connections are added when
+        needed so that none has more than MAX_CHANNELS channels.
+
+        Files of at least segment_threshold bytes are downloaded with
+        download_segmented() using workers and connections.
+
+        manifest is passed to listdir_attr_recurse() so only directories that
+        changed are listed.
+
+        Returns the number of files downloaded.
         """
+        if workers > 1:
+            return self._mirror_parallel(path, dest_root, keep_modes,
+                                         keep_times, resume, on_write,
+                                         workers, max(1, connections),
+                                         segment_threshold, manifest,
+                                         walk_concurrency)
         n = 0
         resume_seek = None
         cwd = self.getcwd()
-        for _path, info in self.listdir_attr_recurse(path=path):
-            if info.st_mode & 0o700 == 0o700:
+        for _path, info in self.listdir_attr_recurse(path=path,
+                                                     manifest=manifest):
+            if not _is_file(info):
                 continue
             dest_path = path_join(dest_root, dirname(_path))
             dest = path_join(dest_path, basename(_path))
@@ -168,9 +656,21 @@ class SFTPClient:
                     makedirs(dest_path)
                 except OSError:
                     pass
-                self._dircache.append(dest_path)
+                self._dircache.add(dest_path)
             if isdir(dest):
                 continue
+            if (segment_threshold is not None
+                    and info.st_size >= segment_threshold):
+                if _file_size(dest) != info.st_size:
+                    self.download_segmented(_path,
+                                            dest,
+                                            workers=workers,
+                                            connections=connections,
+                                            resume=resume,
+                                            on_write=on_write)
+                    n += 1
+                _set_attributes(dest, info, keep_modes, keep_times)
+                continue
             try:
                 with open(dest, 'rb'):
                     current_size = os.stat(dest).st_size
@@ -185,37 +685,26 @@ class SFTPClient:
                     try:
                         # Only size is used to determine complete-ness here
                         # Hash verification is in the util module
-                        if resume_seek and resume:
-                            read_tuples = []
-                            n_reads = ceil((info.st_size - resume_seek) /
-                                           self.MAX_PACKET_SIZE) - 1
-                            n_left = ((info.st_size - resume_seek) %
-                                      self.MAX_PACKET_SIZE)
-                            offset = 0
-                            for n in range(n_reads):
-                                read_tuples.append((
-                                    resume_seek + offset,
-                                    self.MAX_PACKET_SIZE,
-                                ))
-                                offset += self.MAX_PACKET_SIZE
-                            read_tuples.append((
-                                resume_seek + offset,
-                                n_left,
-                            ))
-                            with self.client.open(_path) as sftp_file:
-                                with open(dest, 'ab') as f:
-                                    f.seek(resume_seek)
-                                    resume_seek = None
-                                    for chunk in sftp_file.readv(read_tuples):
-                                        f.write(chunk)
-                        else:
+                        offset = (max(0, resume_seek)
+                                  if resume_seek and resume else 0)
+                        resume_seek = None
+                        if not offset:
                             dest = realpath(dest)
                             self._log.info('Downloading %s -> %s', _path, dest)
-                            start_time = datetime.now()
-                            self.client.get(_path, dest)
-                            self._get_callback(start_time,
-                                               self._log)(info.st_size,
-                                                          info.st_size)
+                        start_time = datetime.now()
+                        with self.client.open(_path, 'rb') as sftp_file, open(
+                                dest, 'r+b' if offset else 'wb') as f:
+                            f.seek(offset)
+                            for chunk in _read_from(sftp_file,
+                                                    self.transfer_settings,
+                                                    offset, info.st_size):
+                                if on_write:
+                                    on_write(dest, offset, chunk)
+                                f.write(chunk)
+                                offset += len(chunk)
+                        self._get_callback(start_time,
+                                           self._log)(info.st_size,
+                                                      info.st_size)
 
                         # Do not count files that were already downloaded
                         n += 1
@@ -242,18 +731,321 @@ class SFTPClient:
                         if cwd:
                             cast(OriginalSFTPClient, self).chdir(cwd)
             # Okay to fix existing files even if they are already downloaded
+            _set_attributes(dest, info, keep_modes, keep_times)
+        return n
+
+    def _mirror_parallel(self, path: str, dest_root: str, keep_modes: bool,
+                         keep_times: bool, resume: bool,
+                         on_write: Optional[WriteHook], workers: int,
+                         connections: int, segment_threshold: Optional[int],
+                         manifest: Optional[RemoteManifest],
+                         walk_concurrency: int) -> int:
+        # See mirror()
+        cwd = self.getcwd()
+        # This client's channel and the walk's share the first connection
+        walk_concurrency = max(1, min(walk_concurrency, workers,
+                                      MAX_CHANNELS - 2))
+        assigned = _spread_channels(
+            workers, connections,
+            1 + (walk_concurrency if walk_concurrency > 1 else 0))
+        ssh_clients = [self.ssh_client] + [
+            self._new_ssh_client() for _ in range(max(assigned))
+        ]
+        work: 'Queue[Optional[Tuple[str, SFTPAttributes, str]]]' = Queue(
+            maxsize=workers * 2)
+        errors: List[BaseException] = []
+        # Downloaded after the other files with download_segmented()
+        large: List[Tuple[str, SFTPAttributes, str]] = []
+
+        def worker(ssh_client: SSHClient) -> int:
+            n = 0
+            downloader = None
             try:
-                if keep_modes:
-                    chmod(dest, info.st_mode)
-                if keep_times:
-                    utime(dest, (
-                        info.st_atime,
-                        info.st_mtime,
-                    ))
-            except IOError:
-                pass
+                while True:
+                    item = work.get()
+                    if item is None:
+                        return n
+                    if errors:
+                        # Keep taking items so the walk is not blocked
+                        continue
+                    try:
+                        if downloader is None:
+                            downloader = _ChannelDownloader(
+                                self, ssh_client, cwd, resume, on_write)
+                        remote_path, info, dest = item
+                        downloader.download(remote_path, info.st_size, dest)
+                        _set_attributes(dest, info, keep_modes, keep_times)
+                        n += 1
+                    except Exception as e:  # pylint: disable=broad-except
+                        errors.append(e)
+            finally:
+                if downloader:
+                    downloader.close()
+
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [
+                    executor.submit(worker, ssh_clients[i]) for i in assigned
+                ]
+                try:
+                    for _path, info in self.listdir_attr_recurse(
+                            path=path,
+                            concurrency=walk_concurrency,
+                            manifest=manifest):
+                        if errors:
+                            break
+                        if not _is_file(info):
+                            continue
+                        dest_path = path_join(dest_root, dirname(_path))
+                        dest = path_join(dest_path, basename(_path))
+                        if dest_path not in self._dircache:
+                            makedirs(dest_path, exist_ok=True)
+                            self._dircache.add(dest_path)
+                        if isdir(dest):
+                            continue
+                        if _file_size(dest) == info.st_size:
+                            _set_attributes(dest, info, keep_modes,
+                                            keep_times)
+                            continue
+                        if (segment_threshold is not None
+                                and info.st_size >= segment_threshold):
+                            large.append((_path, info, dest))
+                            continue
+                        work.put((_path, info, dest))
+                finally:
+                    for _ in futures:
+                        work.put(None)
+                n = sum(x.result() for x in futures)
+        finally:
+            for ssh_client in ssh_clients[1:]:
+                ssh_client.close()
+        if errors:
+            raise errors[0]
+        for _path, info, dest in large:
+            self.download_segmented(_path,
+                                    dest,
+                                    workers=workers,
+                                    connections=connections,
+                                    resume=resume,
+                                    on_write=on_write)
+            _set_attributes(dest, info, keep_modes, keep_times)
+            n += 1
         return n
 
+    @staticmethod
+    def _completed_segments(dest: str, state: Dict[str, Any]) -> Set[int]:
+        # Segments recorded by an interrupted download of the same file
+        part = dest + PART_SUFFIX
+        try:
+            with open(dest + SEGMENTS_SUFFIX) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            saved = None
+        count = ceil(state['size'] / state['segment_size'])
+        if (isinstance(saved, dict) and os.path.exists(part)
+                and all(saved.get(k) == v for k, v in state.items())):
+            return {
+                x
+                for x in saved.get('done', ())
+                if isinstance(x, int) and 0 <= x < count
+            }
+        # Partial file from a download that was not segmented
+        current_size = _file_size(dest)
+        if current_size is not None and 0 < current_size < state['size']:
+            os.replace(dest, part)
+            return set(range(current_size // state['segment_size']))
+        return set()
+
+    def download_segmented(self,
+                           remote_path: str,
+                           dest: str,
+                           workers: int = 4,
+                           connections: int = 1,
+                           segment_size: int = SEGMENT_SIZE,
+                           resume: bool = True,
+                           on_write: Optional[WriteHook] = None) -> None:
+        """
+        Download a single file as byte ranges read concurrently.
+
+        The file is split into segments of segment_size bytes. workers threads
+        read them with readv() over their own SFTP channels, spread over
+        connections SSH connections (more if any would have over MAX_CHANNELS
+        channels), and write them in place into
+        dest + PART_SUFFIX, which is preallocated to the size of the file.
+        dest is replaced once every segment is written.
+
+        Completed segments are recorded in dest + SEGMENTS_SUFFIX. When
+        resuming, only the missing segments are downloaded. A worker that
+        loses its connection reconnects and continues its segment.
+
+        on_write is called with every block written, not in order.
+        """
+        info = self.client.stat(remote_path)
+        size = info.st_size or 0
+        part = dest + PART_SUFFIX
+        state_path = dest + SEGMENTS_SUFFIX
+        state: Dict[str, Any] = dict(size=size,
+                                     mtime=info.st_mtime,
+                                     segment_size=segment_size)
+        done = self._completed_segments(dest, state) if resume else set()
+        missing = [
+            x for x in range(ceil(size / segment_size)) if x not in done
+        ]
+        self._log.info('Downloading %s -> %s (%d of %d segments)',
+                       remote_path, dest, len(missing),
+                       len(missing) + len(done))
+        fd = os.open(part,
+                     os.O_RDWR | os.O_CREAT | (0 if done else os.O_TRUNC),
+                     0o644)
+        try:
+            if size:
+                _preallocate(fd, size)
+            self._download_segments(remote_path, fd, dest, size,
+                                    segment_size, missing, done, state,
+                                    workers, max(1, connections), resume,
+                                    on_write)
+        finally:
+            os.close(fd)
+        os.replace(part, dest)
+        try:
+            os.remove(state_path)
+        except OSError:
+            pass
+
+    def _download_segments(self, remote_path: str, fd: int, dest: str,
+                           size: int, segment_size: int, missing: List[int],
+                           done: Set[int], state: Dict[str, Any],
+                           workers: int, connections: int, resume: bool,
+                           on_write: Optional[WriteHook]) -> None:
+        # See download_segmented()
+        if not missing:
+            return
+        workers = min(workers, len(missing))
+        connections = min(connections, workers)
+        cwd = self.getcwd()
+        state_path = dest + SEGMENTS_SUFFIX
+        work: 'Queue[int]' = Queue()
+        for index in missing:
+            work.put(index)
+        errors: List[BaseException] = []
+        lock = Lock()
+
+        def save() -> None:
+            tmp = state_path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(dict(state, done=sorted(done)), f)
+            os.replace(tmp, state_path)
+
+        def worker(ssh_client: SSHClient) -> None:
+            downloader = None
+            try:
+                while not errors:
+                    try:
+                        index = work.get_nowait()
+                    except Empty:
+                        return
+                    start = index * segment_size
+                    try:
+                        if downloader is None:
+                            downloader = _ChannelDownloader(
+                                self, ssh_client, cwd, resume, on_write)
+                        downloader.download_range(
+                            remote_path, fd, dest, start,
+                            min(size, start + segment_size))
+                        with lock:
+                            done.add(index)
+                            save()
+                    except Exception as e:  # pylint: disable=broad-except
+                        errors.append(e)
+            finally:
+                if downloader:
+                    downloader.close()
+
+        assigned = _spread_channels(workers, connections, 1)
+        ssh_clients = [self.ssh_client] + [
+            self._new_ssh_client() for _ in range(max(assigned))
+        ]
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for future in [
+                        executor.submit(worker, ssh_clients[i])
+                        for i in assigned
+                ]:
+                    future.result()
+        finally:
+            for ssh_client in ssh_clients[1:]:
+                ssh_client.close()
+        if errors:
+            raise errors[0]
+
+    def probe_transfer_settings(
+        self,
+        remote_path: str,
+        sample_size: int = PROBE_SAMPLE_SIZE,
+        candidates: Optional[Sequence[TransferSettings]] = None
+    ) -> TransferSettings:
+        """
+        Find the fastest transfer settings for the link.
+
+        The first sample_size bytes of remote_path are read with each of the
+        candidates (default: PROBE_CANDIDATES), over a new channel each. The
+        fastest settings are used for later transfers and returned.
+        """
+        cwd = self.getcwd()
+        best: Optional[Tuple[float, TransferSettings]] = None
+        for settings in candidates or PROBE_CANDIDATES:
+            try:
+                sftp = self._open_sftp(self.ssh_client, settings)
+                try:
+                    if cwd:
+                        sftp.chdir(cwd)
+                    start = time.perf_counter()
+                    with sftp.open(remote_path, 'rb') as remote:
+                        size = min(sample_size, remote.stat().st_size or 0)
+                        read = sum(
+                            len(x) for unused_offset, x in _read_range(
+                                remote, settings, 0, size))
+                    elapsed = time.perf_counter() - start
+                finally:
+                    sftp.close()
+            except (IOError, EOFError, SFTPError, SSHException) as e:
+                self._log.debug('%s: %s', settings, e)
+                continue
+            rate = read / elapsed if elapsed else 0.0
+            self._log.debug('%s: %s/s', settings, naturalsize(rate))
+            if best is None or rate > best[0]:
+                best = (rate, settings)
+        if best is None:
+            raise IOError(f'{remote_path}: no transfer settings worked')
+        self._log.info('Using %s (%s/s)', best[1], naturalsize(best[0]))
+        self.transfer_settings = best[1]
+        return best[1]
+
+    def tune(self,
+             remote_path: str,
+             cache: Optional[TransferSettingsCache] = None,
+             max_age: float = TUNING_MAX_AGE) -> TransferSettings:
+        """
+        Use the transfer settings cached for this host, or probe for them.
+
+        remote_path must be a file of at least a few megabytes. Settings found
+        by probe_transfer_settings() are saved in cache, keyed by user, host
+        and port.
+        """
+        host = self._host_key()
+        cached = cache.get(host, max_age) if cache else None
+        if cached is not None:
+            try:
+                self.transfer_settings = TransferSettings(**cached)
+                return self.transfer_settings
+            except TypeError:
+                # Saved by a different version
+                pass
+        settings = self.probe_transfer_settings(remote_path)
+        if cache:
+            cache.set(host, settings._asdict())
+        return settings
+
     def __str__(self) -> str:
         """Return string representation."""
         return f'{self.client} (wrapped by {__name__}.SFTPClient)'
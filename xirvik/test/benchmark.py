@@ -0,0 +1,233 @@
+"""
+Benchmarks for ruTorrentClient and the commands against a local
+RuTorrentServer.
+
+The server runs in the same process, so latencies measured with concurrent
+requests include time spent serving them.
+
+Run with python -m xirvik.test.benchmark --help.
+"""
+from contextlib import ExitStack, redirect_stdout
+from itertools import chain
+from typing import Any, Callable, Dict, Iterator, List, Sequence, Tuple
+from unittest.mock import patch
+import argparse
+import json
+import os
+import sys
+import time
+
+from xirvik.client import _ruTorrentClientBase, ruTorrentClient
+from xirvik.commands import delete_old, move_by_label, move_erroneous
+from xirvik.metrics import MetricsRegistry, RequestRecord
+from xirvik.test.server import RuTorrentServer
+
+__all__ = ('main', )
+
+#: Benchmark function. Takes a client and hashes to work on, returns the
+#: number of operations done.
+ClientBenchmark = Callable[[ruTorrentClient, Sequence[str]], int]
+
+
+def _list_torrents_since(client: ruTorrentClient,
+                         hashes: Sequence[str]) -> int:
+    cache = client.torrent_list_cache
+    cache.update()
+    client.set_label_to_hashes(hashes=list(hashes), label='Benchmark')
+    cache.update()
+    return 2
+
+
+def _fetch_torrents(client: ruTorrentClient, hashes: Sequence[str]) -> int:
+    return sum(1 for _ in client.fetch_torrents(hashes))
+
+
+#: Client benchmarks: name, function, whether it changes the torrents it is
+#: given (so each gets its own slice of hashes).
+CLIENT_BENCHMARKS: Sequence[Tuple[str, ClientBenchmark, bool]] = (
+    ('list_torrents', lambda c, h: len(c.list_torrents()) and 1, False),
+    ('list_torrents_dict', lambda c, h: len(c.list_torrents_dict()) and 1,
+     False),
+    ('list_torrents_since', _list_torrents_since, True),
+    ('query', lambda c, h: len(c.query(('name', 'base_path'))) and 1, False),
+    ('set_label_to_hashes', lambda c, h: c.set_label_to_hashes(
+        hashes=list(h), label='Benchmark') or 1, True),
+    ('list_files', lambda c, h: sum(len(list(c.list_files(x))) and 1
+                                    for x in h), False),
+    ('get_torrent', lambda c, h: sum(c.get_torrent(x) and 1 for x in h),
+     False),
+    ('fetch_torrents', _fetch_torrents, False),
+    ('move_torrent', lambda c, h: sum(
+        c.move_torrent(x, '/torrents/user/benchmark') or 1 for x in h), True),
+    ('stop_many', lambda c, h: len(c.stop_many(h)), True),
+    ('move_many', lambda c, h: len(c.move_many(h, '/torrents/user/moved')),
+     True),
+    ('delete_many', lambda c, h: len(c.delete_many(h)), True),
+    ('remove_many', lambda c, h: len(c.remove_many(h)), True),
+    ('add_torrent_url', lambda c, h: sum(
+        c.add_torrent_url(f'http://example.invalid/{x}') or 1 for x in h),
+     True),
+)
+#: Command benchmarks: name, main function, extra arguments.
+COMMAND_BENCHMARKS: Sequence[Tuple[str, Callable[[], int], List[str]]] = (
+    ('delete-old', delete_old.main, ['--label', 'Seeding', '--ignore-date']),
+    ('move-by-label', move_by_label.main, []),
+    ('move-erroneous', move_erroneous.main, []),
+)
+
+
+def _server(args: argparse.Namespace) -> RuTorrentServer:
+    return RuTorrentServer(torrent_count=args.torrents,
+                           latency=args.latency,
+                           jitter=args.jitter,
+                           failure_rate=args.failure_rate,
+                           seed=args.seed)
+
+
+class _Recorder:
+    # Metrics for all requests made during a benchmark
+    def __init__(self) -> None:
+        self.metrics = MetricsRegistry()
+
+    def __call__(self, record: RequestRecord) -> None:
+        self.metrics(record._replace(endpoint='', mode=''))
+
+    def result(self, name: str, operations: int, elapsed: float,
+               requests: int) -> Dict[str, Any]:
+        summary = (self.metrics.summary() or [
+            dict(latency_p50=0.0, latency_p95=0.0, retries=0, errors=0)
+        ])[0]
+        return dict(
+            name=name,
+            operations=operations,
+            seconds=elapsed,
+            operations_per_second=operations / elapsed if elapsed else 0.0,
+            requests=requests,
+            requests_per_second=requests / elapsed if elapsed else 0.0,
+            latency_p50=summary['latency_p50'],
+            latency_p95=summary['latency_p95'],
+            retries=summary['retries'],
+            errors=summary['errors'])
+
+
+def run_client_benchmarks(
+        args: argparse.Namespace) -> Iterator[Dict[str, Any]]:
+    """Run CLIENT_BENCHMARKS and yield a result per benchmark."""
+    with _server(args) as server:
+        hashes = list(server.torrents)
+        offset = 0
+        for name, func, mutates in CLIENT_BENCHMARKS:
+            if args.only and name not in args.only:
+                continue
+            if mutates:
+                subset = hashes[offset:offset + args.operations]
+                offset += args.operations
+            else:
+                subset = hashes[-args.operations:]
+            recorder = _Recorder()
+            client = server.client(metrics_hook=recorder,
+                                   max_retries=args.max_retries,
+                                   pool_size=16)
+            before = sum(server.requests.values())
+            start = time.perf_counter()
+            operations = func(client, subset)
+            elapsed = time.perf_counter() - start
+            yield recorder.result(name, operations, elapsed,
+                                  sum(server.requests.values()) - before)
+
+
+def run_command_benchmarks(
+        args: argparse.Namespace) -> Iterator[Dict[str, Any]]:
+    """Run COMMAND_BENCHMARKS, each against a new server."""
+    for name, main, extra in COMMAND_BENCHMARKS:
+        if args.only and name not in args.only:
+            continue
+        with _server(args) as server:
+            argv = [
+                name, '-u', server.username, '-p', server.password,
+                '--rate',
+                str(args.rate), '--max-retries',
+                str(args.max_retries), *extra, 'localhost'
+            ]
+            recorder = _Recorder()
+            with ExitStack() as stack:
+                # Not closed: command loggers keep a reference to it
+                stack.enter_context(
+                    redirect_stdout(open(os.devnull, 'w')))
+                stack.enter_context(patch.object(sys, 'argv', argv))
+                stack.enter_context(
+                    patch.object(_ruTorrentClientBase, 'http_prefix',
+                                 server.http_prefix))
+                stack.enter_context(
+                    patch.object(sys.modules[main.__module__],
+                                 'metrics_from_args',
+                                 return_value=recorder))
+                start = time.perf_counter()
+                main()
+                elapsed = time.perf_counter() - start
+            requests = sum(server.requests.values())
+            yield recorder.result(name, requests, elapsed, requests)
+
+
+def _format(result: Dict[str, Any]) -> str:
+    return ('{name:<22} {operations:>7} ops {seconds:>8.3f}s '
+            '{operations_per_second:>10.1f} ops/s {requests:>7} req '
+            '{requests_per_second:>9.1f} req/s p50 {p50:>7.1f}ms '
+            'p95 {p95:>7.1f}ms {retries:>4} retries {errors:>4} errors'.format(
+                p50=result['latency_p50'] * 1000,
+                p95=result['latency_p95'] * 1000,
+                **result))
+
+
+def main() -> int:
+    """Entry point."""
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('-n',
+                        '--torrents',
+                        type=int,
+                        default=10000,
+                        help='Number of synthetic torrents')
+    parser.add_argument('-o',
+                        '--operations',
+                        type=int,
+                        default=100,
+                        help='Hashes used by each per-torrent benchmark')
+    parser.add_argument('--latency',
+                        type=float,
+                        default=0.002,
+                        help='Server latency in seconds')
+    parser.add_argument('--jitter',
+                        type=float,
+                        default=0.0,
+                        help='Random extra server latency in seconds')
+    parser.add_argument('--failure-rate',
+                        type=float,
+                        default=0.0,
+                        help='Fraction of requests answered with HTTP 503')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-retries', type=int, default=3)
+    parser.add_argument('--rate',
+                        type=float,
+                        default=0,
+                        help='--rate passed to commands (0 disables)')
+    parser.add_argument('--only',
+                        nargs='+',
+                        help='Names of benchmarks to run')
+    parser.add_argument('--no-commands',
+                        action='store_true',
+                        help='Only benchmark client methods')
+    parser.add_argument('--json',
+                        action='store_true',
+                        help='Print results as JSON lines')
+    args = parser.parse_args()
+    results = run_client_benchmarks(args)
+    if not args.no_commands:
+        results = chain(results, run_command_benchmarks(args))
+    for result in results:
+        print(json.dumps(result) if args.json else _format(result),
+              flush=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,450 @@
+"""
+Local stand-in for a ruTorrent/rTorrent server.
+
+Implements enough of ruTorrent's plugins and rTorrent's XML-RPC interface for
+ruTorrentClient and the commands to run against it, with synthetic torrents,
+injected latency and injected failures.
+
+Example use:
+    with RuTorrentServer(torrent_count=10000, latency=0.005) as server:
+        client = server.client()
+        client.list_torrents_dict()
+"""
+from base64 import b64encode
+from hashlib import sha1
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from random import Random
+from threading import Lock, Thread
+from typing import (Any, Callable, Dict, List, Mapping, Optional, Sequence,
+                    Tuple, Union)
+from urllib.parse import parse_qs, urlsplit
+import json
+import sys
+import time
+import xmlrpc.client as xmlrpc
+
+import benc
+
+from xirvik.client import _FIELD_COMMANDS, TORRENT_FIELDS, ruTorrentClient
+
+__all__ = ('RuTorrentServer', )
+
+MULTIRPC_PATH = '/rtorrent/plugins/multirpc/action.php'
+DATADIR_PATH = '/rtorrent/plugins/datadir/action.php'
+SOURCE_PATH = '/rtorrent/plugins/source/action.php'
+ADD_TORRENT_PATH = '/rtorrent/php/addtorrent.php'
+#: Labels assigned to synthetic torrents.
+LABELS = ('', 'Movies', 'TV', 'Music', 'Seeding')
+#: Messages assigned to synthetic torrents (mostly empty).
+MESSAGES = ('', '', '', '', '', '', '', '', 'Unregistered torrent',
+            'Tracker: [Couldn\'t connect to server]')
+
+_STRING_FIELDS = frozenset(
+    ('name', 'custom1', 'custom2', 'base_path', 'message'))
+_COMMAND_FIELDS = {f'{v}=': k for k, v in _FIELD_COMMANDS.items()}
+_PIECE_LENGTH = 262144
+
+
+class _Torrent:
+    def __init__(self, hash_: str, values: Dict[str, str]):
+        self.hash = hash_
+        self.values = values
+        self.cid = 0
+
+    def row(self) -> List[str]:
+        return [self.values[x] for x in TORRENT_FIELDS]
+
+    def xmlrpc_value(self, field: str) -> Union[int, str]:
+        value = self.values[field]
+        return value if field in _STRING_FIELDS else int(value)
+
+    def metainfo(self) -> bytes:
+        size = int(self.values['size_bytes'])
+        pieces = -(-size // _PIECE_LENGTH)
+        return benc.encode({
+            b'announce': b'http://tracker.invalid/announce',
+            b'info': {
+                b'length': size,
+                b'name': self.values['name'].encode('utf-8'),
+                b'piece length': _PIECE_LENGTH,
+                b'pieces': sha1(self.hash.encode()).digest() * pieces,
+            },
+        })
+
+
+class _Marshaller(xmlrpc.Marshaller):
+    # rTorrent sends 64-bit integers as <i8>, which Python can read but not
+    # write
+    dispatch = dict(xmlrpc.Marshaller.dispatch)
+
+    def dump_long(self, value: int, write: Callable[[str], Any]) -> None:
+        if xmlrpc.MININT <= value <= xmlrpc.MAXINT:
+            write(f'<value><int>{value}</int></value>\n')
+        else:
+            write(f'<value><i8>{value}</i8></value>\n')
+
+    dispatch[int] = dump_long
+
+
+class _HTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request: Any, client_address: Any) -> None:
+        # Clients may close connections without reading a response (for
+        # example after an error status with stream=True)
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class RuTorrentServer:
+    """
+    Threaded HTTP server with synthetic torrents.
+
+    latency seconds (plus up to jitter seconds) are slept before each response.
+    A failure_rate fraction of requests get an HTTP 503 response. seed makes
+    the torrents, jitter and failures reproducible.
+
+    requests counts handled requests per (path, mode) for reporting.
+    """
+    def __init__(self,
+                 torrent_count: int = 1000,
+                 latency: float = 0.0,
+                 jitter: float = 0.0,
+                 failure_rate: float = 0.0,
+                 seed: int = 0,
+                 username: str = 'user',
+                 password: str = 'password'):
+        """Generate torrent_count torrents. The server is not started."""
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.username = username
+        self.password = password
+        self.requests: Dict[Tuple[str, str], int] = {}
+        self._random = Random(seed)
+        self._lock = Lock()
+        self._cid = 1
+        self._deleted: Dict[str, int] = {}
+        self.torrents: Dict[str, _Torrent] = {}
+        for i in range(torrent_count):
+            self._add(f'synthetic-torrent-{i:06d}')
+        self._httpd: Optional[_HTTPServer] = None
+        self._thread: Optional[Thread] = None
+
+    def _add(self, name: str) -> _Torrent:
+        r = self._random
+        hash_ = sha1(name.encode()).hexdigest().upper()
+        size = r.randrange(1, 8 * 1024**3)
+        chunks = -(-size // _PIECE_LENGTH)
+        left = 0 if r.random() < 0.8 else r.randrange(size)
+        label = r.choice(LABELS)
+        now = int(time.time())
+        values = dict(
+            is_open='1',
+            is_hash_checking='0',
+            is_hash_checked='1',
+            state='1',
+            name=name,
+            size_bytes=str(size),
+            completed_chunks=str(chunks - left // _PIECE_LENGTH),
+            size_chunks=str(chunks),
+            bytes_done=str(size - left),
+            up_total=str(r.randrange(4 * size)),
+            ratio=str(r.randrange(4000)),
+            up_rate=str(r.randrange(1024**2)),
+            down_rate='0' if not left else str(r.randrange(1024**2)),
+            chunk_size=str(_PIECE_LENGTH),
+            custom1=label,
+            peers_accounted=str(r.randrange(50)),
+            peers_not_connected=str(r.randrange(50)),
+            peers_connected=str(r.randrange(50)),
+            peers_complete=str(r.randrange(50)),
+            left_bytes=str(left),
+            priority='2',
+            state_changed=str(now - r.randrange(60 * 86400)),
+            skip_total='0',
+            hashing='0',
+            chunks_hashed='0',
+            base_path=(f'/torrents/{self.username}/'
+                       f'{"_completed" if not left else "downloads"}/'
+                       f'{name}'),
+            creation_date=str(now - r.randrange(365 * 86400)),
+            tracker_focus='0',
+            is_active='1',
+            message=r.choice(MESSAGES),
+            custom2='',
+            free_diskspace=str(1024**4),
+            is_private='1',
+            is_multi_file='0',
+        )
+        t = self.torrents[hash_] = _Torrent(hash_, values)
+        self._touch(t)
+        return t
+
+    def _touch(self, t: _Torrent) -> None:
+        self._cid += 1
+        t.cid = self._cid
+
+    @property
+    def http_prefix(self) -> str:
+        """Return the base URI of the server once started."""
+        assert self._httpd is not None, 'Server is not started'
+        host, port = self._httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def client(self, **kwargs: Any) -> ruTorrentClient:
+        """Return a ruTorrentClient that talks to this server."""
+        client = ruTorrentClient('localhost', self.username, self.password,
+                                 **kwargs)
+        client.http_prefix = self.http_prefix
+        return client
+
+    def start(self) -> 'RuTorrentServer':
+        """Start serving on a free port in a background thread."""
+        self._httpd = _HTTPServer(('127.0.0.1', 0), _make_handler(self))
+        self._thread = Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """Stop serving."""
+        if self._httpd:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+
+    def __enter__(self) -> 'RuTorrentServer':
+        """Start the server."""
+        return self.start()
+
+    def __exit__(self, *args: Any) -> None:
+        """Stop the server."""
+        self.stop()
+
+    # Request handling. Each returns (status, content type, body)
+
+    def _delay_and_fail(self) -> bool:
+        with self._lock:
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            fail = self._random.random() < self.failure_rate
+        if delay:
+            time.sleep(delay)
+        return fail
+
+    def _count(self, path: str, mode: str) -> None:
+        with self._lock:
+            key = (path, mode)
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+    def _handle_list(self, form: Mapping[str, List[str]]) -> Any:
+        with self._lock:
+            since = int(form.get('cid', ['0'])[0])
+            changes: Dict[str, Any] = {
+                hash_: t.row()
+                for hash_, t in self.torrents.items() if t.cid > since
+            }
+            if since:
+                changes.update((hash_, False)
+                               for hash_, cid in self._deleted.items()
+                               if cid > since)
+            return dict(t=changes or [], cid=self._cid)
+
+    def _handle_setlabel(self, form: Mapping[str, List[str]]) -> Any:
+        hashes = form.get('hash', [])
+        labels = form.get('v', [])
+        ret = []
+        with self._lock:
+            for hash_, label in zip(hashes, labels):
+                t = self.torrents.get(hash_)
+                if not t:
+                    continue
+                t.values['custom1'] = label
+                self._touch(t)
+                ret.append(label)
+        return ret
+
+    def _handle_fls(self, form: Mapping[str, List[str]]) -> Any:
+        t = self.torrents.get(form.get('hash', [''])[0])
+        if not t:
+            return []
+        return [[
+            t.values['name'], t.values['size_chunks'],
+            t.values['completed_chunks'], t.values['size_bytes'], '1', '0',
+            '0'
+        ]]
+
+    def _handle_state(self, form: Mapping[str, List[str]],
+                      mode: str) -> Any:
+        with self._lock:
+            for hash_ in form.get('hash', []):
+                t = self.torrents.get(hash_)
+                if not t:
+                    continue
+                if mode == 'remove':
+                    self._erase(hash_)
+                    continue
+                t.values.update(state='0', is_active='0')
+                self._touch(t)
+        return []
+
+    def _erase(self, hash_: str) -> bool:
+        if self.torrents.pop(hash_, None) is None:
+            return False
+        self._cid += 1
+        self._deleted[hash_] = self._cid
+        return True
+
+    def _handle_multirpc(self, body: bytes) -> Tuple[int, str, bytes]:
+        form = parse_qs(body.decode('utf-8'))
+        mode = form.get('mode', [''])[0]
+        self._count(MULTIRPC_PATH, mode)
+        if mode == 'list':
+            ret = self._handle_list(form)
+        elif mode == 'setlabel':
+            ret = self._handle_setlabel(form)
+        elif mode == 'fls':
+            ret = self._handle_fls(form)
+        elif mode in ('stop', 'remove', 'start'):
+            ret = self._handle_state(form, mode)
+        else:
+            return 400, 'text/plain', b'Unknown mode'
+        return 200, 'application/json', json.dumps(ret).encode()
+
+    def _call(self, method: str, params: Sequence[Any]) -> Any:
+        if method == 'system.multicall':
+            ret: List[Any] = []
+            for call in params[0]:
+                try:
+                    ret.append([self._call(call['methodName'],
+                                           call['params'])])
+                except xmlrpc.Fault as e:
+                    ret.append(
+                        dict(faultCode=e.faultCode,
+                             faultString=e.faultString))
+            return ret
+        if method == 'd.multicall2':
+            _, _, *commands = params
+            fields = [
+                None if x == 'd.hash=' else _COMMAND_FIELDS[x]
+                for x in commands
+            ]
+            with self._lock:
+                return [[
+                    t.hash if x is None else t.xmlrpc_value(x) for x in fields
+                ] for t in self.torrents.values()]
+        with self._lock:
+            t = self.torrents.get(params[0]) if params else None
+            if not t:
+                raise xmlrpc.Fault(-501, 'Could not find info-hash.')
+            if method == 'd.erase':
+                self._erase(t.hash)
+            elif method == 'd.custom5.set':
+                t.values['custom5'] = params[1]
+            elif method == 'd.custom1.set':
+                t.values['custom1'] = params[1]
+                self._touch(t)
+            elif method != 'd.delete_tied':
+                raise xmlrpc.Fault(-506, f'Method \'{method}\' not defined')
+        return 0
+
+    def _handle_xmlrpc(self, body: bytes) -> Tuple[int, str, bytes]:
+        params, method = xmlrpc.loads(body)
+        self._count(MULTIRPC_PATH, method)
+        try:
+            response = ('<?xml version=\'1.0\'?>\n<methodResponse>\n' +
+                        _Marshaller().dumps((self._call(method, params), )) +
+                        '</methodResponse>\n')
+        except xmlrpc.Fault as e:
+            response = xmlrpc.dumps(e, methodresponse=True)
+        return 200, 'text/xml', response.encode('utf-8')
+
+    def _handle_datadir(self, body: bytes) -> Tuple[int, str, bytes]:
+        self._count(DATADIR_PATH, '')
+        form = parse_qs(body.decode('utf-8'))
+        errors = []
+        with self._lock:
+            t = self.torrents.get(form.get('hash', [''])[0])
+            if not t or 'datadir' not in form:
+                errors.append('Invalid hash or directory')
+            else:
+                t.values['base_path'] = '{}/{}'.format(
+                    form['datadir'][0].rstrip('/'), t.values['name'])
+                self._touch(t)
+        return 200, 'application/json', json.dumps(dict(
+            errors=errors)).encode()
+
+    def _handle_source(self, query: str) -> Tuple[int, str, bytes]:
+        self._count(SOURCE_PATH, '')
+        t = self.torrents.get(parse_qs(query).get('hash', [''])[0])
+        if not t:
+            return 404, 'text/plain', b'Not found'
+        return 200, 'application/x-bittorrent', t.metainfo()
+
+    def _handle_add_torrent(self, body: bytes) -> Tuple[int, str, bytes]:
+        self._count(ADD_TORRENT_PATH, '')
+        with self._lock:
+            self._add(f'added-torrent-{sha1(body).hexdigest()}')
+        return 200, 'text/plain', b'Success'
+
+
+def _make_handler(server: RuTorrentServer) -> type:
+    expected_auth = 'Basic ' + b64encode(
+        f'{server.username}:{server.password}'.encode()).decode()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # Send headers and body in one segment without waiting for ACKs
+        disable_nagle_algorithm = True
+        wbufsize = -1
+
+        def log_message(self, format: str, *args: Any) -> None:
+            pass
+
+        def _respond(self, status: int, content_type: str, body: bytes,
+                     headers: Optional[Mapping[str, str]] = None) -> None:
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _handle(self, body: bytes) -> None:
+            url = urlsplit(self.path)
+            if server._delay_and_fail():
+                self._respond(503, 'text/plain', b'Service unavailable')
+                return
+            if self.headers.get('Authorization') != expected_auth:
+                self._respond(401, 'text/plain', b'Unauthorized',
+                              {'WWW-Authenticate': 'Basic realm="test"'})
+                return
+            headers = {}
+            if url.path == MULTIRPC_PATH:
+                if self.headers.get('Content-Type', '').startswith('text/xml'):
+                    response = server._handle_xmlrpc(body)
+                else:
+                    response = server._handle_multirpc(body)
+            elif url.path == DATADIR_PATH:
+                response = server._handle_datadir(body)
+            elif url.path == SOURCE_PATH:
+                response = server._handle_source(url.query)
+                headers['Content-Disposition'] = (
+                    'attachment; filename="{}.torrent"'.format(
+                        parse_qs(url.query).get('hash', [''])[0]))
+            elif url.path == ADD_TORRENT_PATH:
+                response = server._handle_add_torrent(body)
+            else:
+                response = 404, 'text/plain', b'Not found'
+            self._respond(*response, headers=headers)
+
+        def do_GET(self) -> None:
+            """Handle GET."""
+            self._handle(b'')
+
+        def do_POST(self) -> None:
+            """Handle POST."""
+            length = int(self.headers.get('Content-Length', 0))
+            self._handle(self.rfile.read(length))
+
+    return Handler
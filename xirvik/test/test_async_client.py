@@ -0,0 +1,146 @@
+from typing import Any, Awaitable, Callable, Dict, List
+import asyncio
+import unittest
+import xmlrpc.client as xmlrpc
+
+from aiohttp import web
+
+from xirvik.async_client import AsyncRuTorrentClient
+from xirvik.client import UnexpectedruTorrentError
+
+Handler = Callable[[web.Request], Awaitable[web.StreamResponse]]
+
+
+def run_with_server(routes: Dict[str, Handler],
+                    test: Callable[[AsyncRuTorrentClient], Awaitable[Any]],
+                    **kwargs: Any) -> Any:
+    async def main() -> Any:
+        app = web.Application()
+        for path, handler in routes.items():
+            app.router.add_route('*', path, handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]  # type: ignore
+        try:
+            async with AsyncRuTorrentClient('hostname-test.com', 'a', 'b',
+                                            **kwargs) as client:
+                client.http_prefix = f'http://127.0.0.1:{port}'
+                return await test(client)
+        finally:
+            await runner.cleanup()
+
+    return asyncio.run(main())
+
+
+MULTIRPC = '/rtorrent/plugins/multirpc/action.php'
+
+
+class TestAsyncRuTorrentClient(unittest.TestCase):
+    def test_list_torrents_dict(self):
+        posts: List[Dict[str, str]] = []
+
+        async def handler(request: web.Request) -> web.Response:
+            posts.append(dict(await request.post()))
+            return web.json_response(
+                dict(t={'hash1': ['1', '0', '1', '1', 'name', '1024']},
+                     cid=1))
+
+        torrents = run_with_server({MULTIRPC: handler},
+                                   lambda c: c.list_torrents_dict())
+        self.assertEqual('list', posts[0]['mode'])
+        self.assertIs(True, torrents['hash1']['is_open'])
+        self.assertEqual(1024, torrents['hash1']['size_bytes'])
+
+    def test_list_torrents_bad_status(self):
+        async def handler(request: web.Request) -> web.Response:
+            return web.Response(status=400)
+
+        with self.assertRaises(Exception):
+            run_with_server({MULTIRPC: handler}, lambda c: c.list_torrents())
+
+    def test_concurrent_stop(self):
+        stopped: List[str] = []
+        in_flight = [0, 0]
+
+        async def handler(request: web.Request) -> web.Response:
+            data = await request.post()
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight)
+            await asyncio.sleep(0.01)
+            in_flight[0] -= 1
+            stopped.append(str(data['hash']))
+            return web.json_response([])
+
+        hashes = ['hash{}'.format(i) for i in range(20)]
+        results = run_with_server({MULTIRPC: handler},
+                                  lambda c: c.gather(c.stop, hashes),
+                                  max_in_flight=4)
+        self.assertEqual([None] * 20, results)
+        self.assertEqual(sorted(hashes), sorted(stopped))
+        self.assertLessEqual(in_flight[1], 4)
+
+    def test_timeout_excludes_queueing(self):
+        async def handler(request: web.Request) -> web.Response:
+            await asyncio.sleep(0.05)
+            return web.json_response([])
+
+        hashes = ['hash{}'.format(i) for i in range(20)]
+        results = run_with_server({MULTIRPC: handler},
+                                  lambda c: c.gather(c.stop, hashes),
+                                  max_in_flight=2,
+                                  max_retries=0,
+                                  timeout=0.2)
+        self.assertEqual([None] * 20, results)
+
+    def test_get_torrent(self):
+        async def handler(request: web.Request) -> web.Response:
+            self.assertEqual('hash1', request.query['hash'])
+            return web.Response(
+                body=b'd4:infode',
+                headers={
+                    'content-disposition': 'attachment; filename=test.torrent'
+                })
+
+        content, fn = run_with_server(
+            {'/rtorrent/plugins/source/action.php': handler},
+            lambda c: c.get_torrent('hash1'))
+        self.assertEqual(b'd4:infode', content)
+        self.assertEqual('test.torrent', fn)
+
+    def test_move_torrent(self):
+        async def handler(request: web.Request) -> web.Response:
+            return web.json_response({'errors': ['some error']})
+
+        with self.assertRaises(UnexpectedruTorrentError):
+            run_with_server({'/rtorrent/plugins/datadir/action.php': handler},
+                            lambda c: c.move_torrent('hash1', 'newplace'))
+
+    def test_list_files(self):
+        async def handler(request: web.Request) -> web.Response:
+            return web.json_response(
+                [['name of file', '14', '13', '8192', '1', '0', '0']])
+
+        files = run_with_server({MULTIRPC: handler},
+                                lambda c: c.list_files('hash1'))
+        self.assertEqual(['name of file', 14, 13, 8192, 1, 0, 0], files[0])
+
+    def test_delete_fault(self):
+        async def handler(request: web.Request) -> web.Response:
+            params, method = xmlrpc.loads(await request.read())
+            self.assertEqual('system.multicall', method)
+            self.assertEqual('d.erase', params[0][2]['methodName'])
+            return web.Response(body=xmlrpc.dumps(
+                ([[0], [0], {
+                    'faultCode': -501,
+                    'faultString': 'Could not find info-hash.'
+                }], ),
+                methodresponse=True))
+
+        with self.assertRaises(xmlrpc.Fault):
+            run_with_server({MULTIRPC: handler}, lambda c: c.delete('hash1'))
+
+
+if __name__ == '__main__':
+    unittest.main()
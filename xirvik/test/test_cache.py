@@ -0,0 +1,201 @@
+from os import listdir, remove as rm, scandir, utime
+from os.path import join as path_join
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest.mock import patch
+import time
+import unittest
+
+from xirvik.cache import (ManifestFile, RemoteManifest, TorrentFileCache,
+                          TransferSettingsCache, VerifiedStateStore)
+
+
+class _Entries(list):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class TestTorrentFileCache(unittest.TestCase):
+    def setUp(self):
+        self.path = mkdtemp(prefix='test-torrent-file-cache-')
+
+    def tearDown(self):
+        rmtree(self.path)
+
+    def test_get_put(self):
+        cache = TorrentFileCache(self.path)
+        self.assertIsNone(cache.get('abcdef'))
+        self.assertNotIn('abcdef', cache)
+
+        cache.put('abcdef', b'd4:infode', 'name.torrent')
+        self.assertIn('abcdef', cache)
+        self.assertIn('ABCDEF', cache)
+        self.assertEqual((b'd4:infode', 'name.torrent'), cache.get('ABCDEF'))
+        self.assertEqual(['ABCDEF.name', 'ABCDEF.torrent'],
+                         sorted(listdir(self.path)))
+
+    def test_invalid_hash(self):
+        cache = TorrentFileCache(self.path)
+        with self.assertRaises(ValueError):
+            cache.put('../abc', b'', 'name.torrent')
+
+    def test_evict_least_recently_used(self):
+        cache = TorrentFileCache(self.path, max_size=25)
+        cache.put('aaaa', b'0123456789', 'a.torrent')
+        cache.put('bbbb', b'0123456789', 'b.torrent')
+        utime(path_join(self.path, 'AAAA.torrent'), (1, 1))
+        utime(path_join(self.path, 'BBBB.torrent'), (2, 2))
+        # Reading marks an entry as recently used
+        cache.get('aaaa')
+
+        cache.put('cccc', b'0123456789', 'c.torrent')
+        self.assertIn('aaaa', cache)
+        self.assertNotIn('bbbb', cache)
+        self.assertIn('cccc', cache)
+        self.assertNotIn('BBBB.name', listdir(self.path))
+
+    def test_evict_entry_removed_concurrently(self):
+        cache = TorrentFileCache(self.path, max_size=25)
+        cache.put('aaaa', b'0123456789', 'a.torrent')
+        cache.put('bbbb', b'0123456789', 'b.torrent')
+
+        def racing_scandir(path):
+            # Another process evicts AAAA after the directory is listed
+            entries = list(scandir(path))
+            rm(path_join(self.path, 'AAAA.torrent'))
+            return _Entries(entries)
+
+        with patch('xirvik.cache.scandir', racing_scandir):
+            cache.put('cccc', b'0123456789', 'c.torrent')
+        self.assertNotIn('aaaa', cache)
+        self.assertIn('bbbb', cache)
+        self.assertIn('cccc', cache)
+
+
+class TestVerifiedStateStore(unittest.TestCase):
+    def setUp(self):
+        self.path = mkdtemp(prefix='test-verified-state-store-')
+        self.db = path_join(self.path, 'sub', 'verified.sqlite3')
+        self.files = [path_join(self.path, x) for x in ('a', 'b')]
+        for x in self.files:
+            with open(x, 'wb') as f:
+                f.write(b'data')
+
+    def tearDown(self):
+        rmtree(self.path)
+
+    def test_mark_verified(self):
+        store = VerifiedStateStore(self.db)
+        states = store.file_states(self.files)
+        self.assertFalse(store.is_verified('abcd', states))
+        self.assertIsNone(store.verified_at('abcd'))
+        store.mark_verified('abcd', states)
+        self.assertTrue(store.is_verified('ABCD', states))
+        self.assertIsNotNone(store.verified_at('abcd'))
+        self.assertFalse(store.is_verified('abcd', None))
+        store.close()
+
+        # Persists and notices changes
+        store = VerifiedStateStore(self.db)
+        self.assertTrue(
+            store.is_verified('abcd', store.file_states(self.files)))
+        utime(self.files[1], (1, 1))
+        self.assertFalse(
+            store.is_verified('abcd', store.file_states(self.files)))
+        store.forget('abcd')
+        self.assertIsNone(store.verified_at('abcd'))
+        store.close()
+
+    def test_file_states_missing(self):
+        self.assertIsNone(
+            VerifiedStateStore.file_states(self.files +
+                                           [path_join(self.path, 'c')]))
+
+
+class TestRemoteManifest(unittest.TestCase):
+    def setUp(self):
+        self.path = mkdtemp(prefix='test-remote-manifest-')
+        self.db = path_join(self.path, 'sub', 'manifest.sqlite3')
+
+    def tearDown(self):
+        rmtree(self.path)
+
+    def test_update(self):
+        def f(path):
+            return ManifestFile(path, 1, 2, 3, 0o100644)
+
+        manifest = RemoteManifest(self.db)
+        self.assertIsNone(manifest.dir_mtime('host', '/a'))
+        manifest.update('host', [
+            ('/a', 1, [f('/a/x')], ['/a/b', '/a/b2']),
+            ('/a/b', 2, [f('/a/b/y'), f('/a/b/z')], ['/a/b/c']),
+            ('/a/b/c', None, [f('/a/b/c/w')], []),
+            ('/a/b2', 4, [f('/a/b2/v')], []),
+        ])
+        manifest.update('other', [('/a', 5, [f('/a/u')], [])])
+        manifest.close()
+
+        manifest = RemoteManifest(self.db)
+        self.assertEqual(2, manifest.dir_mtime('host', '/a/b'))
+        self.assertIsNone(manifest.dir_mtime('host', '/a/b/c'))
+        self.assertEqual(([f('/a/b/y'), f('/a/b/z')], ['/a/b/c']),
+                         manifest.listing('host', '/a/b'))
+        self.assertEqual(([f('/a/x')], ['/a/b', '/a/b2']),
+                         manifest.listing('host', '/a'))
+
+        # /a/b is gone
+        manifest.update('host', [('/a', 6, [], ['/a/b2'])])
+        self.assertEqual(([], ['/a/b2']), manifest.listing('host', '/a'))
+        self.assertEqual(([], []), manifest.listing('host', '/a/b'))
+        self.assertIsNone(manifest.dir_mtime('host', '/a/b'))
+        self.assertEqual(6, manifest.dir_mtime('host', '/a'))
+        self.assertEqual(4, manifest.dir_mtime('host', '/a/b2'))
+
+        manifest.forget('host')
+        self.assertIsNone(manifest.dir_mtime('host', '/a'))
+        self.assertEqual(5, manifest.dir_mtime('other', '/a'))
+        manifest.close()
+
+    def test_max_age(self):
+        manifest = RemoteManifest(self.db, max_age=60)
+        manifest.update('host', [('/a', 1, [], [])])
+        manifest.update('host', [('/b', 1, [], [])], time.time() - 120)
+        self.assertEqual(1, manifest.dir_mtime('host', '/a'))
+        self.assertIsNone(manifest.dir_mtime('host', '/b'))
+        manifest.close()
+
+
+class TestTransferSettingsCache(unittest.TestCase):
+    def setUp(self):
+        self.path = mkdtemp(prefix='test-transfer-settings-cache-')
+        self.file = path_join(self.path, 'sub', 'transfer.json')
+
+    def tearDown(self):
+        rmtree(self.path)
+
+    def test_get_set(self):
+        cache = TransferSettingsCache(self.file)
+        self.assertIsNone(cache.get('host'))
+        cache.set('host', dict(max_requests=64))
+        cache.set('other', dict(max_requests=1))
+        cache = TransferSettingsCache(self.file)
+        self.assertEqual(dict(max_requests=64), cache.get('host', 60))
+        self.assertIsNone(cache.get('host', -1))
+        self.assertEqual(['transfer.json'],
+                         listdir(path_join(self.path, 'sub')))
+
+    def test_corrupt(self):
+        cache = TransferSettingsCache(self.file)
+        cache.set('host', dict(max_requests=64))
+        with open(self.file, 'w') as f:
+            f.write('[')
+        self.assertIsNone(cache.get('host'))
+        cache.set('host', dict(max_requests=1))
+        self.assertEqual(dict(max_requests=1), cache.get('host'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,16 @@
+from hashlib import sha1
 from os import close as close_fd, remove as rm, write as write_fd
-from tempfile import mkstemp
+from shutil import rmtree
+from tempfile import mkdtemp, mkstemp
 from typing import List, Optional
+from unittest.mock import MagicMock
 import unittest
+import xmlrpc.client as xmlrpc
 
 from requests.exceptions import HTTPError
 import requests_mock
 
+from xirvik.cache import TorrentFileCache
 from xirvik.client import (TORRENT_FILE_DOWNLOAD_STRATEGY_NORMAL,
                            TORRENT_FILE_PRIORITY_NORMAL,
                            UnexpectedruTorrentError, ruTorrentClient)
@@ -90,6 +95,77 @@ class TestRuTorrentClient(unittest.TestCase):
         self.assertEqual(client.list_torrents()['hash here'][4],
                          'name of torrent?')
 
+    @requests_mock.Mocker()
+    def test_list_torrents_dict(self, m: requests_mock.Mocker):
+        client = ruTorrentClient('hostname-test.com', 'a', 'b')
+        row = [
+            '1', '0', '1', '1', 'name.of.torrent', '250952849', '958', '958',
+            '250952849', '357999402', '1426', '0', '0', '262144', '2020',
+            '0', '0', '0', '0', '0', '2', '1600000000', '0', '0', '0',
+            '/torrents/a/name.of.torrent', '0', '0', '1', '', '.5',
+            '1000000000', '1', '0', '1600000001'
+        ]
+        m.post(client.multirpc_action_uri,
+               json=dict(
+                   t={
+                       'hash1': row,
+                       'hash2': row[:5],
+                   },
+                   cid=92385,
+               ))
+
+        torrents = client.list_torrents_dict()
+        self.assertEqual(['hash1', 'hash2'], list(torrents))
+        info = torrents['hash1']
+        self.assertEqual(34, len(info))
+        self.assertIs(True, info['is_open'])
+        self.assertIs(False, info['is_hash_checking'])
+        self.assertEqual(1, info['state'])
+        self.assertEqual('name.of.torrent', info['name'])
+        self.assertEqual(250952849, info['size_bytes'])
+        self.assertEqual(1.426, info['ratio'])
+        # Labels that look like numbers are converted
+        self.assertEqual(2020, info['custom1'])
+        self.assertEqual(1600000000, info['state_changed'].timestamp())
+        self.assertIsNone(info['creation_date'])
+        self.assertEqual('', info['message'])
+        self.assertEqual(0.5, info['custom2'])
+        self.assertEqual(5, len(torrents['hash2']))
+        self.assertEqual('name.of.torrent', torrents['hash2']['name'])
+
+    @requests_mock.Mocker()
+    def test_torrent_list_cache(self, m: requests_mock.Mocker):
+        client = ruTorrentClient('hostname-test.com', 'a', 'b')
+        m.post(client.multirpc_action_uri, [
+            dict(json=dict(t={
+                'hash1': ['1', '0', '1', '1', 'name1'],
+                'hash2': ['1', '0', '1', '1', 'name2'],
+            },
+                           cid=1)),
+            dict(json=dict(t={
+                'hash1': False,
+                'hash2': ['1', '0', '1', '0', 'name2'],
+                'hash3': ['1', '0', '1', '1', 'name3'],
+            },
+                           cid=2)),
+            dict(json=dict(t=[], cid=2)),
+        ])
+        cache = client.torrent_list_cache
+
+        self.assertEqual(['hash1', 'hash2'], list(cache.update()))
+        self.assertEqual(1, cache.cid)
+        self.assertNotIn('cid', m.request_history[0].text)
+        self.assertEqual('name1', cache.torrents_dict['hash1']['name'])
+
+        torrents = cache.update()
+        self.assertIn('cid=1', m.request_history[1].text)
+        self.assertEqual(['hash2', 'hash3'], sorted(torrents))
+        self.assertEqual(0, cache.torrents_dict['hash2']['state'])
+        self.assertNotIn('hash1', cache.torrents_dict)
+
+        self.assertEqual(['hash2', 'hash3'], sorted(cache.update()))
+        self.assertEqual(2, cache.cid)
+
     @requests_mock.Mocker()
     def test_get_torrent(self, m: requests_mock.Mocker):
         client = ruTorrentClient('hostname-test.com', 'a', 'b')
@@ -104,6 +180,80 @@ class TestRuTorrentClient(unittest.TestCase):
 
         self.assertEqual('test.torrent', fn)
 
+    @requests_mock.Mocker()
+    def test_get_torrent_cached(self, m: requests_mock.Mocker):
+        cache_dir = mkdtemp(prefix='test-rutorrent-client-')
+        self.addCleanup(rmtree, cache_dir)
+        client = ruTorrentClient('hostname-test.com',
+                                 'a',
+                                 'b',
+                                 torrent_cache=TorrentFileCache(cache_dir))
+        hash_ = sha1(b'de').hexdigest()
+        m.get(client._source_uri(hash_),
+              content=b'd4:infodee',
+              headers={
+                  'content-disposition': 'attachment; '
+                  'filename=test.torrent'
+              })
+
+        for _ in range(2):
+            r, fn = client.get_torrent(hash_)
+            self.assertEqual(b'd4:infodee', r.content)
+            self.assertEqual('test.torrent', fn)
+        self.assertEqual(1, m.call_count)
+
+        futures = list(client.get_torrents_futures([hash_]))
+        self.assertEqual(b'd4:infodee', futures[0].result().content)
+        self.assertEqual(1, m.call_count)
+
+    @requests_mock.Mocker()
+    def test_get_torrent_not_cached(self, m: requests_mock.Mocker):
+        cache_dir = mkdtemp(prefix='test-rutorrent-client-')
+        self.addCleanup(rmtree, cache_dir)
+        client = ruTorrentClient('hostname-test.com',
+                                 'a',
+                                 'b',
+                                 torrent_cache=TorrentFileCache(cache_dir))
+        headers = {'content-disposition': 'attachment; filename=test.torrent'}
+        m.get(client._source_uri('hash1'),
+              content=b'd4:infodee',
+              headers=headers)
+        m.get(client._source_uri('hash2'),
+              content=b'<html></html>',
+              headers=headers)
+
+        for hash_ in ('hash1', 'hash1', 'hash2', 'hash2'):
+            client.get_torrent(hash_)
+        for future in client.get_torrents_futures(['hash1', 'hash2']):
+            future.result()
+        self.assertEqual(6, m.call_count)
+        self.assertNotIn('hash1', client.torrent_cache)
+        self.assertNotIn('hash2', client.torrent_cache)
+
+    @requests_mock.Mocker()
+    def test_fetch_torrents(self, m: requests_mock.Mocker):
+        client = ruTorrentClient('hostname-test.com', 'a', 'b')
+        headers = {'content-disposition': 'attachment; filename=a.torrent'}
+        m.get(client._source_uri('hash1'),
+              content=b'd4:infod4:name1:aee',
+              headers=headers)
+        m.get(client._source_uri('hash2'), [
+            dict(status_code=503),
+            dict(content=b'd4:infod4:name1:bee', headers=headers),
+        ])
+        m.get(client._source_uri('hash3'), status_code=404)
+
+        results = dict(
+            client.fetch_torrents(['hash1', 'hash2', 'hash3'],
+                                  concurrency=2,
+                                  backoff_factor=0))
+        self.assertEqual(b'a', results['hash1'][b'info'][b'name'])
+        self.assertEqual(b'b', results['hash2'][b'info'][b'name'])
+        self.assertIsInstance(results['hash3'], HTTPError)
+        self.assertEqual(4, m.call_count)
+        for req in m.request_history:
+            self.assertIn('Authorization', req.headers)
+
     @requests_mock.Mocker()
     def test_list_files(self, m: requests_mock.Mocker):
         client = ruTorrentClient('hostname-test.com', 'a', 'b')
@@ -195,6 +345,110 @@ class TestRuTorrentClient(unittest.TestCase):
         with self.assertRaises(UnexpectedruTorrentError):
             client.move_torrent('hash1', 'newplace')
 
+    @requests_mock.Mocker()
+    def test_stop_many(self, m: requests_mock.Mocker):
+        client = ruTorrentClient('hostname-test.com', 'a', 'b')
+        m.post(client.multirpc_action_uri, [
+            dict(json=[]),
+            dict(status_code=500),
+        ])
+
+        results = client.stop_many(['hash1', 'hash2', 'hash3'], batch_size=2)
+        self.assertEqual(2, len(m.request_history))
+        self.assertEqual('mode=stop&hash=hash1&hash=hash2',
+                         m.request_history[0].text)
+        self.assertEqual('mode=stop&hash=hash3', m.request_history[1].text)
+        self.assertIsNone(results['hash1'])
+        self.assertIsNone(results['hash2'])
+        self.assertIsInstance(results['hash3'], HTTPError)
+
+    def test_delete_many(self):
+        client = ruTorrentClient('hostname-test.com', 'a', 'b')
+        client._xmlrpc_proxy = MagicMock()
+        client._xmlrpc_proxy.system.multicall.return_value = [
+            [0], [0], [0], [0], {
+                'faultCode': -501,
+                'faultString': 'Could not find info-hash.'
+            }, [0]
+        ]
+
+        results = client.delete_many(['hash1', 'hash2'])
+        calls = client._xmlrpc_proxy.system.multicall.call_args[0][0]
+        self.assertEqual(6, len(calls))
+        self.assertEqual('d.erase', calls[5]['methodName'])
+        self.assertEqual(('hash2', ), calls[5]['params'])
+        self.assertIsNone(results['hash1'])
+        self.assertIsInstance(results['hash2'], xmlrpc.Fault)
+
+    def test_query(self):
+        client = ruTorrentClient('hostname-test.com', 'a', 'b')
+        client._xmlrpc_proxy = MagicMock()
+        client._xmlrpc_proxy.d.multicall2.return_value = [
+            ['hash1', '2020', 1426, 1, 0],
+        ]
+
+        torrents = client.query(
+            ('custom1', 'ratio', 'is_hash_checking', 'creation_date'))
+        client._xmlrpc_proxy.d.multicall2.assert_called_once_with(
+            '', 'main', 'd.hash=', 'd.custom1=', 'd.ratio=',
+            'd.is_hash_checking=', 'd.creation_date=')
+        self.assertEqual(
+            {
+                'custom1': '2020',
+                'ratio': 1.426,
+                'is_hash_checking': True,
+                'creation_date': None,
+            }, torrents['hash1'])
+
+        with self.assertRaises(ValueError):
+            client.query(('not a field', ))
+
+    @requests_mock.Mocker()
+    def test_query_hashing(self, m: requests_mock.Mocker):
+        client = ruTorrentClient('hostname-test.com', 'a', 'b')
+        client._xmlrpc_proxy = MagicMock()
+        client._xmlrpc_proxy.d.multicall2.return_value = [
+            [f'hash{x}', x] for x in range(4)
+        ]
+        m.post(client.multirpc_action_uri,
+               json=dict(t={
+                   f'hash{x}': ['0'] * 23 + [str(x)]
+                   for x in range(4)
+               }))
+
+        listed = client.list_torrents_dict()
+        queried = client.query(('hashing', ))
+        self.assertEqual([False, True, False, False],
+                         [queried[f'hash{x}']['hashing'] for x in range(4)])
+        self.assertEqual({x: y['hashing']
+                          for x, y in listed.items()},
+                         {x: y['hashing']
+                          for x, y in queried.items()})
+
+    @requests_mock.Mocker()
+    def test_delete(self, m: requests_mock.Mocker):
+        client = ruTorrentClient('hostname-test.com', 'a', 'b')
+        m.post(client.multirpc_action_uri, [
+            dict(text=xmlrpc.dumps(([[0], [0], [0]], ), methodresponse=True)),
+            dict(text=xmlrpc.dumps(([[0], [0], {
+                'faultCode': -501,
+                'faultString': 'Could not find info-hash.'
+            }], ),
+                                   methodresponse=True)),
+            dict(status_code=500),
+        ])
+
+        client.delete('hash1')
+        request = m.request_history[0]
+        self.assertEqual('text/xml', request.headers['Content-Type'])
+        params, method = xmlrpc.loads(request.body)
+        self.assertEqual('system.multicall', method)
+        self.assertEqual('d.erase', params[0][2]['methodName'])
+        with self.assertRaises(xmlrpc.Fault):
+            client.delete('hash1')
+        with self.assertRaises(xmlrpc.ProtocolError):
+            client.delete('hash1')
+
 
 if __name__ == '__main__':
     unittest.main()
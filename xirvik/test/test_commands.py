@@ -0,0 +1,56 @@
+from unittest.mock import patch
+import unittest
+
+import requests
+
+from xirvik.commands import move_erroneous
+
+
+def _torrent(name):
+    return dict(name=name,
+                message='Unregistered torrent',
+                is_hash_checking=False,
+                left_bytes=0,
+                custom1='Label')
+
+
+class TestMoveErroneous(unittest.TestCase):
+    def setUp(self):
+        patcher = patch('xirvik.commands.move_erroneous.ruTorrentClient')
+        self.client = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+        patcher = patch('xirvik.commands.move_erroneous.setup_logging_stdout')
+        self.log = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+        self.client.name = 'user'
+        self.client.list_torrents_dict.return_value = {
+            'hash1': _torrent('a'),
+            'hash2': _torrent('b'),
+        }
+        self.client.stop_many.side_effect = lambda x: dict.fromkeys(x)
+        self.client.remove_many.side_effect = lambda x: dict.fromkeys(x)
+
+    def test_move_failure(self):
+        self.client.move_many.return_value = {
+            'hash1': requests.ConnectionError(),
+            'hash2': None,
+        }
+        with patch('sys.argv', ['xirvik-move-erroneous', 'host']):
+            self.assertEqual(1, move_erroneous.main())
+        self.client.move_many.assert_called_once_with(
+            ['hash1', 'hash2'], '/torrents/user/_completed-not-active/label')
+        self.assertEqual(
+            [(['hash1', 'hash2'], ), (['hash2'], )],
+            [x.args for x in self.client.stop_many.call_args_list])
+        self.client.remove_many.assert_called_once_with(['hash2'])
+
+    def test_sleep_time(self):
+        self.client.move_many.side_effect = lambda x, y: dict.fromkeys(x)
+        with patch('sys.argv', ['xirvik-move-erroneous', '-t', '5', 'host']):
+            self.assertEqual(0, move_erroneous.main())
+        self.client.remove_many.assert_called_once_with(['hash1', 'hash2'])
+        self.log.warning.assert_called_once()
+
+
+if __name__ == '__main__':
+    unittest.main()
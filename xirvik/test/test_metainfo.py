@@ -0,0 +1,73 @@
+from hashlib import sha1
+import unittest
+
+from benc import decode as bdecode, encode as bencode
+
+from xirvik.metainfo import LazyDict, parse_metainfo
+
+
+class TestMetainfo(unittest.TestCase):
+    def setUp(self):
+        self.info = {
+            b'name': b'name',
+            b'piece length': 16384,
+            b'pieces': bytes(range(200)),
+            b'files': [
+                {
+                    b'length': 1,
+                    b'path': [b'a', b'b'],
+                },
+                {
+                    b'length': 2,
+                    b'path': [b'c'],
+                },
+            ],
+        }
+        self.data = bencode({
+            b'announce': b'https://fake.com',
+            b'creation date': 1234,
+            b'info': self.info,
+        })
+
+    def test_parse(self):
+        metainfo = parse_metainfo(self.data)
+        self.assertEqual(bdecode(self.data), dict(metainfo))
+        self.assertEqual(sha1(bencode(self.info)).digest(),
+                         metainfo.info_hash)
+        self.assertEqual([b'announce', b'creation date', b'info'],
+                         list(metainfo))
+        self.assertEqual(1234, metainfo[b'creation date'])
+        info = metainfo[b'info']
+        self.assertIsInstance(info, LazyDict)
+        self.assertIs(info, metainfo[b'info'])
+        self.assertEqual(b'name', info[b'name'])
+        self.assertIsInstance(info[b'files'][0], LazyDict)
+        self.assertEqual([b'a', b'b'], info[b'files'][0][b'path'])
+        with self.assertRaises(KeyError):
+            info[b'length']  # pylint: disable=pointless-statement
+
+    def test_pieces_view(self):
+        metainfo = parse_metainfo(bytearray(self.data))
+        pieces = metainfo[b'info'][b'pieces']
+        self.assertIsInstance(pieces, memoryview)
+        self.assertEqual(bytes(range(200)), pieces)
+        self.assertEqual(bytes(range(20, 40)), pieces[20:40])
+
+    def test_lazy(self):
+        metainfo = parse_metainfo(self.data)
+        # pylint: disable=protected-access
+        self.assertEqual({}, metainfo._values)
+        self.assertEqual(bencode(self.info), metainfo.raw(b'info'))
+
+    def test_no_info(self):
+        self.assertIsNone(parse_metainfo(b'd1:ai1ee').info_hash)
+
+    def test_invalid(self):
+        for data in (b'', b'i1e', b'd', b'd1:a', b'd1:ai1ee1', b'di1ei2ee',
+                     b'd1:a5:abce', b'd1:a-1:e', b'd1:ali1ee'):
+            with self.assertRaises(ValueError):
+                parse_metainfo(data)
+
+
+if __name__ == '__main__':
+    unittest.main()
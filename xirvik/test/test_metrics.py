@@ -0,0 +1,143 @@
+from os.path import join as path_join
+from shutil import rmtree
+from tempfile import mkdtemp
+from typing import List
+import json
+import unittest
+import xmlrpc.client as xmlrpc
+
+import requests
+import requests_mock
+
+from xirvik.metrics import (Histogram, InstrumentedHTTPAdapter,
+                            MetricsRegistry, RequestRecord)
+
+
+def record(mode: str = 'list',
+           status: int = 200,
+           latency: float = 0.1) -> RequestRecord:
+    return RequestRecord(endpoint='/rtorrent/plugins/multirpc/action.php',
+                         mode=mode,
+                         status=status,
+                         bytes_sent=10,
+                         bytes_received=100,
+                         retries=1,
+                         latency=latency)
+
+
+class TestHistogram(unittest.TestCase):
+    def test_quantile(self):
+        h = Histogram((0.1, 1.0, float('inf')))
+        self.assertEqual(0, h.quantile(0.5))
+        for value in (0.05, 0.05, 0.5, 20):
+            h.observe(value)
+        self.assertEqual([2, 1, 1], h.counts)
+        self.assertEqual(0.1, h.quantile(0.5))
+        self.assertEqual(1.0, h.quantile(0.75))
+        self.assertEqual(20, h.quantile(1))
+        self.assertEqual(20.6, h.sum)
+
+
+class TestMetricsRegistry(unittest.TestCase):
+    def setUp(self):
+        self.path = mkdtemp(prefix='test-metrics-')
+
+    def tearDown(self):
+        rmtree(self.path)
+
+    def test_summary(self):
+        registry = MetricsRegistry()
+        registry(record())
+        registry(record(status=503, latency=3))
+        registry(record(mode='stop'))
+        summary = registry.summary()
+        self.assertEqual(['list', 'stop'], [x['mode'] for x in summary])
+        self.assertEqual(2, summary[0]['count'])
+        self.assertEqual(1, summary[0]['errors'])
+        self.assertEqual(2, summary[0]['retries'])
+        self.assertEqual(200, summary[0]['bytes_received'])
+        self.assertEqual({'200': 1, '503': 1}, summary[0]['statuses'])
+        self.assertEqual(3, summary[0]['latency_max'])
+        lines = list(registry.format_summary())
+        self.assertIn('2 requests, 1 errors', lines[0])
+
+    def test_write_json_lines(self):
+        registry = MetricsRegistry()
+        registry(record())
+        path = path_join(self.path, 'metrics.jsonl')
+        registry.write_json_lines(path)
+        registry.write_json_lines(path)
+        with open(path) as f:
+            lines = [json.loads(x) for x in f]
+        self.assertEqual(2, len(lines))
+        self.assertEqual('list', lines[0]['mode'])
+
+    def test_write_prometheus(self):
+        registry = MetricsRegistry()
+        registry(record())
+        registry(record(mode='stop', status=None))
+        path = path_join(self.path, 'xirvik.prom')
+        registry.write_prometheus(path)
+        with open(path) as f:
+            lines = f.read().splitlines()
+        self.assertIn(
+            'xirvik_request_duration_seconds_bucket{endpoint="/rtorrent/'
+            'plugins/multirpc/action.php",mode="list",le="+Inf"} 1', lines)
+        self.assertIn(
+            'xirvik_requests_total{endpoint="/rtorrent/plugins/multirpc/'
+            'action.php",mode="stop",status="error"} 1', lines)
+        # Samples of each family must be grouped under their TYPE line
+        types = [i for i, x in enumerate(lines) if x.startswith('# TYPE')]
+        self.assertEqual(4, len(types))
+        self.assertTrue(
+            all(x.startswith('xirvik_requests_total')
+                for x in lines[types[1] + 1:types[2]]))
+
+
+class TestInstrumentedHTTPAdapter(unittest.TestCase):
+    def test_send(self):
+        records: List[RequestRecord] = []
+        inner = requests_mock.Adapter()
+        inner.register_uri('POST',
+                           'https://host/action.php',
+                           content=b'[]',
+                           headers={'Content-Length': '2'})
+        inner.register_uri('GET',
+                           'https://host/source.php',
+                           exc=requests.ConnectionError)
+        session = requests.Session()
+        session.mount('https://', InstrumentedHTTPAdapter(inner,
+                                                          records.append))
+
+        session.post('https://host/action.php',
+                     data=dict(mode='stop', hash='hash1'))
+        session.post('https://host/action.php',
+                     data=xmlrpc.dumps(('hash1', ), 'd.erase'),
+                     headers={'Content-Type': 'text/xml'})
+        with self.assertRaises(requests.ConnectionError):
+            session.get('https://host/source.php?hash=hash1')
+
+        self.assertEqual(['stop', 'd.erase', ''], [x.mode for x in records])
+        self.assertEqual([200, 200, None], [x.status for x in records])
+        self.assertEqual('/action.php', records[0].endpoint)
+        self.assertEqual(2, records[0].bytes_received)
+        self.assertEqual(len('mode=stop&hash=hash1'), records[0].bytes_sent)
+
+    def test_send_without_content_length(self):
+        records: List[RequestRecord] = []
+        inner = requests_mock.Adapter()
+        inner.register_uri('GET', 'https://host/source.php', content=b'x' * 10)
+        session = requests.Session()
+        session.mount('https://', InstrumentedHTTPAdapter(inner,
+                                                          records.append))
+
+        self.assertEqual(b'x' * 10,
+                         session.get('https://host/source.php').content)
+        with session.get('https://host/source.php', stream=True) as r:
+            self.assertEqual(b'x' * 10, r.content)
+
+        self.assertEqual([10, 0], [x.bytes_received for x in records])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+from typing import List
+from unittest.mock import patch
+import time
+import unittest
+
+from requests.adapters import HTTPAdapter
+import requests
+
+from xirvik.client import ruTorrentClient
+from xirvik.metrics import RequestRecord
+from xirvik.ratelimit import RateLimiter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps: List[float] = []
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_token_bucket(self):
+        clock = FakeClock()
+        limiter = RateLimiter(rate=2, burst=2, clock=clock, sleep=clock.sleep)
+        self.assertEqual(0, limiter.acquire())
+        self.assertEqual(0, limiter.acquire())
+        self.assertEqual(0.5, limiter.acquire())
+        self.assertEqual(0.5, limiter.acquire())
+        clock.now += 10
+        # Tokens never exceed burst
+        self.assertEqual(0, limiter.acquire())
+        self.assertEqual(0, limiter.acquire())
+        self.assertEqual(0.5, limiter.acquire())
+
+    def test_aimd(self):
+        clock = FakeClock()
+        limiter = RateLimiter(rate=8,
+                              min_rate=1,
+                              max_rate=10,
+                              increase=1,
+                              target_latency=1,
+                              clock=clock,
+                              sleep=clock.sleep)
+        limiter.record(0.1, True)
+        self.assertEqual(9, limiter.rate)
+        # Slow responses do not increase the rate
+        limiter.record(5, True)
+        self.assertEqual(9, limiter.rate)
+        limiter.record(0.1, False)
+        self.assertEqual(4.5, limiter.rate)
+        # Failures within target_latency of a decrease are ignored
+        limiter.record(0.1, False)
+        self.assertEqual(4.5, limiter.rate)
+        clock.now += 1
+        limiter.record(0.1, False)
+        limiter.record(0.1, True)
+        self.assertEqual(3.25, limiter.rate)
+        for _ in range(20):
+            limiter.record(0.1, True)
+        self.assertEqual(10, limiter.rate)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            RateLimiter(rate=100, max_rate=10)
+        with self.assertRaises(ValueError):
+            RateLimiter(burst=0)
+
+    def test_client_requests_are_limited(self):
+        clock = FakeClock()
+        limiter = RateLimiter(rate=4,
+                              burst=1,
+                              min_rate=1,
+                              clock=clock,
+                              sleep=clock.sleep)
+        client = ruTorrentClient('hostname-test.com',
+                                 'a',
+                                 'b',
+                                 rate_limiter=limiter)
+        responses = []
+        for status_code in (503, 200):
+            r = requests.Response()
+            r.status_code = status_code
+            responses.append(r)
+        with patch.object(HTTPAdapter, 'send', side_effect=responses):
+            with self.assertRaises(requests.HTTPError):
+                client.stop('hash1')
+            self.assertEqual(2, limiter.rate)
+            client.stop('hash1')
+        self.assertEqual([0.5], clock.sleeps)
+        self.assertEqual(2.5, limiter.rate)
+
+    def test_client_metrics_exclude_waiting(self):
+        clock = FakeClock()
+
+        def sleep(seconds: float) -> None:
+            clock.sleep(seconds)
+            time.sleep(0.2)
+
+        limiter = RateLimiter(rate=4, burst=1, clock=clock, sleep=sleep)
+        records: List[RequestRecord] = []
+        client = ruTorrentClient('hostname-test.com',
+                                 'a',
+                                 'b',
+                                 rate_limiter=limiter,
+                                 metrics_hook=records.append)
+        r = requests.Response()
+        r.status_code = 200
+        r._content = b''  # pylint: disable=protected-access
+        with patch.object(HTTPAdapter, 'send', return_value=r):
+            client.stop('hash1')
+            client.stop('hash1')
+        self.assertEqual(1, len(clock.sleeps))
+        self.assertEqual(2, len(records))
+        self.assertLess(max(x.latency for x in records), 0.2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+
+from xirvik.client import TORRENT_FIELDS
+from xirvik.test.server import RuTorrentServer
+
+
+class TestRuTorrentServer(unittest.TestCase):
+    def setUp(self):
+        self.server = RuTorrentServer(torrent_count=50).start()
+        self.addCleanup(self.server.stop)
+        self.client = self.server.client(max_retries=0)
+        self.hashes = list(self.server.torrents)
+
+    def test_list_and_query(self):
+        torrents = self.client.list_torrents_dict()
+        self.assertEqual(set(self.hashes), set(torrents))
+        self.assertEqual(set(TORRENT_FIELDS), set(torrents[self.hashes[0]]))
+        fields = ('name', 'base_path', 'size_bytes', 'ratio', 'is_open')
+        queried = self.client.query(fields)
+        for hash_ in self.hashes:
+            self.assertEqual({x: torrents[hash_][x]
+                              for x in fields}, queried[hash_])
+
+    def test_changes(self):
+        cache = self.client.torrent_list_cache
+        self.assertEqual(50, len(cache.update()))
+        self.client.set_label(label='new label', hash_=self.hashes[0])
+        self.client.move_torrent(self.hashes[1], '/torrents/user/elsewhere')
+        self.assertEqual({self.hashes[2]: None},
+                         self.client.delete_many(self.hashes[2:3]))
+        self.client.remove(self.hashes[3])
+        torrents = cache.update()
+        self.assertEqual(48, len(torrents))
+        self.assertNotIn(self.hashes[2], torrents)
+        info = cache.torrents_dict
+        self.assertEqual('new label', info[self.hashes[0]]['custom1'])
+        self.assertEqual(
+            '/torrents/user/elsewhere/' + info[self.hashes[1]]['name'],
+            info[self.hashes[1]]['base_path'])
+
+    def test_fetch_torrents(self):
+        results = dict(self.client.fetch_torrents(self.hashes[:5]))
+        for hash_ in self.hashes[:5]:
+            self.assertEqual(
+                self.server.torrents[hash_].values['name'].encode(),
+                results[hash_][b'info'][b'name'])
+
+    def test_failures(self):
+        self.server.failure_rate = 1
+        with self.assertRaises(Exception):
+            self.client.list_torrents()
+        self.assertIsInstance(
+            self.client.stop_many(self.hashes[:2])[self.hashes[0]], Exception)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,497 @@
+from os import makedirs, stat
+from os.path import join as path_join
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest.mock import MagicMock, patch
+import os
+import socket
+import time
+import unittest
+
+from paramiko import SFTPAttributes
+from paramiko.ssh_exception import SSHException
+
+from xirvik.cache import RemoteManifest, TransferSettingsCache
+from xirvik.sftp import (PART_SUFFIX, SEGMENTS_SUFFIX, SFTPClient,
+                         TransferSettings, _spread_channels)
+
+
+class _RemoteFile:
+    def __init__(self, sftp, path):
+        self.sftp = sftp
+        self.path = path
+        self.f = open(path_join(sftp.root, path), 'rb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def seek(self, offset):
+        self.f.seek(offset)
+
+    def stat(self):
+        return self.sftp.stat(self.path)
+
+    def prefetch(self, size, max_requests=None):
+        pass
+
+    def read(self, n):
+        if self.path in self.sftp.fail_after and self.f.tell() >= \
+                self.sftp.fail_after[self.path]:
+            del self.sftp.fail_after[self.path]
+            raise socket.timeout()
+        if self.sftp.delay:
+            time.sleep(self.sftp.delay)
+        return self.f.read(min(n, 1000))
+
+    def readv(self, chunks, max_requests=None):
+        for offset, size in chunks:
+            self.seek(offset)
+            data = b''
+            while len(data) < size:
+                chunk = self.read(size - len(data))
+                if not chunk:
+                    break
+                data += chunk
+            yield data
+
+    def close(self):
+        self.f.close()
+
+
+class _FakeSFTP:
+    # Serves files from a local directory
+    def __init__(self, root, fail_after):
+        self.root = root
+        self.fail_after = fail_after
+        self.cwd = None
+        self.delay = 0.0
+        self.closed = False
+
+    def listdir_attr(self, path='.'):
+        if os.path.basename(path) == 'unreadable':
+            raise IOError('Permission denied')
+        ret = []
+        for name in sorted(os.listdir(path_join(self.root, path))):
+            ret.append(
+                SFTPAttributes.from_stat(
+                    stat(path_join(self.root, path, name)), name))
+        return ret
+
+    def listdir_iter(self, path='.', read_aheads=50):
+        yield from self.listdir_attr(path)
+
+    def stat(self, path):
+        return SFTPAttributes.from_stat(stat(path_join(self.root, path)))
+
+    def getcwd(self):
+        return self.cwd
+
+    def chdir(self, path):
+        self.cwd = path
+
+    def open(self, path, mode='r'):
+        return _RemoteFile(self, path)
+
+    def close(self):
+        self.closed = True
+
+
+class _FakeServerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.remote = mkdtemp(prefix='test-sftp-remote-')
+        self.local = mkdtemp(prefix='test-sftp-local-')
+        self.data = {}
+        for i in range(12):
+            name = path_join('dir', 'sub' if i % 3 else '', f'{i}.bin')
+            makedirs(path_join(self.remote, 'dir', 'sub'), exist_ok=True)
+            data = os.urandom(i * 1500)
+            with open(path_join(self.remote, name), 'wb') as f:
+                f.write(data)
+            os.chmod(path_join(self.remote, name), 0o640)
+            os.utime(path_join(self.remote, name), (1000 + i, 2000 + i))
+            self.data[name] = data
+        self.fail_after = {}
+        with patch.object(SFTPClient, '_connect'):
+            self.client = SFTPClient(hostname='localhost',
+                                     username='user',
+                                     password='pass')
+        self.client.client = _FakeSFTP(self.remote, self.fail_after)
+        self.client.getcwd = self.client.client.getcwd
+        self.client.ssh_client = MagicMock()
+        self.client.raise_exceptions = False
+        self.client.clear_directory_cache()
+        self.sftps = []
+        # Called with the settings of new channels, returns the delay of
+        # reads
+        self.on_open = lambda settings: 0.0
+
+        def open_sftp(ssh_client, settings=None):
+            sftp = _FakeSFTP(self.remote, self.fail_after)
+            sftp.delay = self.on_open(settings)
+            self.sftps.append((ssh_client, sftp))
+            return sftp
+
+        patcher = patch.object(self.client,
+                               '_open_sftp',
+                               side_effect=open_sftp)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(self.client, '_new_ssh_client')
+        self.new_ssh_client = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        rmtree(self.remote)
+        rmtree(self.local)
+
+    def _check_local(self):
+        for name, data in self.data.items():
+            path = path_join(self.local, name)
+            with open(path, 'rb') as f:
+                self.assertEqual(data, f.read())
+            st = stat(path)
+            self.assertEqual(0o640, st.st_mode & 0o777)
+            self.assertEqual(
+                stat(path_join(self.remote, name)).st_mtime, st.st_mtime)
+
+
+class TestParallelMirror(_FakeServerTestCase):
+    def test_mirror(self):
+        written = {}
+
+        def on_write(path, offset, data):
+            written.setdefault(path, bytearray())
+            self.assertEqual(len(written[path]), offset)
+            written[path] += data
+
+        # One file is already there
+        makedirs(path_join(self.local, 'dir'))
+        with open(path_join(self.local, 'dir', '0.bin'), 'wb'):
+            pass
+        n = self.client.mirror('dir',
+                               self.local,
+                               on_write=on_write,
+                               workers=3,
+                               connections=2)
+        self.assertEqual(11, n)
+        self._check_local()
+        self.assertEqual(
+            {
+                path_join(self.local, x): y
+                for x, y in self.data.items() if y
+            }, written)
+        # At most a channel per worker for the walk and for downloads
+        self.assertLessEqual(len(self.sftps), 6)
+        self.assertEqual(1, self.new_ssh_client.call_count)
+        self.new_ssh_client.return_value.close.assert_called_once_with()
+
+    def test_mirror_channels_per_connection(self):
+        self.new_ssh_client.side_effect = lambda: MagicMock()
+        n = self.client.mirror('dir',
+                               self.local,
+                               workers=12,
+                               connections=1,
+                               walk_concurrency=6)
+        self.assertEqual(12, n)
+        self._check_local()
+        # This client's own channel is on the first connection
+        channels = {id(self.client.ssh_client): 1}
+        for ssh_client, _ in self.sftps:
+            channels[id(ssh_client)] = channels.get(id(ssh_client), 0) + 1
+        self.assertLessEqual(max(channels.values()), 10)
+        self.assertEqual(1, self.new_ssh_client.call_count)
+        # Six walk channels and this client's leave room for three workers
+        self.assertEqual([0, 0, 0] + [1] * 9, _spread_channels(12, 1, 7))
+
+    def test_mirror_sequential(self):
+        written = {}
+
+        def on_write(path, offset, data):
+            written.setdefault(path, {})[offset] = data
+
+        name = path_join('dir', 'sub', '11.bin')
+        makedirs(path_join(self.local, 'dir', 'sub'))
+        with open(path_join(self.local, name), 'wb') as f:
+            f.write(self.data[name][:3000])
+        n = self.client.mirror('dir', self.local, on_write=on_write)
+        self.assertEqual(12, n)
+        self._check_local()
+        for path, data in self.data.items():
+            if data:
+                blocks = written[path_join(self.local, path)]
+                self.assertEqual(3000 if path == name else 0, min(blocks))
+                self.assertEqual(data[min(blocks):], b''.join(
+                    y for x, y in sorted(blocks.items())))
+
+    def test_mirror_resume(self):
+        name = path_join('dir', 'sub', '11.bin')
+        self.fail_after[name] = 5000
+        n = self.client.mirror('dir', self.local, workers=2)
+        self.assertEqual(12, n)
+        self._check_local()
+        # Reconnected once with a new connection
+        self.assertEqual(1, self.new_ssh_client.call_count)
+        self.assertIn(self.new_ssh_client.return_value,
+                      [x for x, _ in self.sftps])
+
+    def test_mirror_no_resume(self):
+        self.fail_after[path_join('dir', 'sub', '11.bin')] = 5000
+        with self.assertRaises(socket.timeout):
+            self.client.mirror('dir', self.local, workers=2, resume=False)
+
+    def test_mirror_segmented(self):
+        n = self.client.mirror('dir',
+                               self.local,
+                               workers=2,
+                               segment_threshold=9000)
+        self.assertEqual(12, n)
+        self._check_local()
+        self.assertFalse([
+            x for x in os.listdir(path_join(self.local, 'dir', 'sub'))
+            if x.endswith((PART_SUFFIX, SEGMENTS_SUFFIX))
+        ])
+
+
+class TestDownloadSegmented(_FakeServerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.name = path_join('dir', 'sub', '11.bin')
+        self.dest = path_join(self.local, '11.bin')
+        self.written = {}
+
+    def on_write(self, path, offset, data):
+        self.assertEqual(self.dest, path)
+        self.written[offset] = data
+
+    def _check_dest(self):
+        with open(self.dest, 'rb') as f:
+            self.assertEqual(self.data[self.name], f.read())
+        self.assertEqual(['11.bin'], os.listdir(self.local))
+
+    def test_download(self):
+        self.fail_after[self.name] = 4500
+        self.client.download_segmented(self.name,
+                                       self.dest,
+                                       workers=3,
+                                       connections=2,
+                                       segment_size=1000,
+                                       on_write=self.on_write)
+        self._check_dest()
+        self.assertEqual(self.data[self.name],
+                         b''.join(y for x, y in sorted(self.written.items())))
+        # One connection for the workers, one to reconnect
+        self.assertEqual(2, self.new_ssh_client.call_count)
+
+    def test_resume(self):
+        self.fail_after[self.name] = 5500
+        with self.assertRaises(socket.timeout):
+            self.client.download_segmented(self.name,
+                                           self.dest,
+                                           workers=1,
+                                           segment_size=1000,
+                                           resume=False)
+        self.assertFalse(os.path.exists(self.dest))
+        self.assertTrue(os.path.exists(self.dest + PART_SUFFIX))
+        self.client.download_segmented(self.name,
+                                       self.dest,
+                                       workers=2,
+                                       segment_size=1000,
+                                       on_write=self.on_write)
+        self._check_dest()
+        self.assertEqual(6000, min(self.written))
+
+    def test_resume_partial_file(self):
+        with open(self.dest, 'wb') as f:
+            f.write(self.data[self.name][:2500])
+        self.client.download_segmented(self.name,
+                                       self.dest,
+                                       workers=2,
+                                       segment_size=1000,
+                                       on_write=self.on_write)
+        self._check_dest()
+        self.assertEqual(2000, min(self.written))
+
+    def test_changed_file(self):
+        self.fail_after[self.name] = 5500
+        with self.assertRaises(socket.timeout):
+            self.client.download_segmented(self.name,
+                                           self.dest,
+                                           workers=1,
+                                           segment_size=1000,
+                                           resume=False)
+        os.utime(path_join(self.remote, self.name), (1, 1))
+        self.client.download_segmented(self.name,
+                                       self.dest,
+                                       workers=2,
+                                       segment_size=1000,
+                                       on_write=self.on_write)
+        self._check_dest()
+        self.assertEqual(0, min(self.written))
+
+
+class TestListdirAttrRecurse(_FakeServerTestCase):
+    def setUp(self):
+        super().setUp()
+        # Not a directory despite the mode
+        with open(path_join(self.remote, 'dir', 'script.sh'), 'wb'):
+            pass
+        os.chmod(path_join(self.remote, 'dir', 'script.sh'), 0o700)
+        for name in ('unreadable', 'empty'):
+            makedirs(path_join(self.remote, 'dir', 'sub', name))
+        self.expected = set(self.data) | {path_join('dir', 'script.sh')}
+
+    def test_sequential(self):
+        entries = list(self.client.listdir_attr_recurse('dir'))
+        self.assertEqual(self.expected, {x for x, _ in entries})
+        # Breadth-first
+        depths = [x.count(os.sep) for x, _ in entries]
+        self.assertEqual(sorted(depths), depths)
+
+    def test_concurrent(self):
+        entries = list(self.client.listdir_attr_recurse('dir',
+                                                        concurrency=3))
+        self.assertEqual(self.expected, {x for x, _ in entries})
+        self.assertEqual(len(self.expected), len(entries))
+        self.assertTrue(self.sftps)
+        self.assertLessEqual(len(self.sftps), 3)
+        self.assertTrue(all(x.closed for _, x in self.sftps))
+
+    def test_manifest(self):
+        manifest = RemoteManifest(path_join(self.local, 'manifest.sqlite3'))
+        listdir_attr = self.client.client.listdir_attr
+        listed = []
+        sub = path_join('dir', 'sub')
+        unreadable = path_join(sub, 'unreadable')
+
+        def walk(**kwargs):
+            listed.clear()
+            return {
+                x: y.st_size
+                for x, y in self.client.listdir_attr_recurse(
+                    'dir', manifest=manifest, **kwargs)
+            }
+
+        def counting_listdir_attr(path='.'):
+            listed.append(path)
+            return listdir_attr(path)
+
+        def touch(path, mtime):
+            os.utime(path_join(self.remote, path), (mtime, mtime))
+
+        for x in ('dir', sub, unreadable, path_join(sub, 'empty')):
+            touch(x, 1000)
+        self.client.client.listdir_attr = counting_listdir_attr
+        sizes = {x: len(y) for x, y in self.data.items()}
+        sizes[path_join('dir', 'script.sh')] = 0
+        self.assertEqual(sizes, walk())
+        self.assertEqual(4, len(listed))
+        # Only the directory that could not be listed is tried again
+        self.assertEqual(sizes, walk())
+        self.assertEqual([unreadable], listed)
+
+        # A new file in a subdirectory
+        new = path_join(sub, 'new.bin')
+        with open(path_join(self.remote, new), 'wb') as f:
+            f.write(b'new')
+        touch(sub, 5000)
+        sizes[new] = 3
+        self.assertEqual(sizes, walk())
+        self.assertEqual([sub, unreadable], listed)
+        self.assertEqual(sizes, walk(concurrency=3))
+
+        # A directory changed in the second of the listing is listed again
+        touch(sub, int(time.time()))
+        self.assertEqual(sizes, walk())
+        self.assertEqual(sizes, walk())
+        self.assertEqual([sub, unreadable], listed)
+
+        # Files changed in place are noticed once listings are too old
+        touch(sub, 5000)
+        self.assertEqual(sizes, walk())
+        with open(path_join(self.remote, new), 'ab') as f:
+            f.write(b'more')
+        self.assertEqual(sizes, walk())
+        manifest.max_age = -1
+        sizes[new] = 7
+        self.assertEqual(sizes, walk())
+        self.assertEqual(4, len(listed))
+        manifest.max_age = None
+
+        # Removed directories are forgotten
+        os.rmdir(path_join(self.remote, sub, 'empty'))
+        touch(sub, 6000)
+        self.assertEqual(sizes, walk(concurrency=3))
+        root = 'user@localhost:22'
+        self.assertIsNone(
+            manifest.dir_mtime(root, path_join(sub, 'empty')))
+        self.assertEqual(6000, manifest.dir_mtime(root, sub))
+        manifest.close()
+
+    def test_raise_exceptions(self):
+        self.client.raise_exceptions = True
+        for concurrency in (1, 3):
+            with self.assertRaises(IOError):
+                list(
+                    self.client.listdir_attr_recurse(
+                        'dir', concurrency=concurrency))
+            self.client.raise_exceptions = False
+            with self.assertRaises(IOError):
+                list(
+                    self.client.listdir_attr_recurse(
+                        path_join('dir', 'sub', 'unreadable'),
+                        concurrency=concurrency))
+            self.client.raise_exceptions = True
+
+
+class TestTransferSettings(_FakeServerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.name = path_join('dir', 'sub', '11.bin')
+        self.candidates = (
+            TransferSettings(),
+            TransferSettings(max_requests=64),
+            TransferSettings(window_size=1),
+        )
+
+        def on_open(settings):
+            if settings.window_size == 1:
+                raise SSHException('Refused')
+            return 0.0 if settings.max_requests else 0.001
+
+        self.on_open = on_open
+
+    def test_probe(self):
+        self.assertEqual(
+            self.candidates[1],
+            self.client.probe_transfer_settings(self.name,
+                                                candidates=self.candidates))
+        self.assertEqual(self.candidates[1], self.client.transfer_settings)
+        self.assertEqual(2, len(self.sftps))
+
+    def test_probe_failed(self):
+        with self.assertRaises(IOError):
+            self.client.probe_transfer_settings(
+                self.name, candidates=self.candidates[2:])
+
+    def test_tune(self):
+        cache = TransferSettingsCache(path_join(self.local, 'tuning.json'))
+        with patch('xirvik.sftp.PROBE_CANDIDATES', self.candidates):
+            self.assertEqual(self.candidates[1],
+                             self.client.tune(self.name, cache))
+            self.assertEqual(self.candidates[1]._asdict(),
+                             cache.get('user@localhost:22'))
+            self.client.transfer_settings = TransferSettings()
+            self.sftps.clear()
+            self.assertEqual(self.candidates[1],
+                             self.client.tune(self.name, cache))
+            self.assertEqual([], self.sftps)
+            # Too old
+            self.client.tune(self.name, cache, max_age=-1)
+            self.assertEqual(2, len(self.sftps))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,16 +1,25 @@
 from hashlib import sha1
 from io import BytesIO as StringIO
-from os import close as close_fd, remove as rm, rmdir, write as write_fd
-from os.path import basename, dirname
+from os import (close as close_fd, makedirs, remove as rm, rmdir, utime,
+                write as write_fd)
+from os.path import basename, dirname, join as path_join
 from random import SystemRandom
+from shutil import rmtree
 from tempfile import mkdtemp, mkstemp
 from typing import List, Optional
+from unittest.mock import patch
 import sys
 import unittest
 
 from benc import encode as bencode
 
-from xirvik.util import VerificationError, verify_torrent_contents
+from xirvik import util
+from xirvik.cache import VerifiedStateStore
+from xirvik.metainfo import parse_metainfo
+from xirvik.util import (BadPiece, FileRange, StreamingVerifier,
+                         TorrentIndex, VerificationError, WrongSizeFile,
+                         info_hash_hex, verify_torrent_contents,
+                         verify_torrent_report, verify_torrents)
 
 random = SystemRandom()
 
@@ -108,6 +117,28 @@ class TestTorrentVerification(TempFilesMixin, unittest.TestCase):
         verify_torrent_contents(StringIO(self.torrent_data),
                                 dirname(self.torrent_data_path))
 
+    def test_verify_torrent_contents_workers(self):
+        verify_torrent_contents(self.torrent_data,
+                                dirname(self.torrent_data_path),
+                                workers=4)
+
+    def test_verify_torrent_contents_workers_bad_compare(self):
+        with open(self.file2, 'r+b') as f:
+            f.seek(self.FILE_SIZE - 1)
+            f.write(b'\0' if f.read(1) != b'\0' else b'\1')
+
+        with self.assertRaises(VerificationError):
+            verify_torrent_contents(self.torrent_data,
+                                    dirname(self.torrent_data_path),
+                                    workers=4)
+
+    def test_verify_torrent_contents_workers_file_missing(self):
+        rm(self.file2)
+        with self.assertRaises(VerificationError):
+            verify_torrent_contents(self.torrent_data,
+                                    dirname(self.torrent_data_path),
+                                    workers=4)
+
     def test_verify_torrent_contents_invalid_path(self):
         with self.assertRaises(IOError):
             verify_torrent_contents(self.torrent_data,
@@ -165,6 +196,7 @@ class TestSingleFileTorrentVerification(TempFilesMixin, unittest.TestCase):
                 b'name': self.file1.encode('utf-8'),
                 b'piece length': self.PIECE_LENGTH,
                 b'pieces': pieces,
+                b'length': self.FILE_SIZE,
             }
         }
         self.torrent_data = bencode(self.torrent_data_dict)
@@ -195,5 +227,467 @@ class TestSingleFileTorrentVerification(TempFilesMixin, unittest.TestCase):
                                     self.torrent_data_path)
 
 
+    def test_verify_torrent_report(self):
+        report = verify_torrent_report(self.torrent_data_dict,
+                                       self.torrent_data_path)
+        self.assertTrue(report.ok)
+        self.assertEqual(10, report.piece_count)
+
+        with open(self.file1, 'r+b') as f:
+            f.seek(self.PIECE_LENGTH * 9 + 1)
+            f.write(b'\0\0')
+        report = verify_torrent_report(self.torrent_data_dict,
+                                       self.torrent_data_path)
+        self.assertFalse(report.ok)
+        self.assertEqual([
+            BadPiece(9, [
+                FileRange(self.file1, self.PIECE_LENGTH * 9, self.FILE_SIZE)
+            ])
+        ], report.bad_pieces)
+        self.assertEqual([self.file1], report.damaged_files)
+
+
+class TestManySmallFilesTorrentVerification(unittest.TestCase):
+    PIECE_LENGTH = 256
+
+    def setUp(self):
+        self.root = mkdtemp(prefix='test-many-files-')
+        self.name = 'many'
+        makedirs(path_join(self.root, self.name, 'sub'))
+        all_data = bytearray()
+        files = []
+        for i in range(300):
+            # Includes empty files and files larger than a piece
+            data = create_random_data(random.randrange(0, 600))
+            path = ['sub', f'{i}.bin'] if i % 2 else [f'{i}.bin']
+            with open(path_join(self.root, self.name, *path), 'wb') as f:
+                f.write(data)
+            all_data += data
+            files.append({
+                b'length': len(data),
+                b'path': [x.encode('utf-8') for x in path],
+            })
+        self.files = files
+        self.torrent_data_dict = {
+            b'info': {
+                b'name':
+                self.name.encode('utf-8'),
+                b'piece length':
+                self.PIECE_LENGTH,
+                b'pieces':
+                b''.join(
+                    sha1(all_data[i:i + self.PIECE_LENGTH]).digest()
+                    for i in range(0, len(all_data), self.PIECE_LENGTH)),
+                b'files':
+                files,
+            }
+        }
+
+    def tearDown(self):
+        rmtree(self.root)
+
+    def test_verify(self):
+        for workers in (1, 3):
+            verify_torrent_contents(self.torrent_data_dict,
+                                    self.root,
+                                    workers=workers)
+
+    def test_verify_checkpoint(self):
+        checkpoint = path_join(self.root, 'checkpoint.json')
+        read_pieces: List[int] = []
+        original = util._read_pieces_at
+
+        def read_pieces_at(files, piece_length, indexes, buffers=1):
+            indexes = list(indexes)
+            read_pieces.extend(indexes)
+            return original(files, piece_length, indexes, buffers)
+
+        with patch.object(util, '_read_pieces_at', read_pieces_at):
+            verify_torrent_contents(self.torrent_data_dict,
+                                    self.root,
+                                    checkpoint=checkpoint)
+            count = len(self.torrent_data_dict[b'info'][b'pieces']) // 20
+            self.assertEqual(list(range(count)), read_pieces)
+
+            # Nothing changed: nothing is read
+            read_pieces.clear()
+            verify_torrent_contents(self.torrent_data_dict,
+                                    self.root,
+                                    checkpoint=checkpoint,
+                                    workers=2)
+            self.assertEqual([], read_pieces)
+
+            # Corrupt one file: only its pieces are read and verification
+            # fails
+            index, info = next((i, x) for i, x in enumerate(self.files)
+                               if x[b'length'])
+            path = path_join(self.root, self.name,
+                             *[x.decode('utf-8') for x in info[b'path']])
+            with open(path, 'r+b') as f:
+                data = bytearray(f.read())
+                data[0] ^= 1
+                f.seek(0)
+                f.write(data)
+            offset = sum(x[b'length'] for x in self.files[:index])
+            first = offset // self.PIECE_LENGTH
+            last = (offset + info[b'length'] - 1) // self.PIECE_LENGTH
+            read_pieces.clear()
+            with self.assertRaises(VerificationError):
+                verify_torrent_contents(self.torrent_data_dict,
+                                        self.root,
+                                        checkpoint=checkpoint)
+            self.assertEqual(list(range(first, last + 1)), read_pieces)
+
+            # Fix it: only the failed pieces are read again
+            data[0] ^= 1
+            with open(path, 'wb') as f:
+                f.write(data)
+            read_pieces.clear()
+            verify_torrent_contents(self.torrent_data_dict,
+                                    self.root,
+                                    checkpoint=checkpoint)
+            self.assertEqual(list(range(first, last + 1)), read_pieces)
+
+    def test_verify_checkpoint_missing_file(self):
+        checkpoint = path_join(self.root, 'checkpoint.json')
+        info = [x for x in self.files if x[b'length']][-1]
+        rm(path_join(self.root, self.name,
+                     *[x.decode('utf-8') for x in info[b'path']]))
+        with self.assertRaises(VerificationError):
+            verify_torrent_contents(self.torrent_data_dict,
+                                    self.root,
+                                    checkpoint=checkpoint)
+
+    def _file_path(self, info):
+        return path_join(self.root, self.name,
+                         *[x.decode('utf-8') for x in info[b'path']])
+
+    def _piece_range(self, index):
+        offset = sum(x[b'length'] for x in self.files[:index])
+        return (offset // self.PIECE_LENGTH,
+                (offset + self.files[index][b'length'] - 1) //
+                self.PIECE_LENGTH)
+
+    def test_index(self):
+        index = TorrentIndex(self.torrent_data_dict[b'info'], self.root)
+        data = bytearray()
+        by_path = {}
+        for i, (name, (path, length)) in enumerate(
+                zip(index.names, index.files)):
+            self.assertEqual(path_join(self.root, self.name, name), path)
+            self.assertEqual(i, index.file_index(name))
+            self.assertEqual(len(data), index.starts[i])
+            with open(path, 'rb') as f:
+                data += f.read()
+            by_path[path] = i
+        self.assertEqual(len(data), index.total_size)
+        self.assertEqual(
+            len(self.torrent_data_dict[b'info'][b'pieces']) // 20,
+            index.piece_count)
+        for i, (path, length) in enumerate(index.files):
+            pieces = index.pieces_for_file(i)
+            if not length:
+                self.assertEqual(0, len(pieces))
+            for piece in pieces:
+                self.assertIn(i, index.files_for_piece(piece))
+        for piece in range(index.piece_count):
+            start = piece * self.PIECE_LENGTH
+            chunk = b''.join(
+                data[index.starts[by_path[x.path]] +
+                     x.start:index.starts[by_path[x.path]] + x.end]
+                for x in index.file_ranges(piece))
+            self.assertEqual(bytes(data[start:start + self.PIECE_LENGTH]),
+                             chunk)
+            self.assertEqual(index.piece_hash(piece), sha1(chunk).digest())
+
+    def test_verify_size_precheck(self):
+        info = [x for x in self.files if x[b'length']][-1]
+        with open(self._file_path(info), 'ab') as f:
+            f.write(b'\0')
+        with patch.object(util, '_read_torrent_pieces') as read_pieces:
+            with self.assertRaisesRegex(VerificationError, 'expected'):
+                verify_torrent_contents(self.torrent_data_dict, self.root)
+            read_pieces.assert_not_called()
+        rm(self._file_path(info))
+        with self.assertRaisesRegex(VerificationError, 'missing'):
+            verify_torrent_contents(self.torrent_data_dict, self.root)
+
+    def test_verify_files(self):
+        index = TorrentIndex(self.torrent_data_dict[b'info'], self.root)
+        chosen = max(range(len(self.files)),
+                     key=lambda i: self.files[i][b'length'])
+        name = index.names[chosen]
+        read_pieces: List[int] = []
+        original = util._read_pieces_at
+
+        def read_pieces_at(files, piece_length, indexes, buffers=1):
+            indexes = list(indexes)
+            read_pieces.extend(indexes)
+            return original(files, piece_length, indexes, buffers)
+
+        # Another file being damaged does not matter unless it shares a
+        # piece with the chosen file
+        other = next(
+            i for i, x in enumerate(self.files)
+            if x[b'length'] and not set(index.pieces_for_file(i))
+            & set(index.pieces_for_file(chosen)))
+        with open(self._file_path(self.files[other]), 'r+b') as f:
+            first = f.read(1)
+            f.seek(0)
+            f.write(bytes((first[0] ^ 1, )))
+        with patch.object(util, '_read_pieces_at', read_pieces_at):
+            for workers in (1, 3):
+                read_pieces.clear()
+                verify_torrent_contents(self.torrent_data_dict,
+                                        self.root,
+                                        workers=workers,
+                                        files=[name])
+                self.assertEqual(list(index.pieces_for_file(chosen)),
+                                 read_pieces)
+            with self.assertRaises(VerificationError):
+                verify_torrent_contents(self.torrent_data_dict,
+                                        self.root,
+                                        files=[index.names[other]])
+        with self.assertRaises(ValueError):
+            verify_torrent_contents(self.torrent_data_dict,
+                                    self.root,
+                                    files=['not-a-file'])
+
+    def test_verify_report(self):
+        for workers in (1, 3):
+            report = verify_torrent_report(self.torrent_data_dict,
+                                           self.root,
+                                           workers=workers)
+            self.assertTrue(report.ok)
+            self.assertEqual(
+                len(self.torrent_data_dict[b'info'][b'pieces']) // 20,
+                report.piece_count)
+
+    def test_verify_report_damaged(self):
+        non_empty = [
+            i for i, x in enumerate(self.files)
+            if x[b'length'] > self.PIECE_LENGTH * 2
+        ]
+        corrupt, missing, short = non_empty[0], non_empty[3], non_empty[6]
+        path = self._file_path(self.files[corrupt])
+        with open(path, 'r+b') as f:
+            f.seek(self.PIECE_LENGTH)
+            first = f.read(1)
+            f.seek(self.PIECE_LENGTH)
+            f.write(bytes((first[0] ^ 1, )))
+        rm(self._file_path(self.files[missing]))
+        with open(self._file_path(self.files[short]), 'r+b') as f:
+            f.truncate(1)
+        expected_bad = set()
+        for index in (missing, short):
+            first, last = self._piece_range(index)
+            expected_bad.update(range(first, last + 1))
+        offset = sum(x[b'length'] for x in self.files[:corrupt])
+        corrupt_piece = (offset + self.PIECE_LENGTH) // self.PIECE_LENGTH
+        expected_bad.add(corrupt_piece)
+        for workers in (1, 3):
+            report = verify_torrent_report(self.torrent_data_dict,
+                                           self.root,
+                                           workers=workers)
+            self.assertFalse(report.ok)
+            self.assertEqual(sorted(expected_bad),
+                             [x.index for x in report.bad_pieces])
+            self.assertEqual([self._file_path(self.files[missing])],
+                             report.missing_files)
+            self.assertEqual([
+                WrongSizeFile(self._file_path(self.files[short]),
+                              self.files[short][b'length'], 1)
+            ], report.wrong_size_files)
+            piece = next(x for x in report.bad_pieces
+                         if x.index == corrupt_piece)
+            self.assertIn(path, [x.path for x in piece.files])
+            for x in piece.files:
+                self.assertLess(x.start, x.end)
+                self.assertLessEqual(x.end - x.start, self.PIECE_LENGTH)
+            self.assertEqual(
+                sorted(
+                    self._file_path(self.files[x])
+                    for x in (corrupt, missing, short)),
+                report.damaged_files)
+
+    def _feed(self, verifier, file_indexes, corrupt=None):
+        # Feeds files in random sized blocks, the blocks of each file
+        # shuffled
+        for i in file_indexes:
+            with open(verifier.index.files[i][0], 'rb') as f:
+                data = f.read()
+            blocks = []
+            offset = 0
+            while offset < len(data):
+                n = random.randrange(1, 100)
+                blocks.append((offset, data[offset:offset + n]))
+                offset += n
+            random.shuffle(blocks)
+            for offset, block in blocks:
+                if i == corrupt and offset == 0:
+                    block = bytes((block[0] ^ 1, )) + block[1:]
+                verifier.feed(i, offset, block)
+
+    def test_streaming_verifier(self):
+        index = TorrentIndex(self.torrent_data_dict[b'info'], self.root)
+        results = {}
+        verifier = StreamingVerifier(index, on_piece=results.__setitem__)
+        self._feed(verifier, reversed(range(len(index.files))))
+        self.assertEqual({x: True for x in range(index.piece_count)}, results)
+        with patch.object(util, '_read_pieces_at',
+                          wraps=util._read_pieces_at) as read_pieces:
+            report = verifier.finish(workers=2)
+            self.assertEqual([], list(read_pieces.call_args[0][2]))
+        self.assertTrue(report.ok)
+
+    def test_streaming_verifier_partial(self):
+        index = TorrentIndex(self.torrent_data_dict[b'info'], self.root)
+        checkpoint = path_join(self.root, 'checkpoint.json')
+        fed = range(len(index.files) // 2)
+        corrupt = next(i for i in fed if self.files[i][b'length'])
+        verifier = StreamingVerifier(index)
+        self.assertEqual(0, verifier.file_index(index.files[0][0]))
+        self.assertIsNone(verifier.file_index(self.root))
+        self._feed(verifier, fed, corrupt=corrupt)
+        self.assertIn(False, verifier.results.values())
+        done = set(verifier.results)
+        with patch.object(util, '_read_pieces_at',
+                          wraps=util._read_pieces_at) as read_pieces:
+            report = verifier.finish(checkpoint=checkpoint)
+            remaining = list(read_pieces.call_args[0][2])
+        self.assertEqual(
+            sorted(set(range(index.piece_count)) - done), remaining)
+        # The corruption was only in what was fed, the files are fine
+        bad_piece = index.starts[corrupt] // self.PIECE_LENGTH
+        self.assertIn(bad_piece, done)
+        self.assertEqual([bad_piece], [x.index for x in report.bad_pieces])
+        # Only the bad piece is read with the checkpoint
+        with patch.object(util, '_read_pieces_at',
+                          wraps=util._read_pieces_at) as read_pieces:
+            report = StreamingVerifier(index).finish(checkpoint=checkpoint)
+            self.assertEqual([bad_piece], list(read_pieces.call_args[0][2]))
+        self.assertTrue(report.ok)
+
+    def test_verify_torrents(self):
+        small = {
+            b'info': {
+                b'name': b'small',
+                b'piece length': self.PIECE_LENGTH,
+                b'pieces': sha1(b'small').digest(),
+                b'length': 5,
+            }
+        }
+        with open(path_join(self.root, 'small'), 'wb') as f:
+            f.write(b'small')
+        empty = {
+            b'info': {
+                b'name': b'empty',
+                b'piece length': self.PIECE_LENGTH,
+                b'pieces': b'',
+                b'length': 0,
+            }
+        }
+        open(path_join(self.root, 'empty'), 'wb').close()
+        bad = {
+            b'info': {
+                b'name': b'bad',
+                b'piece length': self.PIECE_LENGTH,
+                b'pieces': sha1(b'other').digest(),
+                b'length': 5,
+            }
+        }
+        with open(path_join(self.root, 'bad'), 'wb') as f:
+            f.write(b'small')
+        jobs = {
+            'many': (self.torrent_data_dict, self.root),
+            'small': (bencode(small), self.root),
+            'empty': (empty, self.root),
+            'bad': (bad, self.root),
+            'missing': (small, self.root + 'junk'),
+            'invalid': (b'not a torrent', self.root),
+        }
+        for workers, batch_size in ((1, 1), (3, 2), (3, 16)):
+            with patch.object(util,
+                              '_read_pieces_at',
+                              wraps=util._read_pieces_at) as read_pieces:
+                results = list(
+                    verify_torrents(jobs,
+                                    workers=workers,
+                                    max_active=2,
+                                    batch_size=batch_size))
+            # One reader per torrent that could be loaded
+            self.assertEqual(5, read_pieces.call_count)
+            self.assertEqual(sorted(jobs), sorted(x[0] for x in results))
+            results_dict = dict(results)
+            self.assertTrue(results_dict['many'].ok)
+            self.assertTrue(results_dict['small'].ok)
+            self.assertTrue(results_dict['empty'].ok)
+            self.assertEqual([0], [
+                x.index for x in results_dict['bad'].bad_pieces
+            ])
+            self.assertEqual([path_join(self.root + 'junk', 'small')],
+                             results_dict['missing'].missing_files)
+            self.assertIsInstance(results_dict['invalid'], ValueError)
+            if batch_size < 16:
+                # Torrents are interleaved so small ones finish first
+                self.assertEqual('many', results[-1][0])
+
+    def test_info_hash_hex(self):
+        expected = sha1(bencode(
+            self.torrent_data_dict[b'info'])).hexdigest().upper()
+        self.assertEqual(expected, info_hash_hex(self.torrent_data_dict))
+        self.assertEqual(
+            expected,
+            info_hash_hex(parse_metainfo(bencode(self.torrent_data_dict))))
+
+    def test_verify_state_store(self):
+        store = VerifiedStateStore(path_join(self.root, 'verified.sqlite3'))
+        self.addCleanup(store.close)
+        with patch.object(util,
+                          '_read_torrent_pieces',
+                          wraps=util._read_torrent_pieces) as read_pieces:
+            verify_torrent_contents(self.torrent_data_dict,
+                                    self.root,
+                                    state_store=store)
+            self.assertEqual(1, read_pieces.call_count)
+            self.assertIsNotNone(
+                store.verified_at(info_hash_hex(self.torrent_data_dict)))
+            # Nothing changed: nothing is read
+            verify_torrent_contents(self.torrent_data_dict,
+                                    self.root,
+                                    state_store=store)
+            self.assertEqual(1, read_pieces.call_count)
+            # A changed file is noticed even with the same size
+            info = next(x for x in self.files if x[b'length'])
+            with open(self._file_path(info), 'r+b') as f:
+                first = f.read(1)
+                f.seek(0)
+                f.write(bytes((first[0] ^ 1, )))
+            # In case the modification time has not moved on
+            utime(self._file_path(info), (1, 1))
+            with self.assertRaises(VerificationError):
+                verify_torrent_contents(self.torrent_data_dict,
+                                        self.root,
+                                        state_store=store)
+            self.assertEqual(2, read_pieces.call_count)
+            with self.assertRaises(VerificationError):
+                verify_torrent_contents(self.torrent_data_dict,
+                                        self.root,
+                                        state_store=store)
+            self.assertEqual(3, read_pieces.call_count)
+
+    def test_verify_bad_compare(self):
+        info = next(x for x in self.files if x[b'length'])
+        path = [x.decode('utf-8') for x in info[b'path']]
+        with open(path_join(self.root, self.name, *path), 'r+b') as f:
+            first = f.read(1)
+            f.seek(0)
+            f.write(bytes((first[0] ^ 1, )))
+        for workers in (1, 3):
+            with self.assertRaises(VerificationError):
+                verify_torrent_contents(self.torrent_data_dict,
+                                        self.root,
+                                        workers=workers)
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,16 +1,19 @@
 """Typing helpers."""
 from datetime import datetime
-from typing import Callable, Optional, TypeVar
+from typing import Any, Callable, Optional, TypeVar
 
 from typing_extensions import TypedDict
 
-__all__ = ('Method0', 'Method1', 'TorrentDict')
+__all__ = ('Method0', 'Method1', 'TorrentDict', 'WriteHook')
 
 T = TypeVar('T')
 U = TypeVar('U')
 V = TypeVar('V')
 Method0 = Callable[[T], V]
 Method1 = Callable[[T, U], V]
+#: Called with the local path, offset and data of every block written by a
+#: download.
+WriteHook = Callable[[str, int, bytes], Any]
 
 
 class TorrentDict(TypedDict):
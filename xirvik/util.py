@@ -1,26 +1,52 @@
 """General utility module."""
+from base64 import b64decode, b64encode
+from bisect import bisect_left, bisect_right
+from collections import deque
+from concurrent.futures import (FIRST_COMPLETED, Future, ThreadPoolExecutor,
+                                wait)
 from hashlib import sha1
 from hmac import compare_digest
+from itertools import accumulate, islice
 from os import R_OK, access, environ, stat
-from os.path import isdir, join as path_join, realpath
-from typing import (Any, BinaryIO, Iterable, Iterator, NoReturn, Optional,
-                    Sequence, TypeVar, Union, cast)
+from os.path import isdir, join as path_join, normpath, realpath
+from stat import S_ISREG
+from threading import Lock
+from typing import (Any, BinaryIO, Callable, Deque, Dict, Iterable, Iterator,
+                    List, Mapping, NamedTuple, NoReturn, Optional, Sequence,
+                    Tuple, TypeVar, Union, cast)
 import argparse
+import json
 import platform
-import struct
 import sys
 
 import benc
 
+from .cache import VerifiedStateStore, write_atomic
+from .metainfo import parse_metainfo
+
 __all__ = (
     'cleanup_and_exit',
     'ctrl_c_handler',
+    'BadPiece',
+    'FileRange',
     'VerificationError',
+    'VerificationReport',
+    'WrongSizeFile',
+    'info_hash_hex',
     'verify_torrent_contents',
+    'verify_torrent_report',
+    'verify_torrents',
     'ReadableDirectoryListAction',
+    'StreamingVerifier',
+    'TorrentFile',
+    'TorrentIndex',
 )
 
 T = TypeVar('T')
+#: Pieces read from a torrent at a time by verify_torrents().
+VERIFY_BATCH_SIZE = 16
+#: Torrent file path, file object, contents or metainfo.
+TorrentFile = Union[str, BinaryIO, bytes, Mapping[bytes, Any]]
 
 
 class ReadableDirectoryAction(argparse.Action):
@@ -82,131 +108,775 @@ def ctrl_c_handler(signum: int, frame: Any) -> NoReturn:
     raise SystemExit('Signal raised')
 
 
-def _chunks(l: Sequence[T], n: int) -> Iterator[Sequence[T]]:
-    # Source: http://stackoverflow.com/a/312464/374110
-    for i in range(0, len(l), n):
-        yield l[i:i + n]
-
-
-def _get_torrent_pieces(filenames: Iterable[str], basepath: str,
-                        piece_length: int) -> Iterator[Optional[bytes]]:
-    # Yes this is a generator and should not be used any other way (i.e. do not
-    # wrap in list()).
-    buf = b''
-    p_delta = piece_length
-
+def _read_torrent_pieces(filenames: Iterable[str],
+                         piece_length: int,
+                         buffers: int = 1) -> Iterator[Optional[memoryview]]:
+    # Files are read straight into piece-sized buffers with readinto(), so a
+    # piece spanning many files is never copied. Buffers are reused in turn:
+    # a yielded piece is only valid until buffers more pieces have been read.
+    # None is yielded (and reading stops) if a file cannot be read
+    views: List[memoryview] = []
+    index = 0
+    filled = 0
+    view = None
     for name in filenames:
-        name = path_join(basepath, name)
-        size = None
         try:
-            size = stat(name).st_size
+            with open(name, 'rb', buffering=0) as f:
+                while True:
+                    if view is None:
+                        if len(views) < buffers:
+                            views.append(memoryview(bytearray(piece_length)))
+                        view = views[index]
+                    n = f.readinto(view[filled:])
+                    if not n:
+                        break
+                    filled += n
+                    if filled == piece_length:
+                        yield view
+                        index = (index + 1) % buffers
+                        view = None
+                        filled = 0
         except OSError:
             yield None
+            return
+    # Very last set of bytes of the last file, and this will be <= piece size
+    # If this is not returned, a false positive can be given if the last
+    # file's last piece is not valid
+    if filled:
+        yield cast(memoryview, view)[:filled]
 
-        assert size is not None
-        if size <= piece_length and p_delta > size:
-            with open(name, 'rb') as f:
-                tmp = f.read()
-                p_delta -= len(tmp)
 
-                if p_delta <= 0:
-                    p_delta = piece_length
+def _sha1_digest(piece: Optional[memoryview]) -> bytes:
+    # None is yielded by _read_torrent_pieces() for unreadable files
+    if piece is None:
+        raise VerificationError('Unable to get hash for piece')
+    return sha1(piece).digest()
 
-                buf += tmp
 
-            continue
+def _optional_sha1_digest(piece: Optional[memoryview]) -> Optional[bytes]:
+    return None if piece is None else sha1(piece).digest()
 
+
+def _parallel_digests(pieces: Iterable[Optional[memoryview]],
+                      workers: int,
+                      digest: Callable[[Optional[memoryview]],
+                                       Any] = _sha1_digest,
+                      stop_at_error: bool = True) -> Iterator[Any]:
+    # Pieces are read in order on the calling thread and hashed on a thread
+    # pool (hashlib releases the GIL). At most workers pieces are being hashed
+    # while the next one is read, so pieces must come from a reader with at
+    # least workers + 1 buffers. Digests are yielded in piece order
+    window: Deque['Future[Any]'] = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
         try:
-            with open(name, 'rb') as f:
-                while True:
-                    tmp = f.read(p_delta)
-                    p_delta -= len(tmp)
+            for piece in pieces:
+                window.append(executor.submit(digest, piece))
+                if piece is None and stop_at_error:
+                    # Verification fails here, do not read past it
+                    break
+                if len(window) >= workers:
+                    yield window.popleft().result()
+            while window:
+                yield window.popleft().result()
+        finally:
+            for future in window:
+                future.cancel()
+
+
+def _read_pieces_at(files: Sequence[Tuple[str, int]],
+                    piece_length: int,
+                    indexes: Iterable[int],
+                    buffers: int = 1) -> Iterator[Optional[memoryview]]:
+    # Like _read_torrent_pieces() but reads only the pieces in indexes, at
+    # the offsets given by the file lengths in the metainfo. None is yielded
+    # for a piece if a file it spans is missing or shorter than expected
+    starts = [0] + list(accumulate(x[1] for x in files))
+    total = starts[-1]
+    views: List[memoryview] = []
+    slot = 0
+    current: Optional[Tuple[int, BinaryIO]] = None
+    try:
+        for index in indexes:
+            if len(views) < buffers:
+                views.append(memoryview(bytearray(piece_length)))
+            view = views[slot]
+            slot = (slot + 1) % buffers
+            pos = index * piece_length
+            end = min(pos + piece_length, total)
+            filled = 0
+            i = bisect_right(starts, pos) - 1
+            try:
+                while pos < end:
+                    want = min(end, starts[i] + files[i][1]) - pos
+                    if want:
+                        if not current or current[0] != i:
+                            if current:
+                                current[1].close()
+                                current = None
+                            current = (i, open(files[i][0], 'rb',
+                                               buffering=0))
+                        f = current[1]
+                        f.seek(pos - starts[i])
+                        target = view[filled:filled + want]
+                        while target:
+                            n = f.readinto(target)
+                            if not n:
+                                raise EOFError(files[i][0])
+                            target = target[n:]
+                        filled += want
+                        pos += want
+                    i += 1
+            except (OSError, EOFError):
+                yield None
+                continue
+            yield view[:filled]
+    finally:
+        if current:
+            current[1].close()
+
+
+#: Size of a piece hash.
+_DIGEST_SIZE = sha1().digest_size
 
-                    if not tmp:
-                        break
 
-                    buf += tmp
+class VerificationError(Exception):
+    """Raised when an error occurs in verify_torrent_contents()."""
 
-                    if len(tmp) < p_delta:
-                        break
 
-                    if p_delta <= 0:
-                        yield buf
-                        buf = b''
-                        p_delta = piece_length
-        except IOError:
-            yield None
+class FileRange(NamedTuple):
+    """Byte range of a file covered by a piece."""
+    #: Path of the file.
+    path: str
+    #: Offset of the first byte.
+    start: int
+    #: Offset after the last byte.
+    end: int
+
+
+class BadPiece(NamedTuple):
+    """Piece that could not be read or whose hash does not match."""
+    #: Piece index.
+    index: int
+    #: Ranges of the files the piece covers.
+    files: Sequence[FileRange]
+
+
+class WrongSizeFile(NamedTuple):
+    """File whose size is not the size in the metainfo."""
+    path: str
+    expected: int
+    actual: int
+
+
+class VerificationReport(NamedTuple):
+    """Result of verify_torrent_report()."""
+    #: Number of pieces in the torrent.
+    piece_count: int
+    #: Pieces that failed, in order.
+    bad_pieces: Sequence[BadPiece]
+    #: Files that do not exist or are not regular files.
+    missing_files: Sequence[str]
+    #: Files that are too short or too long.
+    wrong_size_files: Sequence[WrongSizeFile]
+
+    @property
+    def ok(self) -> bool:
+        """True if every piece passed and every file has the right size."""
+        return not (self.bad_pieces or self.missing_files
+                    or self.wrong_size_files)
+
+    @property
+    def damaged_files(self) -> List[str]:
+        """
+        Sorted paths of the files that need to be downloaded again.
+
+        A bad piece that spans a missing or wrong size file is assumed to
+        fail because of that file only.
+        """
+        incomplete = set(self.missing_files)
+        incomplete.update(x.path for x in self.wrong_size_files)
+        damaged = set(incomplete)
+        for piece in self.bad_pieces:
+            paths = {x.path for x in piece.files}
+            if not paths & incomplete:
+                damaged.update(paths)
+        return sorted(damaged)
+
+
+def info_hash_hex(metainfo: Mapping[bytes, Any]) -> str:
+    """
+    Info hash of metainfo in upper case hexadecimal, as used by ruTorrent.
+    """
+    info_hash = getattr(metainfo, 'info_hash', None)
+    if info_hash is None:
+        info_hash = sha1(benc.encode(metainfo[b'info'])).digest()
+    return info_hash.hex().upper()
 
-    # Very last set of bytes of the last file, and this will be <= piece size
-    # If this is not returned, a false positive can be given if the last
-    # file's last piece is not valid
-    if buf:
-        yield buf
 
+def _load_torrent(torrent_file: TorrentFile) -> Mapping[bytes, Any]:
+    if isinstance(torrent_file, Mapping):
+        return torrent_file
+    if hasattr(torrent_file, 'seek') and hasattr(torrent_file, 'read'):
+        cast(BinaryIO, torrent_file).seek(0)
+        return parse_metainfo(cast(BinaryIO, torrent_file).read())
+    try:
+        with open(cast(str, torrent_file), 'rb') as f:
+            data = f.read()
+    except (IOError, TypeError, ValueError):
+        if isinstance(torrent_file, str):
+            raise
+        # ValueError for 'embedded null byte' in Python 3.5
+        data = cast(bytes, torrent_file)
+    return parse_metainfo(data)
 
-class VerificationError(Exception):
-    """Raised when an error occurs in verify_torrent_contents()."""
 
+class TorrentIndex:
+    """
+    File and piece offsets of a torrent, built from the info dictionary of
+    its metainfo.
 
-def verify_torrent_contents(torrent_file: Union[str, BinaryIO, bytes],
-                            path: str) -> None:
+    Used to find the pieces a file spans (and the reverse) without reading
+    any data.
     """
-    Verify torrent contents.
+    def __init__(self, info: Mapping[bytes, Any], path: str):
+        """path is the directory the torrent's data is saved in."""
+        name = info[b'name'].decode('utf-8')
+        root = path_join(path, name)
+        #: Names of the files relative to the torrent's root directory, or
+        #: the torrent's name for a single file torrent.
+        self.names: List[str]
+        #: Local path and length of each file.
+        self.files: List[Tuple[str, int]]
+        if b'files' in info:
+            parts = [[y.decode('utf-8') for y in x[b'path']]
+                     for x in info[b'files']]
+            self.names = ['/'.join(x) for x in parts]
+            self.files = [(path_join(root, *x), y[b'length'])
+                          for x, y in zip(parts, info[b'files'])]
+        else:
+            self.names = [name]
+            self.files = [(root, info[b'length'])]
+        self.piece_length: int = info[b'piece length']
+        self.pieces = memoryview(info[b'pieces'])
+        self.piece_count = len(self.pieces) // _DIGEST_SIZE
+        #: Offset of each file in the torrent's data, followed by the total
+        #: size.
+        self.starts = [0] + list(accumulate(x[1] for x in self.files))
+        self._by_name = {x: i for i, x in enumerate(self.names)}
+
+    @property
+    def total_size(self) -> int:
+        """Size of all files."""
+        return self.starts[-1]
+
+    def file_index(self, name: str) -> int:
+        """Index of a file by name (as in names). Raises KeyError."""
+        return self._by_name[name]
+
+    def piece_hash(self, index: int) -> bytes:
+        """SHA1 digest of a piece from the metainfo."""
+        return bytes(self.pieces[index * _DIGEST_SIZE:(index + 1) *
+                                 _DIGEST_SIZE])
+
+    def pieces_for_file(self, index: int) -> range:
+        """Indexes of the pieces a file spans (empty for an empty file)."""
+        start, end = self.starts[index], self.starts[index + 1]
+        if start == end:
+            return range(0)
+        return range(start // self.piece_length,
+                     (end - 1) // self.piece_length + 1)
+
+    def files_for_piece(self, index: int) -> range:
+        """Indexes of the files a piece spans, including empty files."""
+        start = index * self.piece_length
+        end = min(start + self.piece_length, self.total_size)
+        return range(
+            bisect_right(self.starts, start) - 1,
+            bisect_left(self.starts, end))
+
+    def file_ranges(self, index: int) -> List[FileRange]:
+        """Byte ranges of the non-empty files a piece spans."""
+        start = index * self.piece_length
+        end = min(start + self.piece_length, self.total_size)
+        return [
+            FileRange(self.files[i][0],
+                      max(start, self.starts[i]) - self.starts[i],
+                      min(end, self.starts[i + 1]) - self.starts[i])
+            for i in self.files_for_piece(index) if self.files[i][1]
+        ]
+
+    def stat_files(
+        self,
+        indexes: Optional[Iterable[int]] = None
+    ) -> Tuple[List[str], List[WrongSizeFile]]:
+        """
+        Check the files (all by default) exist with the right size, without
+        reading them. Returns the missing files and the wrong size files.
+        """
+        missing = []
+        wrong_size = []
+        for i in (range(len(self.files)) if indexes is None else indexes):
+            name, length = self.files[i]
+            try:
+                st = stat(name)
+            except OSError:
+                missing.append(name)
+                continue
+            if not S_ISREG(st.st_mode):
+                missing.append(name)
+            elif st.st_size != length:
+                wrong_size.append(WrongSizeFile(name, length, st.st_size))
+        return missing, wrong_size
+
+
+def _file_stat(path: str) -> Optional[List[int]]:
+    try:
+        st = stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
 
-    Pass a torrent file path and the path to check.
+def _load_checkpoint(path: str, key: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(data, dict) or data.get('key') != key:
+        return None
+    return data
+
+
+class _Checkpoint:
+    # Pieces that passed, saved with the size and modification time of each
+    # file. See verify_torrent_contents()
+    def __init__(self, index: TorrentIndex, path: str):
+        self.index = index
+        self.path = path
+        self.key = sha1(index.pieces).hexdigest()
+        self.stats = [_file_stat(name) for name, _ in index.files]
+        data = _load_checkpoint(path, self.key)
+        if data:
+            self.verified = bytearray(b64decode(data['verified']))
+            unchanged = [
+                old == new and new is not None and new[0] == length
+                for old, new, (_, length) in zip(data['files'], self.stats,
+                                                 index.files)
+            ]
+        else:
+            self.verified = bytearray((index.piece_count + 7) // 8)
+            unchanged = [False] * len(index.files)
+        for piece in range(index.piece_count):
+            spans = index.files_for_piece(piece)
+            # Bits are only kept for pieces whose files have not changed
+            if not all(unchanged[spans.start:spans.stop]):
+                self.set(piece, False)
+
+    def passed(self, piece: int) -> bool:
+        return bool(self.verified[piece >> 3] & (0x80 >> (piece & 7)))
+
+    def set(self, piece: int, ok: bool) -> None:
+        if ok:
+            self.verified[piece >> 3] |= 0x80 >> (piece & 7)
+        else:
+            self.verified[piece >> 3] &= ~(0x80 >> (piece & 7))
+
+    def save(self) -> None:
+        write_atomic(
+            self.path,
+            json.dumps(
+                dict(key=self.key,
+                     piece_length=self.index.piece_length,
+                     files=self.stats,
+                     verified=b64encode(
+                         self.verified).decode('ascii'))).encode())
+
+
+def _verify_with_checkpoint(index: TorrentIndex, indexes: Iterable[int],
+                            workers: int, checkpoint: str) -> None:
+    # See verify_torrent_contents()
+    state = _Checkpoint(index, checkpoint)
+    to_check = [x for x in indexes if not state.passed(x)]
+    try:
+        pieces_read = _read_pieces_at(index.files, index.piece_length,
+                                      to_check, workers + 1)
+        digests = (_parallel_digests(pieces_read, workers)
+                   if workers > 1 else map(_sha1_digest, pieces_read))
+        for piece, file_hash in zip(to_check, digests):
+            if not compare_digest(index.piece_hash(piece), file_hash):
+                raise VerificationError('Computed hash does not match '
+                                        'torrent file\'s hash')
+            state.set(piece, True)
+    finally:
+        state.save()
+
+
+def verify_torrent_contents(torrent_file: TorrentFile,
+                            path: str,
+                            workers: int = 1,
+                            checkpoint: Optional[str] = None,
+                            files: Optional[Iterable[str]] = None,
+                            state_store: Optional[VerifiedStateStore] = None
+                            ) -> None:
     """
-    orig_path = path
+    Verify torrent contents.
 
-    if hasattr(torrent_file, 'seek') and hasattr(torrent_file, 'read'):
-        cast(BinaryIO, torrent_file).seek(0)
-        torrent = benc.decode(cast(BinaryIO, torrent_file).read())
-    else:
-        try:
-            with open(cast(str, torrent_file), 'rb') as f:
-                torrent = benc.decode(f.read())
-        except (IOError, TypeError, ValueError):
-            # ValueError for 'embedded null byte' in Python 3.5
-            torrent = benc.decode(torrent_file)
+    Pass a torrent file path (or file object, contents, or already decoded
+    metainfo) and the path to check.
+
+    The size of every file is checked before anything is hashed. If files is
+    given (names as in TorrentIndex.names), only the pieces that span those
+    files are hashed.
+
+    With workers greater than 1, pieces are hashed on that many threads while
+    the next pieces are read.
+
+    If checkpoint is a file path, the pieces that pass and the size and
+    modification time of each file are saved to it, even if verification
+    fails or is interrupted. Later calls with the same checkpoint skip pieces
+    that passed if none of the files they span have changed.
 
-    path = path_join(path, torrent[b'info'][b'name'].decode('utf-8'))
+    With a state_store, nothing is hashed if the torrent passed before and
+    none of its files have changed since. Passing torrents are recorded in it
+    (unless files is given).
+    """
+    torrent = _load_torrent(torrent_file)
+    root = path_join(path, torrent[b'info'][b'name'].decode('utf-8'))
     is_a_file = False
     try:
-        with open(path, 'rb'):
+        with open(root, 'rb'):
             is_a_file = True
     except IOError:
         pass
 
-    if not isdir(path) and not is_a_file:
+    if not isdir(root) and not is_a_file:
         raise IOError('Path specified for torrent data is invalid')
 
-    piece_length = torrent[b'info'][b'piece length']
-    piece_hashes = _chunks(
-        struct.unpack('<{}B'.format(len(torrent[b'info'][b'pieces'])),
-                      torrent[b'info'][b'pieces']),
-        sha1().digest_size)
-
-    try:
-        filenames: Iterable[str] = ('/'.join((y.decode('utf-8')
-                                              for y in x[b'path']))
-                                    for x in torrent[b'info'][b'files'])
-    except KeyError as e:
-        if e.args[0] != b'files':
-            raise e
-
-        # Single file torrent, never has a directory
-        filenames = [path]
-        path = orig_path
+    index = TorrentIndex(torrent[b'info'], path)
+    if state_store:
+        info_hash = info_hash_hex(torrent)
+        states = state_store.file_states(x[0] for x in index.files)
+        if state_store.is_verified(info_hash, states):
+            return
+    to_check: Sequence[int] = range(index.piece_count)
+    needed: Iterable[int] = range(len(index.files))
+    if files is not None:
+        try:
+            file_indexes = [index.file_index(x) for x in files]
+        except KeyError as e:
+            raise ValueError(f'{e.args[0]} is not in the torrent') from e
+        to_check = sorted(
+            {x
+             for i in file_indexes for x in index.pieces_for_file(i)})
+        needed = sorted(
+            {x
+             for i in to_check for x in index.files_for_piece(i)})
+    missing, wrong_size = index.stat_files(needed)
+    if missing:
+        raise VerificationError(f'{missing[0]} is missing')
+    if wrong_size:
+        raise VerificationError(
+            '{} has size {}, expected {}'.format(wrong_size[0].path,
+                                                 wrong_size[0].actual,
+                                                 wrong_size[0].expected))
+
+    if checkpoint:
+        _verify_with_checkpoint(index, to_check, workers, checkpoint)
+    else:
+        if files is None:
+            pieces = _read_torrent_pieces((x[0] for x in index.files),
+                                          index.piece_length, workers + 1)
+        else:
+            pieces = _read_pieces_at(index.files, index.piece_length,
+                                     to_check, workers + 1)
+        digests = (_parallel_digests(pieces, workers)
+                   if workers > 1 else map(_sha1_digest, pieces))
+        for piece, file_hash in zip(to_check, digests):
+            if not compare_digest(index.piece_hash(piece), file_hash):
+                raise VerificationError('Computed hash does not match '
+                                        'torrent file\'s hash')
+    if state_store and states is not None and files is None:
+        state_store.mark_verified(info_hash, states)
+
+
+def verify_torrent_report(torrent_file: TorrentFile,
+                          path: str,
+                          workers: int = 1) -> VerificationReport:
+    """
+    Verify torrent contents without stopping at the first error.
 
-    pieces = _get_torrent_pieces(list(filenames), path, piece_length)
+    Arguments are as for verify_torrent_contents(). Every piece is read and
+    hashed, and a VerificationReport of the bad pieces (with the file ranges
+    they cover), missing files and files of the wrong size is returned.
+    """
+    index = TorrentIndex(_load_torrent(torrent_file)[b'info'], path)
+    missing, wrong_size = index.stat_files()
+    pieces_read = _read_pieces_at(index.files, index.piece_length,
+                                  range(index.piece_count), workers + 1)
+    if workers > 1:
+        digests: Iterable[Optional[bytes]] = _parallel_digests(
+            pieces_read,
+            workers,
+            digest=_optional_sha1_digest,
+            stop_at_error=False)
+    else:
+        digests = map(_optional_sha1_digest, pieces_read)
+    bad = [
+        BadPiece(piece, index.file_ranges(piece))
+        for piece, file_hash in enumerate(digests)
+        if file_hash is None
+        or not compare_digest(index.piece_hash(piece), file_hash)
+    ]
+    return VerificationReport(piece_count=index.piece_count,
+                              bad_pieces=bad,
+                              missing_files=missing,
+                              wrong_size_files=wrong_size)
+
+
+class _PieceState:
+    __slots__ = ('hash', 'position', 'pending')
+
+    def __init__(self) -> None:
+        self.hash = sha1()
+        # Bytes of the piece hashed so far
+        self.position = 0
+        # Data received ahead of position, by offset in the piece
+        self.pending: Dict[int, bytes] = {}
+
+
+class StreamingVerifier:
+    """
+    Verify the pieces of a torrent while its files are being written, so a
+    completed download does not have to be read back from disk.
+
+    Pass every block written with feed(). Blocks of a file can arrive in any
+    order and files can be written in any order; data ahead of the next
+    unhashed byte of a piece is held in memory until the gap is filled (at
+    most a piece per piece that is out of order). Call finish() when all
+    files have been written.
+    """
+    def __init__(self,
+                 index: TorrentIndex,
+                 on_piece: Optional[Callable[[int, bool], Any]] = None):
+        """on_piece is called with the index and result of each piece."""
+        self.index = index
+        self.on_piece = on_piece
+        #: Result of each piece that has been hashed.
+        self.results: Dict[int, bool] = {}
+        self._pieces: Dict[int, _PieceState] = {}
+        self._by_path = {
+            normpath(x[0]): i
+            for i, x in enumerate(index.files)
+        }
+        self._lock = Lock()
+
+    def file_index(self, path: str) -> Optional[int]:
+        """Index of a file by local path, or None if not in the torrent."""
+        return self._by_path.get(normpath(path))
+
+    def feed(self, file_index: int, offset: int, data: bytes) -> None:
+        """Pass data written to a file at offset."""
+        index = self.index
+        start = index.starts[file_index] + offset
+        end = min(start + len(data),
+                  index.starts[file_index] + index.files[file_index][1])
+        view = memoryview(data)
+        with self._lock:
+            while start < end:
+                piece = start // index.piece_length
+                piece_start = piece * index.piece_length
+                n = min(end, piece_start + index.piece_length) - start
+                if piece not in self.results:
+                    self._feed_piece(piece, start - piece_start, view[:n])
+                view = view[n:]
+                start += n
+
+    def _feed_piece(self, piece: int, offset: int, data: memoryview) -> None:
+        try:
+            state = self._pieces[piece]
+        except KeyError:
+            state = self._pieces[piece] = _PieceState()
+        if offset > state.position:
+            state.pending[offset] = bytes(data)
+            return
+        # Data already hashed (for example when a transfer is resumed a few
+        # bytes back) is skipped
+        state.hash.update(data[state.position - offset:])
+        state.position = max(state.position, offset + len(data))
+        while state.pending:
+            offset = min(state.pending)
+            if offset > state.position:
+                break
+            data = memoryview(state.pending.pop(offset))
+            state.hash.update(data[state.position - offset:])
+            state.position = max(state.position, offset + len(data))
+        index = self.index
+        size = min(index.piece_length,
+                   index.total_size - piece * index.piece_length)
+        if state.position >= size:
+            del self._pieces[piece]
+            self._set_result(
+                piece,
+                compare_digest(index.piece_hash(piece), state.hash.digest()))
+
+    def _set_result(self, piece: int, ok: bool) -> None:
+        self.results[piece] = ok
+        if self.on_piece:
+            self.on_piece(piece, ok)
+
+    def finish(self,
+               workers: int = 1,
+               checkpoint: Optional[str] = None) -> VerificationReport:
+        """
+        Read and hash the pieces that were not completely fed (for example
+        those of files that were already downloaded) and return a report of
+        the whole torrent.
+
+        With a checkpoint (as for verify_torrent_contents()), pieces that were
+        not fed but passed before are not read, and the results are saved to
+        it.
+        """
+        index = self.index
+        with self._lock:
+            self._pieces.clear()
+            missing, wrong_size = index.stat_files()
+            state = _Checkpoint(index, checkpoint) if checkpoint else None
+            remaining = []
+            for piece in range(index.piece_count):
+                if piece in self.results:
+                    continue
+                if state and state.passed(piece):
+                    self.results[piece] = True
+                else:
+                    remaining.append(piece)
+            pieces_read = _read_pieces_at(index.files, index.piece_length,
+                                          remaining, workers + 1)
+            if workers > 1:
+                digests: Iterable[Optional[bytes]] = _parallel_digests(
+                    pieces_read,
+                    workers,
+                    digest=_optional_sha1_digest,
+                    stop_at_error=False)
+            else:
+                digests = map(_optional_sha1_digest, pieces_read)
+            for piece, file_hash in zip(remaining, digests):
+                self._set_result(
+                    piece, file_hash is not None
+                    and compare_digest(index.piece_hash(piece), file_hash))
+            if state:
+                for piece, ok in self.results.items():
+                    state.set(piece, ok)
+                state.save()
+            return VerificationReport(
+                piece_count=index.piece_count,
+                bad_pieces=[
+                    BadPiece(x, index.file_ranges(x))
+                    for x in sorted(self.results) if not self.results[x]
+                ],
+                missing_files=missing,
+                wrong_size_files=wrong_size)
+
+
+class _BatchJob:
+    def __init__(self, key: Any, index: TorrentIndex):
+        self.key = key
+        self.index = index
+        self.missing, self.wrong_size = index.stat_files()
+        self.next_piece = 0
+        self.remaining = index.piece_count
+        self.bad: List[int] = []
+        # Read in order with one buffer by one thread at a time
+        self.pieces = _read_pieces_at(index.files, index.piece_length,
+                                      range(index.piece_count))
+
+    def digests(self, count: int) -> List[Optional[bytes]]:
+        return [
+            _optional_sha1_digest(x) for x in islice(self.pieces, count)
+        ]
+
+    def report(self) -> VerificationReport:
+        return VerificationReport(
+            piece_count=self.index.piece_count,
+            bad_pieces=[
+                BadPiece(x, self.index.file_ranges(x))
+                for x in sorted(self.bad)
+            ],
+            missing_files=self.missing,
+            wrong_size_files=self.wrong_size)
+
+
+def verify_torrents(
+    jobs: Mapping[T, Tuple[TorrentFile, str]],
+    workers: int = 1,
+    max_active: Optional[int] = None,
+    batch_size: int = VERIFY_BATCH_SIZE
+) -> Iterator[Tuple[T, Union[VerificationReport, Exception]]]:
+    """
+    Verify many torrents on one thread pool.
 
-    for known_hash, piece in zip(piece_hashes, pieces):
-        known_hash = bytes(known_hash)
+    jobs maps keys to tuples of torrent file and path as passed to
+    verify_torrent_report(). Yields tuples of key and VerificationReport as
+    soon as each torrent is done. If a torrent file cannot be loaded, the
+    exception is yielded in place of the report.
 
+    Pieces are read and hashed by workers threads. Up to max_active torrents
+    (workers by default) are verified at once, taking batch_size pieces from
+    each in turn, so a large torrent does not hold up small ones. Each
+    torrent is read in order by one thread at a time.
+    """
+    max_active = max_active or workers
+    items = iter(jobs.items())
+    # Torrents waiting for their next batch to be read
+    active: Deque[_BatchJob] = deque()
+    in_flight: Dict['Future[List[Optional[bytes]]]', Tuple[_BatchJob,
+                                                             int]] = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
         try:
-            file_hash = sha1(cast(bytes, piece)).digest()
-        except TypeError as e:
-            raise VerificationError('Unable to get hash for piece') from e
-
-        if not compare_digest(known_hash, file_hash):
-            raise VerificationError('Computed hash does not match torrent '
-                                    'file\'s hash')
+            while True:
+                while len(in_flight) < workers:
+                    while len(active) + len(in_flight) < max_active:
+                        try:
+                            key, (torrent_file, path) = next(items)
+                        except StopIteration:
+                            break
+                        try:
+                            job = _BatchJob(
+                                key,
+                                TorrentIndex(
+                                    _load_torrent(torrent_file)[b'info'],
+                                    path))
+                        except (OSError, KeyError, TypeError,
+                                ValueError) as e:
+                            yield key, e
+                            continue
+                        if job.remaining:
+                            active.append(job)
+                        else:
+                            yield key, job.report()
+                    if not active:
+                        break
+                    job = active.popleft()
+                    start = job.next_piece
+                    count = min(batch_size, job.index.piece_count - start)
+                    job.next_piece += count
+                    in_flight[executor.submit(job.digests,
+                                              count)] = (job, start)
+                if not in_flight:
+                    break
+                done, unused_ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job, start = in_flight.pop(future)
+                    file_hashes = future.result()
+                    for piece, file_hash in enumerate(file_hashes, start):
+                        if file_hash is None or not compare_digest(
+                                job.index.piece_hash(piece), file_hash):
+                            job.bad.append(piece)
+                    job.remaining -= len(file_hashes)
+                    if job.next_piece < job.index.piece_count:
+                        active.append(job)
+                    elif not job.remaining:
+                        yield job.key, job.report()
+        finally:
+            for future in in_flight:
+                future.cancel()